@@ -0,0 +1,173 @@
+import math
+import time
+import asyncio
+from collections import deque
+
+from .metrics import registry as metrics
+# 持有时长的 EWMA 系数，用于估算 Retry-After
+HOLD_EWMA_ALPHA = 0.2
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot be admitted; carries a Retry-After hint in seconds."""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """One admitted request. release() is idempotent so every exit path may call it."""
+
+    __slots__ = ("controller", "model", "admitted_at", "released")
+
+    def __init__(self, controller, model: str):
+        self.controller = controller
+        self.model = model
+        self.admitted_at = time.monotonic()
+        self.released = False
+
+    def release(self, **_):
+        if not self.released:
+            self.released = True
+            self.controller._release(self)
+
+
+class AdmissionController:
+    """
+    Per-worker concurrency ceiling for upstream calls, with a bounded FIFO wait queue.
+
+    A request is admitted while fewer than `max_per_model` requests for its model and fewer
+    than `max_total` requests overall are running (0 disables a ceiling). Otherwise it waits
+    in the queue for at most `queue_timeout` seconds; when the queue already holds
+    `max_queue` requests it is rejected immediately. Waiters whose model is still full do not
+    block waiters for other models behind them.
+    """
+
+    def __init__(self, max_per_model: int = 0, max_total: int = 0, max_queue: int = 64, queue_timeout: float = 10.0):
+        self.max_per_model = max_per_model
+        self.max_total = max_total
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._running = {}      # model -> admitted requests
+        self._total = 0
+        self._waiters = deque()  # (future, model)
+        self._hold_ewma = 0.0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+        self.max_wait = 0.0
+        self.total_wait = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.max_per_model or self.max_total)
+
+    def _fits(self, model: str) -> bool:
+        if self.max_total and self._total >= self.max_total:
+            return False
+        if self.max_per_model and self._running.get(model, 0) >= self.max_per_model:
+            return False
+        return True
+
+    def _grant(self, model: str) -> Ticket:
+        self._total += 1
+        self._running[model] = self._running.get(model, 0) + 1
+        self.admitted += 1
+        return Ticket(self, model)
+
+    def retry_after(self) -> int:
+        """Rough seconds until a slot frees up, for the Retry-After header."""
+        capacity = self.max_total or self.max_per_model or 1
+        backlog = len(self._waiters) / capacity + 1
+        return max(1, math.ceil(self._hold_ewma * backlog))
+
+    async def admit(self, model: str) -> Ticket:
+        # Queued requests never fit (they are woken as soon as they do), so this cannot jump the queue.
+        if self._fits(model):
+            return self._grant(model)
+        if len(self._waiters) >= self.max_queue:
+            self.rejected_full += 1
+            raise AdmissionRejected("Too many queued requests", self.retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = (future, model)
+        self._waiters.append(waiter)
+        self.queued += 1
+        started = time.monotonic()
+        try:
+            ticket = await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            # The slot may have been granted in the same loop iteration the timeout fired.
+            if future.done() and not future.cancelled():
+                ticket = future.result()
+            else:
+                self._remove(waiter)
+                self.rejected_timeout += 1
+                self._observe_wait(time.monotonic() - started, "timeout")
+                raise AdmissionRejected("Timed out waiting for capacity", self.retry_after())
+        except BaseException:
+            # Cancelled while queued (e.g. the client went away); give back a slot granted meanwhile.
+            self._remove(waiter)
+            if future.done() and not future.cancelled():
+                future.result().release()
+            else:
+                future.cancel()
+            raise
+        self._observe_wait(time.monotonic() - started, "admitted")
+        return ticket
+
+    def _remove(self, waiter):
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            pass
+
+    def _observe_wait(self, waited: float, outcome: str):
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        metrics.observe("baojimi_admission_wait_seconds", waited, outcome=outcome)
+
+    def _release(self, ticket: Ticket):
+        self._total -= 1
+        remaining = self._running.get(ticket.model, 1) - 1
+        if remaining:
+            self._running[ticket.model] = remaining
+        else:
+            self._running.pop(ticket.model, None)
+        held = time.monotonic() - ticket.admitted_at
+        self._hold_ewma = held if not self._hold_ewma else self._hold_ewma + HOLD_EWMA_ALPHA * (held - self._hold_ewma)
+        self._wake()
+
+    def _wake(self):
+        """Hands free slots to queued requests in FIFO order, skipping models that are still full."""
+        for waiter in list(self._waiters):
+            if self.max_total and self._total >= self.max_total:
+                break
+            future, model = waiter
+            if future.done():
+                self._remove(waiter)
+                continue
+            if self._fits(model):
+                self._remove(waiter)
+                future.set_result(self._grant(model))
+
+    def stats(self) -> dict:
+        finished_waits = self.queued - len(self._waiters)
+        return {
+            "running": self._total,
+            "running_by_model": dict(self._running),
+            "queue_depth": len(self._waiters),
+            "max_per_model": self.max_per_model,
+            "max_total": self.max_total,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected_full": self.rejected_full,
+            "rejected_timeout": self.rejected_timeout,
+            "avg_wait_ms": round(self.total_wait / finished_waits * 1000, 1) if finished_waits else 0.0,
+            "max_wait_ms": round(self.max_wait * 1000, 1),
+            "avg_hold_ms": round(self._hold_ewma * 1000, 1),
+        }
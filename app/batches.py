@@ -0,0 +1,465 @@
+import os
+import re
+import json
+import time
+import uuid
+import fcntl
+import random
+import shutil
+import asyncio
+import logging
+from collections import deque
+
+from pydantic import ValidationError
+
+from .models import ChatCompletionRequest
+
+logger = logging.getLogger("app")
+
+# --- 批量任务 ---
+# 每个批量任务是 BATCH_DIR 下的一个目录：input.jsonl（提交的请求）、output.jsonl（逐行追加的结果）、
+# batch.json（状态快照）和 batch.lock（正在执行该任务的 worker 持有的文件锁）。
+# output.jsonl 本身就是检查点：重启后跳过已有结果的 custom_id，从剩下的请求继续执行。
+
+CHECKPOINT_INTERVAL = 1.0   # 结果落盘（fsync）并更新 batch.json 的间隔（秒）
+RESCAN_INTERVAL = 30.0      # 扫描无人执行的未完成任务的间隔（秒），用于接管崩溃 worker 留下的任务
+RETRY_BASE_DELAY = 2.0      # 单个请求失败后的首次重试等待（秒），之后指数增长
+RETRY_MAX_DELAY = 60.0
+NO_KEY_MAX_DELAY = 30.0     # 所有 Key 都满载或在冷却时，重新尝试获取 Key 的最长间隔（秒）
+
+ENDPOINT = "/v1/chat/completions"
+_ACTIVE = ("in_progress", "cancelling")
+_BATCH_ID = re.compile(r"batch_[0-9a-f]{32}")
+
+
+class InvalidBatch(ValueError):
+    """The submitted JSONL cannot be run; the message names the offending line."""
+
+
+class BatchRequestError(Exception):
+    """A batch line that cannot succeed as written (bad request, blocked prompt); it is not retried."""
+
+    def __init__(self, code: str, message: str):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+def _parse_line(raw: bytes, line_no: int):
+    """(custom_id, chat request body) of one input line in OpenAI batch format."""
+    try:
+        item = json.loads(raw)
+    except ValueError as e:
+        raise InvalidBatch(f"Line {line_no}: invalid JSON ({e})")
+    if not isinstance(item, dict):
+        raise InvalidBatch(f"Line {line_no}: expected a JSON object")
+    if item.get("url", ENDPOINT) != ENDPOINT:
+        raise InvalidBatch(f"Line {line_no}: only {ENDPOINT} is supported")
+    # Bare chat requests are accepted too; custom_id then defaults to the line number.
+    body = item["body"] if "body" in item else item
+    if not isinstance(body, dict):
+        raise InvalidBatch(f"Line {line_no}: body must be a JSON object")
+    return str(item.get("custom_id") or f"request-{line_no}"), body
+
+
+def _read_json(path: str) -> dict:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_json(path: str, data: dict):
+    # Write-then-rename, so readers in other workers never see a half-written record.
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+class _BatchRun:
+    """A batch executing in this worker: its status record, open files and requests still to run."""
+
+    def __init__(self, directory: str, batch_id: str, lock):
+        self.id = batch_id
+        self.directory = directory
+        self.lock = lock
+        self.record = None
+        self.pending = deque()  # (custom_id, byte offset of the line in input.jsonl)
+        self.input = None
+        self.output = None
+        self.task = None
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    @property
+    def cancelling(self) -> bool:
+        return self.record["status"] == "cancelling"
+
+    def load(self):
+        """Reads the status record and queues every request that has no result in output.jsonl yet."""
+        self.record = _read_json(self.path("batch.json"))
+        done, completed, failed = set(), 0, 0
+        output_path = self.path("output.jsonl")
+        if os.path.exists(output_path):
+            with open(output_path, "rb+") as f:
+                end = 0
+                for raw in f:
+                    if not raw.endswith(b"\n"):
+                        break
+                    result = json.loads(raw)
+                    done.add(result["custom_id"])
+                    if result["error"] is None:
+                        completed += 1
+                    else:
+                        failed += 1
+                    end += len(raw)
+                # A crash can leave half a line at the end; drop it and run that request again.
+                f.truncate(end)
+        self.record["request_counts"].update(completed=completed, failed=failed)
+
+        self.input = open(self.path("input.jsonl"), "rb")
+        offset = 0
+        for line_no, raw in enumerate(self.input, 1):
+            if raw.strip():
+                custom_id, _ = _parse_line(raw, line_no)
+                if custom_id not in done:
+                    self.pending.append((custom_id, offset))
+            offset += len(raw)
+        if self.record["status"] == "in_progress" and os.path.exists(self.path("cancel")):
+            self.record["status"] = "cancelling"
+        self.output = open(output_path, "a", encoding="utf-8")
+
+    def read_body(self, offset: int) -> dict:
+        self.input.seek(offset)
+        return _parse_line(self.input.readline(), 0)[1]
+
+    def write_result(self, custom_id: str, response: dict = None, error: dict = None):
+        result = {
+            "id": f"batch_req_{uuid.uuid4().hex}",
+            "custom_id": custom_id,
+            "response": {"status_code": 200, "request_id": response["id"], "body": response} if response else None,
+            "error": error,
+        }
+        self.output.write(json.dumps(result, ensure_ascii=False) + "\n")
+        self.record["request_counts"]["failed" if error else "completed"] += 1
+
+    def cancel(self):
+        if self.record["status"] == "in_progress":
+            self.record["status"] = "cancelling"
+
+    def finish(self):
+        now = int(time.time())
+        if self.cancelling:
+            self.record.update(status="cancelled", cancelled_at=now)
+        else:
+            self.record.update(status="completed", completed_at=now)
+
+    def fail(self, message: str):
+        self.record.update(status="failed", failed_at=int(time.time()), errors={"message": message})
+
+    def snapshot(self) -> dict:
+        return {**self.record, "request_counts": dict(self.record["request_counts"])}
+
+    async def checkpoint(self):
+        self.output.flush()
+        await asyncio.to_thread(self._persist, self.snapshot())
+
+    def save(self):
+        """Synchronous checkpoint, for shutdown and error paths."""
+        if self.record is None:
+            return
+        if self.output is not None:
+            self.output.flush()
+        self._persist(self.snapshot())
+
+    def _persist(self, record: dict):
+        if self.output is not None:
+            os.fsync(self.output.fileno())
+        _write_json(self.path("batch.json"), record)
+
+    def close(self):
+        for f in (self.input, self.output, self.lock):
+            if f is not None:
+                f.close()
+
+
+class BatchManager:
+    """
+    Runs OpenAI-style chat completion batches from JSONL files, checkpointed to disk.
+
+    Requests are spread over all keys through the key scheduler, with at most
+    `concurrency_per_key` batch calls on a key at a time (across all batches in this worker)
+    and cooling keys skipped. When the scheduler caps calls per key, batches keep one slot of
+    every key free for interactive requests. Failed calls are retried with exponential backoff up to
+    `max_attempts` times. Results are appended to the batch's output.jsonl as they finish, and
+    a batch interrupted by a restart resumes from the requests without a result. A file lock
+    makes sure only one worker runs a batch; other workers serve its status from batch.json.
+    """
+
+    def __init__(self, directory: str, key_scheduler, call, concurrency_per_key: int = 2,
+                 max_attempts: int = 5, max_requests: int = 50000):
+        self.directory = directory
+        self.key_scheduler = key_scheduler
+        self.call = call  # async (api_key, body) -> OpenAI chat.completion dict
+        self.concurrency_per_key = max(1, concurrency_per_key)
+        if key_scheduler.max_in_flight > 1:
+            # Interactive requests are not queued for a key, so a batch holding all its slots would 429 them.
+            self.concurrency_per_key = min(self.concurrency_per_key, key_scheduler.max_in_flight - 1)
+        self.max_attempts = max(1, max_attempts)
+        self.max_requests = max_requests
+        self._running = {}   # batch id -> _BatchRun
+        self._key_load = {}  # api key -> batch calls in flight on it
+        self._key_freed = asyncio.Event()
+        self._supervisor = None
+        self.calls = 0
+        self.retries = 0
+
+    def _batch_dir(self, batch_id: str) -> str:
+        return os.path.join(self.directory, batch_id)
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if self._supervisor is None:
+            self._supervisor = asyncio.ensure_future(self._supervise())
+
+    async def stop(self):
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+            self._supervisor = None
+        tasks = [run.task for run in self._running.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _supervise(self):
+        while True:
+            try:
+                self.resume()
+            except Exception as e:
+                logger.warning(f"Failed to scan for unfinished batches: {e}")
+            await asyncio.sleep(RESCAN_INTERVAL)
+
+    def resume(self):
+        """Picks up unfinished batches that no worker is running, e.g. after a restart or a crash."""
+        for batch_id in os.listdir(self.directory):
+            if batch_id in self._running or not _BATCH_ID.fullmatch(batch_id):
+                continue
+            try:
+                record = _read_json(os.path.join(self._batch_dir(batch_id), "batch.json"))
+            except (OSError, ValueError):
+                continue
+            if record.get("status") in _ACTIVE:
+                self._claim(batch_id)
+
+    def _claim(self, batch_id: str) -> bool:
+        """Starts running batch_id here unless this or another worker already runs it."""
+        lock = open(os.path.join(self._batch_dir(batch_id), "batch.lock"), "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            return False
+        run = _BatchRun(self._batch_dir(batch_id), batch_id, lock)
+        self._running[batch_id] = run
+        run.task = asyncio.ensure_future(self._run(run))
+        return True
+
+    async def create(self, chunks) -> dict:
+        """Stores the JSONL body streamed in `chunks`, validates every line and starts the batch."""
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        batch_dir = self._batch_dir(batch_id)
+        os.makedirs(batch_dir)
+        try:
+            with open(os.path.join(batch_dir, "input.jsonl"), "wb") as f:
+                async for chunk in chunks:
+                    f.write(chunk)
+            total = await asyncio.to_thread(self._validate, os.path.join(batch_dir, "input.jsonl"))
+        except BaseException:
+            shutil.rmtree(batch_dir, ignore_errors=True)
+            raise
+        now = int(time.time())
+        record = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": ENDPOINT,
+            "status": "in_progress",
+            "created_at": now,
+            "in_progress_at": now,
+            "completed_at": None,
+            "cancelled_at": None,
+            "failed_at": None,
+            "errors": None,
+            "request_counts": {"total": total, "completed": 0, "failed": 0},
+        }
+        _write_json(os.path.join(batch_dir, "batch.json"), record)
+        self._claim(batch_id)
+        return record
+
+    def _validate(self, path: str) -> int:
+        seen = set()
+        with open(path, "rb") as f:
+            for line_no, raw in enumerate(f, 1):
+                if not raw.strip():
+                    continue
+                custom_id, body = _parse_line(raw, line_no)
+                if custom_id in seen:
+                    raise InvalidBatch(f"Line {line_no}: duplicate custom_id {custom_id!r}")
+                seen.add(custom_id)
+                if len(seen) > self.max_requests:
+                    raise InvalidBatch(f"A batch may contain at most {self.max_requests} requests")
+                try:
+                    ChatCompletionRequest(**body)
+                except ValidationError as e:
+                    problems = "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors())
+                    raise InvalidBatch(f"Line {line_no}: {problems}")
+        if not seen:
+            raise InvalidBatch("The batch contains no requests")
+        return len(seen)
+
+    def get(self, batch_id: str):
+        if not _BATCH_ID.fullmatch(batch_id):
+            return None
+        run = self._running.get(batch_id)
+        if run is not None and run.record is not None:
+            return run.snapshot()
+        try:
+            return _read_json(os.path.join(self._batch_dir(batch_id), "batch.json"))
+        except FileNotFoundError:
+            return None
+
+    def list(self, limit: int = 20) -> list:
+        records = []
+        if os.path.isdir(self.directory):
+            for batch_id in os.listdir(self.directory):
+                record = self.get(batch_id) if _BATCH_ID.fullmatch(batch_id) else None
+                if record is not None:
+                    records.append(record)
+        records.sort(key=lambda record: record["created_at"], reverse=True)
+        return records[:limit]
+
+    def output_path(self, batch_id: str):
+        """Path of the results written so far, or None for an unknown batch."""
+        if self.get(batch_id) is None:
+            return None
+        path = os.path.join(self._batch_dir(batch_id), "output.jsonl")
+        if not os.path.exists(path):
+            open(path, "a").close()
+        return path
+
+    def cancel(self, batch_id: str):
+        """Stops starting new requests; calls already running finish and keep their results."""
+        record = self.get(batch_id)
+        if record is None or record["status"] not in _ACTIVE:
+            return record
+        run = self._running.get(batch_id)
+        if run is not None and run.record is not None:
+            run.cancel()
+            return run.snapshot()
+        # Running in another worker (or about to be resumed): leave a marker for whoever runs it.
+        open(os.path.join(self._batch_dir(batch_id), "cancel"), "w").close()
+        return {**record, "status": "cancelling"}
+
+    async def _run(self, run: _BatchRun):
+        try:
+            await asyncio.to_thread(run.load)
+            if run.record["status"] not in _ACTIVE:
+                return  # Finished by another worker between the scan and taking the lock.
+            counts = run.record["request_counts"]
+            logger.info(f"Running batch {run.id}: {len(run.pending)} of {counts['total']} requests left")
+            if run.pending and not run.cancelling:
+                checkpoints = asyncio.ensure_future(self._checkpoint_loop(run))
+                workers = [
+                    asyncio.ensure_future(self._worker(run))
+                    for _ in range(min(len(run.pending), self.concurrency_per_key * max(1, len(self.key_scheduler))))
+                ]
+                try:
+                    await asyncio.gather(*workers)
+                finally:
+                    checkpoints.cancel()
+                    for worker in workers:
+                        worker.cancel()
+            run.finish()
+            await run.checkpoint()
+            logger.info(f"Batch {run.id} {run.record['status']}: {counts['completed']} completed, {counts['failed']} failed")
+        except asyncio.CancelledError:
+            # Shutting down: keep the progress so far; the batch resumes on the next start.
+            run.save()
+            raise
+        except Exception as e:
+            logger.error(f"Batch {run.id} failed: {e}")
+            if run.record is not None:
+                run.fail(str(e))
+            run.save()
+        finally:
+            run.close()
+            self._running.pop(run.id, None)
+
+    async def _checkpoint_loop(self, run: _BatchRun):
+        while True:
+            await asyncio.sleep(CHECKPOINT_INTERVAL)
+            if os.path.exists(run.path("cancel")):
+                run.cancel()
+            await run.checkpoint()
+
+    async def _worker(self, run: _BatchRun):
+        while run.pending and not run.cancelling:
+            custom_id, offset = run.pending.popleft()
+            await self._execute(run, custom_id, run.read_body(offset))
+
+    async def _execute(self, run: _BatchRun, custom_id: str, body: dict):
+        attempt, wait = 0, 0.0
+        while not run.cancelling:
+            # Keys at the batch concurrency limit are skipped, and cooling keys are waited out.
+            busy = {key for key, load in self._key_load.items() if load >= self.concurrency_per_key}
+            api_key = self.key_scheduler.acquire(exclude=busy, include_cooling=False)
+            if api_key is None:
+                wait = min(NO_KEY_MAX_DELAY, max(0.5, wait * 2))
+                try:
+                    await asyncio.wait_for(self._key_freed.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            wait = 0.0
+            attempt += 1
+            self.calls += 1
+            self._key_load[api_key] = self._key_load.get(api_key, 0) + 1
+            started = time.monotonic()
+            try:
+                response, error = await self.call(api_key, body), None
+            except asyncio.CancelledError:
+                self.key_scheduler.abandon(api_key)
+                raise
+            except Exception as e:
+                response, error = None, e
+            finally:
+                self._key_load[api_key] -= 1
+                # Wake workers waiting for a key; the next waiters get a fresh event.
+                self._key_freed.set()
+                self._key_freed = asyncio.Event()
+
+            if error is None or isinstance(error, BatchRequestError):
+                # A request rejected for its content still says nothing bad about the key.
+                self.key_scheduler.release(api_key, latency=time.monotonic() - started)
+                if error is None:
+                    run.write_result(custom_id, response=response)
+                else:
+                    run.write_result(custom_id, error={"code": error.code, "message": error.message})
+                return
+            self.key_scheduler.release(api_key, error=error)
+            from google.api_core import exceptions as google_exceptions
+            # Upstream errors that another attempt cannot fix.
+            permanent = isinstance(error, (google_exceptions.InvalidArgument, google_exceptions.FailedPrecondition))
+            if attempt >= self.max_attempts or permanent:
+                run.write_result(custom_id, error={"code": "upstream_error", "message": str(error)})
+                return
+            self.retries += 1
+            delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1))
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+
+    def stats(self) -> dict:
+        return {
+            "running": list(self._running),
+            "in_flight": sum(self._key_load.values()),
+            "calls": self.calls,
+            "retries": self.retries,
+        }
@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import deque
+
+from .shared_state import SHARED_STATE_BACKEND, SQLiteDatabase
+
+logger = logging.getLogger("app")
+
+# --- 持久化调用日志 ---
+# 调用日志只追加写入 SQLite（WAL 模式），所有 worker 共用同一个文件。
+# 请求路径上只把日志放进内存队列，由后台任务批量写入；按行数、体积和时间清理旧日志。
+
+CALL_LOG_PATH = os.environ.get("CALL_LOG_PATH", "/tmp/baojimi-lite-calls.db")
+CALL_LOG_MAX_ROWS = int(os.environ.get("CALL_LOG_MAX_ROWS", 100000))
+CALL_LOG_MAX_MB = float(os.environ.get("CALL_LOG_MAX_MB", 64))
+CALL_LOG_MAX_AGE_DAYS = float(os.environ.get("CALL_LOG_MAX_AGE_DAYS", 7))
+
+FLUSH_INTERVAL = 0.5       # 后台写入间隔（秒）
+FLUSH_BATCH = 500          # 队列积累到这么多条时立即写入
+MAX_PENDING = 10000        # 写入跟不上时内存中最多保留的条数，超出的最旧日志被丢弃
+RETENTION_INTERVAL = 60.0  # 清理旧日志的间隔（秒）
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS calls (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    model TEXT,
+    key TEXT,
+    status TEXT,
+    payload TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS calls_ts ON calls (ts);
+CREATE INDEX IF NOT EXISTS calls_model ON calls (model, seq);
+CREATE INDEX IF NOT EXISTS calls_key ON calls (key, seq);
+CREATE INDEX IF NOT EXISTS calls_status ON calls (status, seq);
+"""
+
+
+def _key_suffix(key_used) -> str:
+    # "...abcd" -> "abcd"; markers such as "cache" / "shared" are stored as-is.
+    return key_used.lstrip(".") if key_used else None
+
+
+def _timestamp(entry: dict) -> float:
+    try:
+        return time.mktime(time.strptime(entry["timestamp"], "%Y-%m-%d %H:%M:%S"))
+    except (KeyError, TypeError, ValueError):
+        return time.time()
+
+
+class CallLog:
+    """
+    Durable call log with batched background writes and indexed queries.
+
+    append() only queues the entry; a background task started with start() writes queued
+    entries in one transaction every FLUSH_INTERVAL seconds. Rows beyond the configured count,
+    size or age are deleted periodically.
+    """
+
+    def __init__(self, path: str, max_rows: int, max_bytes: int, max_age: float):
+        self.path = path
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._db = SQLiteDatabase(path, _SCHEMA)
+        self._pending = deque()
+        self._wakeup = None
+        self._task = None
+        self._last_retention = 0.0
+        self.written = 0
+        self.dropped = 0
+
+    def initialize(self):
+        """Creates the log database before gunicorn forks; see SQLiteDatabase.initialize()."""
+        self._db.initialize()
+
+    def append(self, entry: dict):
+        """Queues an entry for the background writer; never blocks on disk."""
+        if len(self._pending) >= MAX_PENDING:
+            self._pending.popleft()
+            self.dropped += 1
+        self._pending.append(entry)
+        if self._wakeup is not None and len(self._pending) >= FLUSH_BATCH:
+            self._wakeup.set()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+                if time.monotonic() - self._last_retention >= RETENTION_INTERVAL:
+                    self._last_retention = time.monotonic()
+                    await asyncio.to_thread(self.enforce_retention)
+            except Exception as e:
+                logger.warning(f"Failed to write call logs: {e}")
+
+    async def flush(self):
+        """Writes every queued entry now."""
+        if not self._pending:
+            return
+        batch = []
+        while self._pending:
+            batch.append(self._pending.popleft())
+        try:
+            await asyncio.to_thread(self._write, batch)
+        except Exception:
+            # Put the batch back so it is retried with the next flush.
+            self._pending.extendleft(reversed(batch))
+            raise
+
+    def _write(self, batch: list):
+        rows = [
+            (_timestamp(entry), entry.get("model"), _key_suffix(entry.get("key_used")), entry.get("status"),
+             json.dumps(entry, ensure_ascii=False))
+            for entry in batch
+        ]
+        with self._db.lock:
+            conn = self._db.connection()
+            conn.execute("BEGIN")
+            try:
+                conn.executemany("INSERT INTO calls (ts, model, key, status, payload) VALUES (?, ?, ?, ?, ?)", rows)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        self.written += len(rows)
+
+    def enforce_retention(self):
+        with self._db.lock:
+            conn = self._db.connection()
+            if self.max_age:
+                conn.execute("DELETE FROM calls WHERE ts < ?", (time.time() - self.max_age,))
+            if self.max_rows:
+                conn.execute("DELETE FROM calls WHERE seq <= (SELECT MAX(seq) FROM calls) - ?", (self.max_rows,))
+            if self.max_bytes:
+                page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+                used_pages = conn.execute("PRAGMA page_count").fetchone()[0] - conn.execute("PRAGMA freelist_count").fetchone()[0]
+                if used_pages * page_size > self.max_bytes:
+                    # Drop the oldest tenth; freed pages are reused, so the file stops growing.
+                    conn.execute(
+                        "DELETE FROM calls WHERE seq <= (SELECT MIN(seq) + (MAX(seq) - MIN(seq)) / 10 FROM calls)"
+                    )
+
+    def query(self, limit: int = 20, before: int = None, model: str = None, key: str = None,
+              status: str = None, since: float = None, until: float = None) -> dict:
+        """Newest-first page of entries matching the filters, plus the cursor for the next page."""
+        clauses, params = [], []
+        if before is not None:
+            clauses.append("seq < ?")
+            params.append(before)
+        if model:
+            clauses.append("model = ?")
+            params.append(model)
+        if key:
+            clauses.append("key = ?")
+            params.append(_key_suffix(key))
+        if status:
+            clauses.append("status = ?")
+            params.append(status)
+        if since is not None:
+            clauses.append("ts >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("ts < ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._db.lock:
+            rows = self._db.connection().execute(
+                f"SELECT seq, payload FROM calls {where} ORDER BY seq DESC LIMIT ?", (*params, limit + 1)
+            ).fetchall()
+        logs = [{**json.loads(payload), "seq": seq} for seq, payload in rows[:limit]]
+        next_before = rows[limit - 1][0] if len(rows) > limit else None
+        return {"logs": logs, "next_before": next_before}
+
+    def stats(self) -> dict:
+        return {"pending": len(self._pending), "written": self.written, "dropped": self.dropped}
+
+
+def create_call_log() -> CallLog:
+    # With the in-memory shared state (single worker) the log stays in this process too.
+    path = ":memory:" if SHARED_STATE_BACKEND == "memory" else CALL_LOG_PATH
+    return CallLog(path, CALL_LOG_MAX_ROWS, int(CALL_LOG_MAX_MB * 1024 * 1024), CALL_LOG_MAX_AGE_DAYS * 86400)
+
+
+call_log = create_call_log()
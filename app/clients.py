@@ -0,0 +1,169 @@
+import os
+import datetime
+import functools
+import threading
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import google.ai.generativelanguage as glm
+    import google.generativeai as genai
+
+# --- 按 Key 划分的上游客户端池 ---
+# genai.configure() 会修改进程级别的全局配置，并发请求之间会互相覆盖 Key。
+# 这里为每个 Key 懒加载一组长期复用的客户端，请求始终绑定在自己的 Key 上。
+# Gemini SDK（google.generativeai、gRPC 和 protobuf 定义）导入需要约 1 秒，因此只在第一次创建客户端时导入；
+# load_sdk() 可以提前在后台线程或 gunicorn master 进程中加载。
+
+# 可选：把上游指向其他地址（例如 bench/fake_gemini.py 提供的本地假服务）。
+# GEMINI_API_INSECURE=true 时使用本地明文 gRPC 连接，仅适用于 127.0.0.1 等本机地址。
+GEMINI_API_ENDPOINT = os.environ.get("GEMINI_API_ENDPOINT")
+GEMINI_API_INSECURE = os.environ.get("GEMINI_API_INSECURE", "false").lower() == "true"
+
+
+def load_sdk():
+    """Imports the Gemini SDK now instead of on the first upstream call."""
+    import google.generativeai.caching  # noqa: F401  (imports google.generativeai and its gRPC clients)
+    import google.api_core.exceptions  # noqa: F401
+
+
+@functools.lru_cache(maxsize=None)
+def _client_info():
+    from google.api_core import gapic_v1
+    from google.generativeai.client import USER_AGENT, __version__ as SDK_VERSION
+    return gapic_v1.client_info.ClientInfo(user_agent=f"{USER_AGENT}/{SDK_VERSION}")
+
+
+def _local_transport(client_cls, transport_name):
+    """Transport factory that keeps per-call API key credentials over a plaintext local connection."""
+    import grpc
+    transport_cls = client_cls.get_transport_class(transport_name)
+
+    def build(**kwargs):
+        kwargs["ssl_channel_credentials"] = grpc.local_channel_credentials(grpc.LocalConnectionType.LOCAL_TCP)
+        return transport_cls(**kwargs)
+    return build
+
+
+def _build_client(client_cls, sync_cls, transport_name, api_key):
+    client_options = {"api_key": api_key}
+    kwargs = {"client_info": _client_info()}
+    if GEMINI_API_ENDPOINT:
+        client_options["api_endpoint"] = GEMINI_API_ENDPOINT
+        if GEMINI_API_INSECURE:
+            kwargs["transport"] = _local_transport(sync_cls, transport_name)
+    return client_cls(client_options=client_options, **kwargs)
+
+
+class KeyClient:
+    """Long-lived upstream clients bound to a single API key."""
+
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+        self._lock = threading.Lock()
+        self._generative_async = None
+        self._model = None
+        self._model_async = None
+        self._cache_async = None
+
+    @property
+    def suffix(self) -> str:
+        return f"...{self.api_key[-4:]}"
+
+    @property
+    def generative_async(self) -> "glm.GenerativeServiceAsyncClient":
+        if self._generative_async is None:
+            import google.ai.generativelanguage as glm
+            with self._lock:
+                if self._generative_async is None:
+                    self._generative_async = _build_client(
+                        glm.GenerativeServiceAsyncClient, glm.GenerativeServiceClient, "grpc_asyncio", self.api_key
+                    )
+        return self._generative_async
+
+    @property
+    def model_client(self) -> "glm.ModelServiceClient":
+        if self._model is None:
+            import google.ai.generativelanguage as glm
+            with self._lock:
+                if self._model is None:
+                    self._model = _build_client(
+                        glm.ModelServiceClient, glm.ModelServiceClient, "grpc", self.api_key
+                    )
+        return self._model
+
+    @property
+    def model_async(self) -> "glm.ModelServiceAsyncClient":
+        if self._model_async is None:
+            import google.ai.generativelanguage as glm
+            with self._lock:
+                if self._model_async is None:
+                    self._model_async = _build_client(
+                        glm.ModelServiceAsyncClient, glm.ModelServiceClient, "grpc_asyncio", self.api_key
+                    )
+        return self._model_async
+
+    @property
+    def cache_async(self) -> "glm.CacheServiceAsyncClient":
+        if self._cache_async is None:
+            import google.ai.generativelanguage as glm
+            with self._lock:
+                if self._cache_async is None:
+                    self._cache_async = _build_client(
+                        glm.CacheServiceAsyncClient, glm.CacheServiceClient, "grpc_asyncio", self.api_key
+                    )
+        return self._cache_async
+
+    def generative_model(self, model_name, safety_settings=None, system_instruction=None, cached_content=None) -> "genai.GenerativeModel":
+        """
+        Builds a GenerativeModel that talks through this key's pooled client.
+        With `cached_content` (a cache name created with this key) the system instruction lives in the cache.
+        """
+        import google.generativeai as genai
+        model = genai.GenerativeModel(
+            model_name=model_name,
+            safety_settings=safety_settings,
+            system_instruction=None if cached_content else system_instruction
+        )
+        # GenerativeModel only falls back to the global default client when this is unset.
+        model._async_client = self.generative_async
+        if cached_content:
+            # Same attribute GenerativeModel.from_cached_content sets, without its extra lookup call.
+            model._cached_content = cached_content
+        return model
+
+    async def create_cached_content(self, model_name, system_instruction, contents, ttl: float):
+        """Uploads a prompt prefix as cached content; returns the upstream CachedContent."""
+        from google.generativeai.caching import CachedContent
+        request = CachedContent._prepare_create_request(
+            model=model_name, system_instruction=system_instruction, contents=contents, ttl=datetime.timedelta(seconds=ttl)
+        )
+        return await self.cache_async.create_cached_content(request)
+
+    async def extend_cached_content(self, name: str, ttl: float):
+        """Pushes the expiry of an existing cache `ttl` seconds into the future."""
+        import google.ai.generativelanguage as glm
+        from google.protobuf import field_mask_pb2
+        cached = glm.CachedContent(name=name, ttl={"seconds": int(ttl)})
+        return await self.cache_async.update_cached_content(
+            cached_content=cached, update_mask=field_mask_pb2.FieldMask(paths=["ttl"])
+        )
+
+    def list_models(self):
+        import google.generativeai as genai
+        return genai.list_models(client=self.model_client)
+
+
+_pool = {}
+_pool_lock = threading.Lock()
+
+
+def get_client(api_key: str) -> KeyClient:
+    """Returns the pooled client for api_key, creating it on first use."""
+    client = _pool.get(api_key)
+    if client is None:
+        with _pool_lock:
+            client = _pool.get(api_key)
+            if client is None:
+                client = KeyClient(api_key)
+                _pool[api_key] = client
+    return client
@@ -0,0 +1,208 @@
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+
+from .clients import get_client
+
+logger = logging.getLogger("app")
+
+# --- Gemini 上下文缓存 ---
+# 同一段 system prompt / 角色卡在每轮对话中都会完整上传。这里按哈希识别重复出现的稳定前缀
+# （system_instruction 加上开头的若干轮对话），为每个 Key 创建上游 cachedContents，
+# 之后的请求只上传前缀之后的部分。
+
+REFRESH_FRACTION = 0.5    # 命中时若剩余有效期低于 TTL 的这个比例，就在后台续期
+EXPIRY_MARGIN = 30.0      # 距离过期不足这么多秒的缓存不再使用，避免请求到达上游时刚好过期
+FAILURE_BACKOFF = 600.0   # 创建失败的前缀在这段时间内不再重试
+MAX_SEEN_PREFIXES = 4096  # 记住最近出现过的前缀哈希数量，用于判断前缀是否重复
+
+
+def _digest(parent: bytes, item) -> bytes:
+    data = json.dumps(item, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    return hashlib.blake2b(parent + data, digest_size=16).digest()
+
+
+class CacheEntry:
+    __slots__ = ("name", "expires_at", "tokens", "bytes", "hits")
+
+    def __init__(self, name: str, expires_at: float, tokens: int, size: int):
+        self.name = name
+        self.expires_at = expires_at
+        self.tokens = tokens
+        self.bytes = size
+        self.hits = 0
+
+
+class ContextCache:
+    """
+    Reuses upstream cached-content handles for repeated prompt prefixes, per API key.
+
+    Candidate prefixes are the system instruction followed by the first N turns, ending on a
+    model turn so the uncached remainder starts with the user. Each is identified by a hash
+    chain, so the system prompt and history turns are hashed once per request. The first time a
+    prefix of at least `min_tokens` is seen again, a cache is created for the current key in the
+    background; the request itself is never delayed. Later requests on that key send only
+    the turns after the longest live cached prefix. Caches that are still being hit are extended
+    before they expire.
+    """
+
+    def __init__(self, estimator, ttl: float = 600.0, min_tokens: int = 4096):
+        self.estimator = estimator
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+        self._entries = {}            # (api_key, prefix digest) -> CacheEntry
+        self._seen = OrderedDict()    # prefix digest -> None, most recent last
+        self._failed = {}             # (model, prefix digest) -> monotonic time of the failure
+        self._pending = set()         # (api_key, prefix digest) being created or refreshed
+        self._tasks = set()
+        self.lookups = 0
+        self.hits = 0
+        self.created = 0
+        self.create_failures = 0
+        self.refreshes = 0
+        self.invalidated = 0
+        self.tokens_saved = 0
+        self.bytes_saved = 0
+
+    def _prefixes(self, model_name: str, gemini_params: dict) -> list:
+        """(turns, digest) for every cacheable prefix, shortest first."""
+        system_instruction = gemini_params.get("system_instruction")
+        contents = gemini_params.get("contents", [])
+        digest = _digest(model_name.encode("utf-8"), system_instruction)
+        candidates = [(0, digest)] if system_instruction else []
+        for i, content in enumerate(contents[:-1]):
+            digest = _digest(digest, content)
+            if content.get("role") == "model":
+                candidates.append((i + 1, digest))
+        return candidates
+
+    def prepare(self, api_key: str, model_name: str, gemini_params: dict):
+        """
+        Returns (cache_name, contents) for a call on api_key. cache_name is None when no cache
+        applies, in which case contents is the full conversation.
+        """
+        contents = gemini_params.get("contents", [])
+        candidates = self._prefixes(model_name, gemini_params)
+        if not candidates:
+            return None, contents
+        self.lookups += 1
+        now = time.monotonic()
+        try:
+            for turns, digest in reversed(candidates):
+                entry = self._entries.get((api_key, digest))
+                if entry is None:
+                    continue
+                if entry.expires_at - now < EXPIRY_MARGIN:
+                    del self._entries[(api_key, digest)]
+                    continue
+                self.hits += 1
+                entry.hits += 1
+                self.tokens_saved += entry.tokens
+                self.bytes_saved += entry.bytes
+                if entry.expires_at - now < self.ttl * REFRESH_FRACTION:
+                    self._spawn((api_key, digest), self._refresh(api_key, entry))
+                return entry.name, contents[turns:]
+
+            # No live cache on this key: start one for the longest prefix seen in an earlier request.
+            for turns, digest in reversed(candidates):
+                if digest not in self._seen:
+                    continue
+                failed_at = self._failed.get((model_name, digest))
+                if failed_at is not None and now - failed_at < FAILURE_BACKOFF:
+                    break
+                prefix = contents[:turns]
+                tokens = self.estimator.system_tokens(gemini_params.get("system_instruction")) + sum(
+                    self.estimator.message_tokens(message) for message in prefix
+                )
+                if tokens >= self.min_tokens:
+                    self._spawn((api_key, digest), self._create(
+                        api_key, model_name, digest, gemini_params.get("system_instruction"), prefix, tokens
+                    ))
+                break
+            return None, contents
+        finally:
+            for _, digest in candidates:
+                self._seen[digest] = None
+                self._seen.move_to_end(digest)
+            while len(self._seen) > MAX_SEEN_PREFIXES:
+                self._seen.popitem(last=False)
+
+    def invalidate(self, api_key: str, cache_name: str, error: Exception) -> bool:
+        """
+        Forgets a cache when `error` says the upstream no longer has it. Returns True in that case;
+        the call should then be resent with the full prompt.
+        """
+        from google.api_core import exceptions as google_exceptions
+        # Gemini answers 403 or 404 for a cachedContents name that expired or was deleted.
+        if not isinstance(error, (google_exceptions.NotFound, google_exceptions.PermissionDenied)):
+            return False
+        for slot, entry in list(self._entries.items()):
+            if slot[0] == api_key and entry.name == cache_name:
+                del self._entries[slot]
+        self.invalidated += 1
+        logger.info(f"Dropped context cache {cache_name} on key ...{api_key[-4:]}: {error}")
+        return True
+
+    def _spawn(self, slot, coro):
+        if slot in self._pending:
+            coro.close()
+            return
+        self._pending.add(slot)
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+
+        def done(task):
+            self._pending.discard(slot)
+            self._tasks.discard(task)
+        task.add_done_callback(done)
+
+    async def _create(self, api_key, model_name, digest, system_instruction, prefix, tokens):
+        started = time.monotonic()
+        try:
+            cached = await get_client(api_key).create_cached_content(model_name, system_instruction, prefix, self.ttl)
+        except Exception as e:
+            self.create_failures += 1
+            self._failed[(model_name, digest)] = time.monotonic()
+            logger.info(f"Context cache creation failed for {model_name} on key ...{api_key[-4:]}: {e}")
+            return
+        size = len(json.dumps([system_instruction, prefix], ensure_ascii=False).encode("utf-8"))
+        self._purge(time.monotonic())
+        self._entries[(api_key, digest)] = CacheEntry(cached.name, started + self.ttl, tokens, size)
+        self.created += 1
+        logger.info(f"Created context cache {cached.name} (~{tokens} tokens) on key ...{api_key[-4:]}")
+
+    async def _refresh(self, api_key, entry):
+        started = time.monotonic()
+        try:
+            await get_client(api_key).extend_cached_content(entry.name, self.ttl)
+        except Exception as e:
+            logger.info(f"Context cache refresh failed for {entry.name}: {e}")
+            return
+        entry.expires_at = started + self.ttl
+        self.refreshes += 1
+
+    def _purge(self, now: float):
+        for slot, entry in list(self._entries.items()):
+            if entry.expires_at - now < EXPIRY_MARGIN:
+                del self._entries[slot]
+        for slot, failed_at in list(self._failed.items()):
+            if now - failed_at >= FAILURE_BACKOFF:
+                del self._failed[slot]
+
+    def stats(self) -> dict:
+        self._purge(time.monotonic())
+        return {
+            "entries": len(self._entries),
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": round(self.hits / self.lookups, 3) if self.lookups else 0.0,
+            "created": self.created,
+            "create_failures": self.create_failures,
+            "refreshes": self.refreshes,
+            "invalidated": self.invalidated,
+            "tokens_saved": self.tokens_saved,
+            "bytes_saved": self.bytes_saved,
+        }
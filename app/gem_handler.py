@@ -1,76 +1,203 @@
-import google.generativeai as genai
+import json
+import time
+import logging
 
-MAX_RETRIES = 2
+from .clients import get_client
+from .streaming import StreamChunk, sdk_chunks
 
-import logging
+MAX_RETRIES = 2
+# 续写时在已发送文本末尾与新输出开头之间查找重叠的范围（字符）
+SEAM_SEARCH_CHARS = 256
+# 至少重叠这么多字符才认为是重复输出，避免误删正常的短文本
+MIN_SEAM_OVERLAP = 8
+CONTINUE_PROMPT = (
+    "Continue exactly from where your previous reply was cut off. "
+    "Do not repeat any text that was already written."
+)
 
 logger = logging.getLogger("app")
 
-async def self_healing_stream_generator(model_name, gemini_params, api_key):
+# Process-wide counters surfaced in /api/status.
+stats = {
+    "streams": 0,
+    "resumes": 0,
+    "failed_streams": 0,
+    "bytes_resent": 0,
+    "seam_chars_trimmed": 0,
+    "client_disconnects": 0,
+}
+
+
+class StreamInterrupted(Exception):
+    """The upstream stream ended before Gemini reported a finish reason."""
+
+
+def seam_overlap(delivered: str, incoming: str) -> int:
     """
-    A generator that attempts to stream a response from the Gemini API, with self-healing capabilities.
-    If the stream is interrupted, it retries the request with the conversation history.
+    Length of the longest prefix of `incoming` that repeats the end of `delivered`.
+    Models asked to continue often restart the last sentence; that part must not be sent twice.
     """
-    chat_history = []
-    retries = 0
-    full_response_text = ""
+    tail = delivered[-SEAM_SEARCH_CHARS:]
+    for size in range(min(len(tail), len(incoming)), MIN_SEAM_OVERLAP - 1, -1):
+        if tail.endswith(incoming[:size]):
+            return size
+    return 0
+
+
+def _resume_contents(initial_contents, delivered_text):
+    """The original conversation plus a single model turn holding everything delivered so far."""
+    if not delivered_text:
+        return initial_contents
+    return initial_contents + [
+        {"role": "model", "parts": [{"text": delivered_text}]},
+        {"role": "user", "parts": [{"text": CONTINUE_PROMPT}]},
+    ]
+
+
+async def _sdk_stream(api_key, model_name, contents, generation_config=None, system_instruction=None, safety_settings=None):
+    model = get_client(api_key).generative_model(
+        model_name,
+        safety_settings=safety_settings,
+        system_instruction=system_instruction
+    )
+    response = await model.generate_content_async(contents, generation_config=generation_config, stream=True)
+    return sdk_chunks(response)
+
+
+async def self_healing_stream_generator(model_name, gemini_params, api_key, scheduler=None, safety_settings=None, is_disconnected=None,
+                                        open_stream=None):
+    """
+    Streams a Gemini response as StreamChunks and resumes it if the upstream stream breaks.
 
-    # Initial contents from the user
+    Tracks exactly which text has already been delivered to the client. On failure it retries on
+    a different healthy key from `scheduler`, asking the model to continue after that text, and
+    trims any overlap between the delivered text and the resumed output so the client never sees
+    it twice. Every attempt's key, timing and request size is logged.
+
+    `api_key` must already be acquired from `scheduler`; this generator takes over releasing it.
+    When `is_disconnected` is given, no resume is attempted once the client has gone away.
+    `open_stream` starts one attempt and returns its StreamChunks (e.g. rest_stream.stream_generate_content);
+    it defaults to the SDK.
+    """
+    open_stream = open_stream or _sdk_stream
     initial_contents = gemini_params.get("contents", [])
+    generation_config = gemini_params.get("generation_config")
+    system_instruction = gemini_params.get("system_instruction")
+
+    delivered_text = ""
+    # Output tokens of finished attempts; the current attempt reports its own running count.
+    spent_tokens = 0
+    attempts = []
+    tried_keys = {api_key}
+    held_key = api_key
+    retries = 0
+    stats["streams"] += 1
 
     logger.info(f"Initiating self-healing stream for model: {model_name}")
-    while retries <= MAX_RETRIES:
-        try:
-            # Configure the API key for each attempt
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel(model_name)
-
-            # Combine history with the initial request for retries
-            current_contents = initial_contents + chat_history
-            
-            # Create a new set of params for the attempt
-            attempt_params = gemini_params.copy()
-            attempt_params["contents"] = current_contents
-
-            # Generate content and stream the response
-            response = await model.generate_content_async(
-                attempt_params["contents"],
-                generation_config=attempt_params.get("generation_config"),
-                stream=True
-            )
-
-            # Stream and collect history
-            chunk_count = 0
-            async for chunk in response:
-                yield chunk
-                # Ensure the chunk has content before trying to access .text
-                if chunk.parts:
-                    full_response_text += chunk.text
-                chunk_count += 1
-            
-            # If we received chunks, the stream is considered successful for this attempt
-            if chunk_count > 0 and (not response.prompt_feedback or response.prompt_feedback.block_reason != 'SAFETY'):
-                logger.info("Stream completed successfully.")
+    try:
+        while True:
+            contents = _resume_contents(initial_contents, delivered_text)
+            attempt = {
+                "key": f"...{api_key[-4:]}",
+                "request_bytes": len(json.dumps(contents, ensure_ascii=False).encode("utf-8")),
+                "ttfb": None,
+                "duration": None,
+                "chars": 0,
+                "output_tokens": 0,
+                "error": None,
+            }
+            attempts.append(attempt)
+            if retries:
+                stats["resumes"] += 1
+                stats["bytes_resent"] += attempt["request_bytes"]
+
+            started = time.monotonic()
+            # Only the first chunks of a resumed attempt can overlap the delivered text.
+            seam_buffer = "" if retries and delivered_text else None
+            finish_reason = None
+            try:
+                chunks = await open_stream(
+                    api_key, model_name, contents, generation_config, system_instruction, safety_settings
+                )
+
+                async for chunk in chunks:
+                    if attempt["ttfb"] is None:
+                        attempt["ttfb"] = round(time.monotonic() - started, 3)
+                    if chunk.finish_reason:
+                        finish_reason = chunk.finish_reason
+                    if chunk.output_tokens:
+                        attempt["output_tokens"] = chunk.output_tokens
+                    text = chunk.text
+
+                    if seam_buffer is not None:
+                        seam_buffer += text
+                        if len(seam_buffer) < SEAM_SEARCH_CHARS and not chunk.finish_reason:
+                            continue
+                        text, seam_buffer = _trim_seam(delivered_text, seam_buffer), None
+
+                    if text or chunk.finish_reason:
+                        delivered_text += text
+                        attempt["chars"] += len(text)
+                        # Usage is the final attempt's own, as reported upstream.
+                        yield StreamChunk(text, chunk.finish_reason, spent_tokens + attempt["output_tokens"], chunk.usage)
+
+                if seam_buffer:
+                    text = _trim_seam(delivered_text, seam_buffer)
+                    delivered_text += text
+                    attempt["chars"] += len(text)
+                    yield StreamChunk(text, None, spent_tokens + attempt["output_tokens"])
+
+                if finish_reason is None and delivered_text:
+                    raise StreamInterrupted("Upstream stream ended without a finish reason.")
+
+                attempt["duration"] = round(time.monotonic() - started, 3)
+                if scheduler is not None:
+                    scheduler.release(api_key, latency=attempt["ttfb"])
+                    held_key = None
+                logger.info(f"Stream completed successfully. Attempts: {attempts}")
                 return
 
-        except Exception as e:
-            logger.warning(f"Stream interrupted on attempt {retries + 1}. Error: {e}. Retrying...")
-            # Add the successfully received part of the response to history before retrying
-            if full_response_text:
-                chat_history.append({"role": "model", "parts": [full_response_text]})
-                # Add a user message to guide the model to continue
-                chat_history.append({"role": "user", "parts": ["Please continue generating the response from where you left off."]})
-                full_response_text = "" # Reset for the next retry
-
-            retries += 1
-            if retries > MAX_RETRIES:
-                logger.error("All retries failed.")
-                # After all retries, raise the last exception to be handled by the main endpoint
-                raise e
-
-        except Exception as e:
-            print(f"Stream interrupted on attempt {retries + 1}. Error: {e}. Retrying...")
-            retries += 1
-            if retries > MAX_RETRIES:
-                # After all retries, raise the last exception to be handled by the main endpoint
-                raise e
\ No newline at end of file
+            except Exception as e:
+                attempt["duration"] = round(time.monotonic() - started, 3)
+                attempt["error"] = str(e)[:200]
+                logger.warning(f"Stream interrupted on attempt {retries + 1} after {len(delivered_text)} delivered chars. Error: {e}")
+                if scheduler is not None:
+                    scheduler.release(api_key, error=e)
+                    held_key = None
+                spent_tokens += attempt["output_tokens"]
+
+                if is_disconnected is not None and await is_disconnected():
+                    stats["client_disconnects"] += 1
+                    logger.info(f"Client is gone; not resuming. {spent_tokens} output tokens spent. Attempts: {attempts}")
+                    return
+
+                retries += 1
+                if retries > MAX_RETRIES:
+                    stats["failed_streams"] += 1
+                    logger.error(f"All retries failed. Attempts: {attempts}")
+                    # After all retries, raise the last exception to be handled by the main endpoint
+                    raise
+
+                if scheduler is not None:
+                    # Resume on a different healthy key; once every key has been tried, reuse the best one.
+                    next_key = scheduler.acquire(exclude=tried_keys) or scheduler.acquire()
+                    if next_key is None:
+                        # Every key is at MAX_CONCURRENT_PER_KEY: end like an exhausted retry budget.
+                        stats["failed_streams"] += 1
+                        logger.error(f"No API key free to resume on. Attempts: {attempts}")
+                        raise
+                    api_key = held_key = next_key
+                    tried_keys.add(api_key)
+    finally:
+        # Covers early exits such as the client closing the stream: that says nothing about the key,
+        # so only its in-flight slot is returned and its health (e.g. a 429 cooldown) is kept.
+        if scheduler is not None and held_key is not None:
+            scheduler.abandon(held_key)
+
+
+def _trim_seam(delivered_text: str, buffered: str) -> str:
+    overlap = seam_overlap(delivered_text, buffered)
+    if overlap:
+        stats["seam_chars_trimmed"] += overlap
+        logger.info(f"Trimmed {overlap} repeated chars at the resume seam.")
+    return buffered[overlap:]
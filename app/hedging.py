@@ -0,0 +1,84 @@
+import asyncio
+import logging
+
+logger = logging.getLogger("app")
+
+
+class Hedger:
+    """
+    Races one upstream call against backups started on other keys.
+
+    The first attempt runs alone for `delay` seconds. If it has not answered by then
+    (a full response, or the first chunk for streams), another attempt is started on
+    a different key, up to `max_extra` extra calls over the lifetime of this Hedger
+    (i.e. per client request). The first attempt to succeed wins and the rest are
+    cancelled.
+    """
+
+    def __init__(self, delay: float, max_extra: int):
+        self.delay = delay
+        self.max_extra = max_extra
+        self.extra_calls = 0
+
+    async def call(self, attempt, first_key, acquire_key, release_key, abandon_key, discard=None):
+        """
+        Runs attempt(key) -> awaitable result, hedging across keys.
+
+        acquire_key() returns a fresh key for a backup attempt (or None), release_key(key, error=...)
+        records a failed attempt and abandon_key(key) returns the key of a cancelled loser.
+        `discard(result)` is awaited for the result of a loser that succeeded too, e.g. to close its stream.
+        Returns (key, result) of the winner; its key is left for the caller to release.
+        Raises the last error if every attempt failed, after releasing all keys.
+        """
+        tasks = {asyncio.ensure_future(attempt(first_key)): first_key}
+        last_error = None
+        try:
+            while tasks:
+                can_hedge = self.extra_calls < self.max_extra
+                done, _ = await asyncio.wait(
+                    tasks, timeout=self.delay if can_hedge else None, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    backup_key = acquire_key()
+                    if backup_key is None:
+                        self.max_extra = self.extra_calls  # no spare keys left, stop hedging
+                        continue
+                    self.extra_calls += 1
+                    logger.info(f"Hedging request on key ...{backup_key[-4:]} after {self.delay}s")
+                    tasks[asyncio.ensure_future(attempt(backup_key))] = backup_key
+                    continue
+
+                winner = None
+                for task in done:
+                    key = tasks.pop(task)
+                    if task.exception() is not None:
+                        last_error = task.exception()
+                        release_key(key, error=last_error)
+                    elif winner is None:
+                        winner = (key, task.result())
+                    else:
+                        # Two attempts finished in the same tick; keep the first, drop the other.
+                        abandon_key(key)
+                        await self._discard(discard, task.result())
+                if winner is not None:
+                    return winner
+            raise last_error
+        finally:
+            for task, key in tasks.items():
+                task.cancel()
+                abandon_key(key)
+            if tasks:
+                results = await asyncio.gather(*tasks, return_exceptions=True)
+                for result in results:
+                    # A loser may have finished before it could be cancelled.
+                    if not isinstance(result, BaseException):
+                        await self._discard(discard, result)
+
+    @staticmethod
+    async def _discard(discard, result):
+        if discard is None:
+            return
+        try:
+            await discard(result)
+        except Exception as e:
+            logger.warning(f"Failed to discard a losing hedged attempt: {e}")
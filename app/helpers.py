@@ -48,8 +48,13 @@ def get_safety_settings(model_name: str) -> List[Dict[str, str]]:
         return SAFETY_SETTINGS_G2
     return SAFETY_SETTINGS
 
-def openai_to_gemini_params(openai_request: dict) -> dict:
-    """Converts OpenAI-compatible request parameters to Gemini format."""
+def openai_to_gemini_params(openai_request: dict, add_random_prefix: bool = True) -> dict:
+    """
+    Converts OpenAI-compatible request parameters to Gemini format.
+
+    Pass add_random_prefix=False for cacheable requests: the anti-cache prefix would
+    otherwise make every converted request unique.
+    """
     gemini_params = {}
     
     generation_config = {
@@ -64,13 +69,6 @@ def openai_to_gemini_params(openai_request: dict) -> dict:
 
     messages = openai_request.get("messages", [])
 
-    # Add a random prefix to the last user message to prevent cache hits
-    if messages and messages[-1]["role"] == "user":
-        last_content = messages[-1].get("content", "")
-        if isinstance(last_content, str):
-            random_prefix = ''.join(random.choices(string.ascii_letters + string.digits, k=16))
-            messages[-1]["content"] = f"{random_prefix}\n{last_content}"
-
     system_instruction = None
     gemini_messages = []
 
@@ -101,5 +99,20 @@ def openai_to_gemini_params(openai_request: dict) -> dict:
 
     gemini_params["system_instruction"] = system_instruction
     gemini_params["contents"] = gemini_messages
-    
-    return gemini_params
\ No newline at end of file
+
+    if add_random_prefix and messages and messages[-1]["role"] == "user" and isinstance(messages[-1].get("content"), str):
+        gemini_params = with_random_prefix(gemini_params)
+
+    return gemini_params
+
+def with_random_prefix(gemini_params: dict) -> dict:
+    """
+    Returns a copy of gemini_params with a random prefix on the last user message to prevent cache hits.
+    The input is left untouched, so it can still be hashed as the identity of the request.
+    """
+    contents = gemini_params["contents"]
+    if not contents or contents[-1]["role"] != "user" or len(contents[-1]["parts"]) != 1:
+        return gemini_params
+    random_prefix = ''.join(random.choices(string.ascii_letters + string.digits, k=16))
+    last_message = {"role": "user", "parts": [{"text": f"{random_prefix}\n{contents[-1]['parts'][0]['text']}"}]}
+    return {**gemini_params, "contents": contents[:-1] + [last_message]}
\ No newline at end of file
@@ -0,0 +1,49 @@
+import time
+import asyncio
+import logging
+
+from .clients import get_client
+
+logger = logging.getLogger("app")
+
+
+async def probe_key(api_key: str):
+    """
+    Cheap validity probe: fetches a single page of model metadata with the key.
+    Unlike a generation call it costs no generation quota.
+    """
+    await get_client(api_key).model_async.list_models(page_size=1)
+
+
+async def check_keys(keys, scheduler=None, concurrency: int = 10, timeout: float = 10.0):
+    """
+    Validates keys concurrently, at most `concurrency` at a time, and yields one result dict per
+    key as soon as it is known. Results are fed into the scheduler's key health.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def check_one(key):
+        async with semaphore:
+            started = time.monotonic()
+            try:
+                if not isinstance(key, str) or not key:
+                    raise ValueError("API key must be a non-empty string.")
+                await asyncio.wait_for(probe_key(key), timeout)
+            except Exception as e:
+                error = "timeout" if isinstance(e, asyncio.TimeoutError) else str(e)
+                logger.warning(f"Key check failed for key ending in ...{key[-4:] if isinstance(key, str) and len(key) > 4 else '****'}: {error}")
+                if scheduler is not None:
+                    scheduler.report(key, error=e)
+                return {"key": key, "valid": False, "error": error[:200]}
+            latency = time.monotonic() - started
+            if scheduler is not None:
+                scheduler.revalidate(key)
+            return {"key": key, "valid": True, "latency_ms": round(latency * 1000, 1)}
+
+    tasks = [asyncio.ensure_future(check_one(key)) for key in keys]
+    try:
+        for next_result in asyncio.as_completed(tasks):
+            yield await next_result
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,309 @@
+import heapq
+import time
+import hashlib
+import logging
+from collections import deque
+
+logger = logging.getLogger("app")
+
+# --- 调度参数 ---
+LATENCY_EWMA_ALPHA = 0.2
+RATE_LIMIT_COOLDOWN = 30.0       # 429 / 配额耗尽后的初始冷却时间（秒）
+MAX_RATE_LIMIT_COOLDOWN = 600.0  # 连续 429 时冷却时间指数增长的上限
+INVALID_KEY_COOLDOWN = 3600.0    # Key 被吊销或无效时的冷却时间
+FAILURE_COOLDOWN = 10.0          # 连续普通错误达到阈值后的短暂冷却
+FAILURE_THRESHOLD = 3
+SHARED_SYNC_INTERVAL = 1.0       # 从共享状态同步其他 worker 记录的 Key 健康状态的最小间隔（秒）
+TPM_WINDOW = 60.0                # 统计每个 Key 已发送 token 数的滑动窗口（秒）
+
+
+def classify_error(error: Exception) -> str:
+    """Buckets an upstream exception into 'rate_limit', 'invalid_key' or 'error'."""
+    # Only needed once a call has failed; google.api_core pulls in gRPC, so it is not imported at startup.
+    from google.api_core import exceptions as google_exceptions
+    if isinstance(error, google_exceptions.ResourceExhausted):
+        return "rate_limit"
+    if isinstance(error, (google_exceptions.PermissionDenied, google_exceptions.Unauthenticated)):
+        return "invalid_key"
+    message = str(error)
+    if "429" in message or "quota" in message.lower():
+        return "rate_limit"
+    if "API_KEY_INVALID" in message or "API key not valid" in message:
+        return "invalid_key"
+    return "error"
+
+
+class KeyState:
+    """Health and load bookkeeping for a single API key."""
+
+    __slots__ = (
+        "key", "in_flight", "successes", "failures", "consecutive_failures",
+        "rate_limit_streak", "cooldown_until", "latency_ewma", "last_error", "version",
+        "key_id", "shared_updated_at", "invalid", "token_log", "window_tokens",
+    )
+
+    def __init__(self, key: str):
+        self.key = key
+        self.in_flight = 0
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.rate_limit_streak = 0
+        self.cooldown_until = 0.0
+        self.latency_ewma = 0.0
+        self.last_error = None
+        self.version = 0
+        # Stable, non-reversible id used when the key's health is written to shared storage.
+        self.key_id = hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+        self.shared_updated_at = 0.0
+        self.invalid = False
+        # (monotonic time, estimated prompt tokens) of calls sent in the last TPM_WINDOW seconds.
+        self.token_log = deque()
+        self.window_tokens = 0
+
+    def tokens_used(self, now: float) -> int:
+        while self.token_log and self.token_log[0][0] <= now - TPM_WINDOW:
+            self.window_tokens -= self.token_log.popleft()[1]
+        return self.window_tokens
+
+    def priority(self):
+        # Least loaded first, then healthiest, then fastest.
+        return (self.in_flight, self.consecutive_failures, self.latency_ewma)
+
+    def to_dict(self, now: float) -> dict:
+        return {
+            "key": f"...{self.key[-4:]}",
+            "in_flight": self.in_flight,
+            "successes": self.successes,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "cooldown_remaining": round(max(0.0, self.cooldown_until - now), 1),
+            "latency_ms": round(self.latency_ewma * 1000, 1),
+            "tokens_last_minute": self.tokens_used(now),
+            "last_error": self.last_error,
+        }
+
+
+class KeyScheduler:
+    """
+    Picks the healthiest, least-loaded API key in O(log n).
+
+    Ready keys live in a heap ordered by KeyState.priority(). Every state change pushes
+    a fresh entry tagged with the key's version, and stale entries are discarded lazily
+    when they reach the top. Keys in cooldown are parked in a second heap ordered by
+    cooldown expiry and moved back once it passes.
+
+    With `max_in_flight` set, keys already running that many calls are skipped. With
+    `tpm_limit` set, a request's estimated prompt tokens go to a key whose last minute of
+    traffic leaves room for them, if there is one. Token counts are tracked per worker.
+    """
+
+    def __init__(self, keys, shared=None, max_in_flight: int = 0, tpm_limit: int = 0):
+        self._shared = shared
+        self.max_in_flight = max_in_flight
+        self.tpm_limit = tpm_limit
+        self._last_sync = 0.0
+        self._states = {}
+        self._ready = []
+        self._cooling = []
+        for key in keys:
+            state = KeyState(key)
+            self._states[key] = state
+            self._ready.append((state.priority(), 0, key))
+        heapq.heapify(self._ready)
+
+    def __len__(self):
+        return len(self._states)
+
+    def _push(self, state: KeyState):
+        state.version += 1
+        if state.cooldown_until > time.monotonic():
+            heapq.heappush(self._cooling, (state.cooldown_until, state.version, state.key))
+        else:
+            heapq.heappush(self._ready, (state.priority(), state.version, state.key))
+        if len(self._ready) + len(self._cooling) > 4 * len(self._states) + 16:
+            self._compact()
+
+    def _compact(self):
+        now = time.monotonic()
+        self._ready, self._cooling = [], []
+        for state in self._states.values():
+            if state.cooldown_until > now:
+                self._cooling.append((state.cooldown_until, state.version, state.key))
+            else:
+                self._ready.append((state.priority(), state.version, state.key))
+        heapq.heapify(self._ready)
+        heapq.heapify(self._cooling)
+
+    def _wake_cooled(self, now: float):
+        while self._cooling and self._cooling[0][0] <= now:
+            _, version, key = heapq.heappop(self._cooling)
+            state = self._states[key]
+            if version == state.version:
+                heapq.heappush(self._ready, (state.priority(), state.version, key))
+
+    def _pop_live(self, heap, exclude, tokens=0):
+        """Pops the best live, non-excluded entry from heap, restoring skipped ones."""
+        skipped, found = [], None
+        now = time.monotonic()
+        while heap:
+            entry = heapq.heappop(heap)
+            state = self._states.get(entry[2])
+            if state is None or entry[1] != state.version:
+                continue  # stale entry
+            if entry[2] in exclude or (self.max_in_flight and state.in_flight >= self.max_in_flight):
+                skipped.append(entry)
+                continue
+            if tokens and state.tokens_used(now) + tokens > self.tpm_limit:
+                skipped.append(entry)
+                continue
+            found = entry
+            break
+        for entry in skipped:
+            heapq.heappush(heap, entry)
+        return found
+
+    def acquire(self, exclude=(), tokens: int = 0, include_cooling: bool = True):
+        """
+        Reserves the best available key and returns it, or None if every key is excluded
+        or already at max_in_flight. `tokens` is the estimated prompt size of the call.
+        Keys with TPM budget left for it are preferred; then any ready key; when all remaining
+        keys are cooling down, the one closest to recovery is used unless include_cooling is False.
+        """
+        now = time.monotonic()
+        if self._shared is not None and now - self._last_sync >= SHARED_SYNC_INTERVAL:
+            self._sync_shared(now)
+        self._wake_cooled(now)
+        entry = None
+        if tokens and self.tpm_limit:
+            entry = self._pop_live(self._ready, exclude, tokens)
+        entry = entry or self._pop_live(self._ready, exclude)
+        if entry is None and include_cooling:
+            entry = self._pop_live(self._cooling, exclude)
+        if entry is None:
+            return None
+        state = self._states[entry[2]]
+        state.in_flight += 1
+        if tokens:
+            state.token_log.append((now, tokens))
+            state.window_tokens += tokens
+            # Prune here too: without a TPM limit the log is otherwise only read by /api/status.
+            state.tokens_used(now)
+        self._push(state)
+        return state.key
+
+    def release(self, key: str, latency: float = None, error: Exception = None):
+        """Returns a key acquired with acquire() and records the outcome of the call."""
+        state = self._states.get(key)
+        if state is None:
+            return
+        state.in_flight = max(0, state.in_flight - 1)
+        self._record(state, latency, error)
+        self._push(state)
+
+    def abandon(self, key: str):
+        """Returns a key whose call was cancelled by us, without counting it as a success or failure."""
+        state = self._states.get(key)
+        if state is None:
+            return
+        state.in_flight = max(0, state.in_flight - 1)
+        self._push(state)
+
+    def report(self, key: str, latency: float = None, error: Exception = None):
+        """Records an outcome for a key that was not reserved through acquire()."""
+        state = self._states.get(key)
+        if state is None:
+            return
+        self._record(state, latency, error)
+        self._push(state)
+
+    def revalidate(self, key: str):
+        """
+        Marks a key as valid again after a successful probe. Only lifts an invalid-key cooldown:
+        a probe proves the key works, not that its generation quota has recovered.
+        """
+        state = self._states.get(key)
+        if state is None or not state.invalid:
+            return
+        state.invalid = False
+        state.consecutive_failures = 0
+        state.cooldown_until = 0.0
+        self._publish(state)
+        self._push(state)
+
+    def _sync_shared(self, now: float):
+        """Adopts key health that other workers recorded since we last looked."""
+        self._last_sync = now
+        try:
+            shared_health = self._shared.load_key_health()
+        except Exception as e:
+            logger.warning(f"Failed to load shared key health: {e}")
+            return
+        wall_offset = now - time.time()
+        by_id = {state.key_id: state for state in self._states.values()}
+        for key_id, health in shared_health.items():
+            state = by_id.get(key_id)
+            if state is None or health["updated_at"] <= state.shared_updated_at:
+                continue
+            state.shared_updated_at = health["updated_at"]
+            state.cooldown_until = health["cooldown_until"] + wall_offset if health["cooldown_until"] else 0.0
+            state.consecutive_failures = health["consecutive_failures"]
+            state.rate_limit_streak = health["rate_limit_streak"]
+            state.last_error = health["last_error"]
+            self._push(state)
+
+    def _publish(self, state: KeyState):
+        if self._shared is None:
+            return
+        now = time.monotonic()
+        try:
+            self._shared.save_key_health(state.key_id, {
+                "cooldown_until": state.cooldown_until - now + time.time() if state.cooldown_until > now else 0.0,
+                "consecutive_failures": state.consecutive_failures,
+                "rate_limit_streak": state.rate_limit_streak,
+                "last_error": state.last_error,
+            })
+            state.shared_updated_at = time.time()
+        except Exception as e:
+            logger.warning(f"Failed to publish key health: {e}")
+
+    def _record(self, state: KeyState, latency, error):
+        now = time.monotonic()
+        if error is None:
+            was_unhealthy = state.consecutive_failures or state.cooldown_until
+            state.invalid = False
+            state.successes += 1
+            state.consecutive_failures = 0
+            state.rate_limit_streak = 0
+            state.cooldown_until = 0.0
+            if latency is not None:
+                if state.latency_ewma:
+                    state.latency_ewma += LATENCY_EWMA_ALPHA * (latency - state.latency_ewma)
+                else:
+                    state.latency_ewma = latency
+            if was_unhealthy:
+                self._publish(state)
+            return
+
+        state.failures += 1
+        state.consecutive_failures += 1
+        state.last_error = str(error)[:200]
+        kind = classify_error(error)
+        if kind == "rate_limit":
+            cooldown = min(RATE_LIMIT_COOLDOWN * (2 ** state.rate_limit_streak), MAX_RATE_LIMIT_COOLDOWN)
+            state.rate_limit_streak += 1
+        elif kind == "invalid_key":
+            state.invalid = True
+            cooldown = INVALID_KEY_COOLDOWN
+        elif state.consecutive_failures >= FAILURE_THRESHOLD:
+            cooldown = FAILURE_COOLDOWN
+        else:
+            cooldown = 0.0
+        if cooldown:
+            state.cooldown_until = max(state.cooldown_until, now + cooldown)
+            logger.info(f"Key ...{state.key[-4:]} cooling down for {cooldown:.0f}s ({kind})")
+        self._publish(state)
+
+    def snapshot(self):
+        now = time.monotonic()
+        return [state.to_dict(now) for state in self._states.values()]
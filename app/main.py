@@ -1,43 +1,145 @@
 import os
 import json
 import time
+import asyncio
 import uuid
-import httpx
-import random
 import logging
-from fastapi import FastAPI, Request, HTTPException, Depends, APIRouter
-from fastapi.responses import StreamingResponse, JSONResponse
+from datetime import datetime
+from typing import Optional
+from functools import partial
+from fastapi import FastAPI, Request, HTTPException, Depends, APIRouter, Query
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse, FileResponse
 from fastapi.security import APIKeyHeader
 from fastapi.staticfiles import StaticFiles
+from starlette.background import BackgroundTask
 from starlette.status import HTTP_401_UNAUTHORIZED
-import google.generativeai as genai
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 
-from .helpers import get_safety_settings, openai_to_gemini_params
+from .helpers import get_safety_settings, openai_to_gemini_params, with_random_prefix
 from .models import ChatCompletionRequest
-from collections import deque
-from . import gem_handler
+from . import gem_handler, rest_stream
+from .clients import get_client, load_sdk
+from .model_catalog import ModelCatalog
+from .key_scheduler import KeyScheduler
+from .hedging import Hedger
+from .token_estimator import TokenEstimator, truncate_history
+from .context_cache import ContextCache
+from .single_flight import SingleFlight, LeaderGone
+from .admission import AdmissionController, AdmissionRejected
+from .batches import BatchManager, BatchRequestError, InvalidBatch
+from .response_cache import ResponseCache, make_cache_key
+from .shared_state import shared_state
+from .call_log import call_log
+from .sse import ChunkEncoder, coalesce, DONE as SSE_DONE
+from .streaming import sdk_chunks, cancel_on_disconnect, ClientDisconnected
+from .metrics import registry as metrics, StreamTimer, RequestTimingMiddleware
+
+logger = logging.getLogger("app")
 
 # --- 日志记录 ---
-MAX_LOG_ENTRIES = 20
-call_logs = deque(maxlen=MAX_LOG_ENTRIES)
+# 调用日志由后台任务批量写入 SQLite（见 call_log.py），/api/logs 能看到所有 worker 的流量，
+# 并支持按模型、Key、状态、时间过滤和翻页
+MAX_LOG_ENTRIES = 20      # /api/logs 默认返回的条数
+MAX_LOG_PAGE_SIZE = 500   # /api/logs 单页最多返回的条数
+
+def record_call(log_entry):
+    try:
+        call_log.append(log_entry)
+    except Exception as e:
+        print(f"Failed to record call log: {e}")
 
 # --- 配置 ---
 GEM_ENABLED = os.environ.get("GEM", "false").lower() == "true"
 GEMINI_API_KEYS = [key.strip() for key in os.environ.get("GEMINI_API_KEYS", "").split(',') if key.strip()]
 LAOPOBAO_AUTH_KEY = os.environ.get("LAOPOBAO_AUTH")
 MAX_TRY = int(os.environ.get("MAX_TRY", 3))
+# 每个 IP 调用 /v1/chat/completions 的速率限制（slowapi 格式）
+CHAT_RATE_LIMIT = os.environ.get("CHAT_RATE_LIMIT", "20/minute")
+# 对冲请求：首个尝试在 HEDGE_DELAY 秒内没有响应时，换一个 Key 并行发起备用请求
+HEDGE_ENABLED = os.environ.get("HEDGE", "false").lower() == "true"
+HEDGE_DELAY = float(os.environ.get("HEDGE_DELAY", 3.0))
+HEDGE_MAX_EXTRA = int(os.environ.get("HEDGE_MAX_EXTRA", 1))
+# 非流式响应缓存：仅缓存 temperature 不高于 RESPONSE_CACHE_MAX_TEMPERATURE 的请求
+RESPONSE_CACHE_ENABLED = os.environ.get("RESPONSE_CACHE", "false").lower() == "true"
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 256))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", 300))
+RESPONSE_CACHE_MAX_TEMPERATURE = float(os.environ.get("RESPONSE_CACHE_MAX_TEMPERATURE", 0))
+# 流式输出合并窗口（毫秒）：窗口内到达的多个 SSE 事件合并为一次写出，0 表示关闭
+SSE_COALESCE_MS = float(os.environ.get("SSE_COALESCE_MS", 0))
+# 流式请求的上游传输方式：grpc 使用 Gemini SDK；rest 直接调用 streamGenerateContent?alt=sse 并自行解析（见 rest_stream.py）。
+# 非流式请求、模型列表和上下文缓存始终走 SDK
+UPSTREAM_TRANSPORT = os.environ.get("UPSTREAM_TRANSPORT", "grpc").lower()
+REST_STREAMING = UPSTREAM_TRANSPORT == "rest"
+# Key 检测的并发数和单个 Key 的超时时间（秒）
+KEY_CHECK_CONCURRENCY = int(os.environ.get("KEY_CHECK_CONCURRENCY", 10))
+KEY_CHECK_TIMEOUT = float(os.environ.get("KEY_CHECK_TIMEOUT", 10))
+# 模型列表缓存时间（秒），过期后在后台刷新；MODEL_VALIDATION=true 时拒绝列表中不存在的模型
+MODELS_CACHE_TTL = float(os.environ.get("MODELS_CACHE_TTL", 600))
+MODEL_VALIDATION_ENABLED = os.environ.get("MODEL_VALIDATION", "true").lower() == "true"
+# 准入控制（按 worker 计算）：每个模型、每个 Key 的最大并发上游请求数，0 表示不限制。
+# 超出时请求在有界队列中最多等待 ADMISSION_QUEUE_TIMEOUT 秒，队列已满则立即返回 429。
+MAX_CONCURRENT_PER_MODEL = int(os.environ.get("MAX_CONCURRENT_PER_MODEL", 0))
+MAX_CONCURRENT_PER_KEY = int(os.environ.get("MAX_CONCURRENT_PER_KEY", 0))
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", 64))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", 10))
+# 按估算的 prompt token 数选 Key：KEY_TPM_LIMIT 为每个 Key 每分钟的输入 token 上限，0 表示不考虑
+KEY_TPM_LIMIT = int(os.environ.get("KEY_TPM_LIMIT", 0))
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", 4096))
+# 服务端截断历史记录：估算的 prompt 超过 MAX_PROMPT_TOKENS 时丢弃最早的对话轮次，0 表示不截断
+MAX_PROMPT_TOKENS = int(os.environ.get("MAX_PROMPT_TOKENS", 0))
+# Gemini 上下文缓存：重复出现且不少于 CONTEXT_CACHE_MIN_TOKENS 的前缀会在上游缓存 CONTEXT_CACHE_TTL 秒
+CONTEXT_CACHE_ENABLED = os.environ.get("CONTEXT_CACHE", "false").lower() == "true"
+CONTEXT_CACHE_TTL = float(os.environ.get("CONTEXT_CACHE_TTL", 600))
+CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get("CONTEXT_CACHE_MIN_TOKENS", 4096))
+# 合并同时进行的相同请求：非流式共享一次上游调用，流式共享同一个输出流（新加入者先补发已输出的块）
+# 默认关闭；开启后也只合并 temperature 不超过 RESPONSE_CACHE_MAX_TEMPERATURE 的请求，并行采样的请求仍各自调用上游
+COALESCE_ENABLED = os.environ.get("COALESCE", "false").lower() == "true"
+COALESCE_BUFFER_CHUNKS = int(os.environ.get("COALESCE_BUFFER_CHUNKS", 1024))
+# 批量任务（/v1/batches）：任务文件和结果保存在 BATCH_DIR，每个 Key 最多同时执行 BATCH_CONCURRENCY_PER_KEY 个批量请求，
+# 单个请求最多尝试 BATCH_MAX_ATTEMPTS 次
+BATCH_DIR = os.environ.get("BATCH_DIR", "/tmp/baojimi-lite-batches")
+BATCH_CONCURRENCY_PER_KEY = int(os.environ.get("BATCH_CONCURRENCY_PER_KEY", 2))
+BATCH_MAX_ATTEMPTS = int(os.environ.get("BATCH_MAX_ATTEMPTS", 5))
+BATCH_MAX_REQUESTS = int(os.environ.get("BATCH_MAX_REQUESTS", 50000))
+
+# --- Key 调度 ---
+key_scheduler = KeyScheduler(
+    GEMINI_API_KEYS, shared=shared_state, max_in_flight=MAX_CONCURRENT_PER_KEY, tpm_limit=KEY_TPM_LIMIT
+)
+token_estimator = TokenEstimator(TOKEN_CACHE_SIZE)
+model_catalog = ModelCatalog(key_scheduler, MODELS_CACHE_TTL)
+
+# --- 准入控制 ---
+# 每个 Key 的并发上限换算成总并发上限，保证被放行的请求总能拿到一个未满载的 Key
+admission = AdmissionController(
+    max_per_model=MAX_CONCURRENT_PER_MODEL,
+    max_total=MAX_CONCURRENT_PER_KEY * len(GEMINI_API_KEYS),
+    max_queue=ADMISSION_QUEUE_SIZE,
+    queue_timeout=ADMISSION_QUEUE_TIMEOUT,
+)
+
+# --- 上下文缓存 ---
+context_cache = ContextCache(token_estimator, CONTEXT_CACHE_TTL, CONTEXT_CACHE_MIN_TOKENS) if CONTEXT_CACHE_ENABLED else None
+
+# --- 相同请求合并 ---
+single_flight = SingleFlight(COALESCE_BUFFER_CHUNKS)
+
+# --- 响应缓存 ---
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL) if RESPONSE_CACHE_ENABLED else None
 
 # --- FastAPI 应用实例与速率限制 ---
-limiter = Limiter(key_func=get_remote_address)
+# 速率限制计数同样存放在共享状态中（shared:// 由 shared_state.SharedStateStorage 注册），
+# 否则每个 worker 各算各的，实际限额会随 worker 数量翻倍
+limiter = Limiter(key_func=get_remote_address, storage_uri="shared://")
 app = FastAPI(
     title="baojimi-lite",
     version="1.0.0",
     description="年轻人的第一个gemini代理轮询服务 (Hugging Face Docker版)"
 )
 app.state.limiter = limiter
+app.add_middleware(RequestTimingMiddleware)
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
 # --- 启动事件 ---
@@ -77,8 +179,67 @@ async def startup_event():
             logger.info("已加载GEM自愈功能，但尚未启动，如需启动，请将GEM的值更改为true")
     else:
         logger.warning("GEM自愈系统未启动，将按照常规方式处理API调用")
+
+    if HEDGE_ENABLED:
+        logger.info(f"已开启对冲请求，延迟 {HEDGE_DELAY} 秒，每个请求最多额外调用 {HEDGE_MAX_EXTRA} 次")
+
+    if RESPONSE_CACHE_ENABLED:
+        logger.info(f"已开启响应缓存，最多 {RESPONSE_CACHE_SIZE} 条，有效期 {RESPONSE_CACHE_TTL} 秒")
+
+    if admission.enabled:
+        logger.info(f"已开启准入控制：每个模型最多 {MAX_CONCURRENT_PER_MODEL or '不限'} 个并发，每个 Key 最多 {MAX_CONCURRENT_PER_KEY or '不限'} 个并发，排队上限 {ADMISSION_QUEUE_SIZE}，最长等待 {ADMISSION_QUEUE_TIMEOUT} 秒")
+
+    if MAX_CONCURRENT_PER_KEY == 1:
+        logger.warning("MAX_CONCURRENT_PER_KEY 为 1 时批量任务会占满 Key，执行批量任务期间的对话请求可能直接返回 429")
+
+    if KEY_TPM_LIMIT:
+        logger.info(f"已开启按 token 选 Key，每个 Key 每分钟最多 {KEY_TPM_LIMIT} 个输入 token")
+
+    if COALESCE_ENABLED:
+        logger.info("已开启相同请求合并")
+
+    if CONTEXT_CACHE_ENABLED:
+        logger.info(f"已开启上下文缓存，前缀不少于约 {CONTEXT_CACHE_MIN_TOKENS} token 时缓存 {CONTEXT_CACHE_TTL} 秒")
+
+    if REST_STREAMING:
+        logger.info(f"流式请求使用 REST SSE 上游：{rest_stream.GEMINI_REST_ENDPOINT}")
+    elif UPSTREAM_TRANSPORT != "grpc":
+        logger.warning(f"未知的 UPSTREAM_TRANSPORT={UPSTREAM_TRANSPORT}，流式请求将使用 gRPC")
+
+    if MAX_PROMPT_TOKENS:
+        logger.info(f"已开启历史记录截断，prompt 超过约 {MAX_PROMPT_TOKENS} token 时丢弃最早的对话")
     logger.info("----------------------------------------")
 
+    # Import the Gemini SDK in a background thread: the worker answers right away, and by the
+    # time the first chat request arrives the import is usually done. A no-op when preloaded.
+    asyncio.get_running_loop().run_in_executor(None, load_sdk)
+
+    call_log.start()
+    # Also resumes batches left unfinished by a previous run.
+    batch_manager.start()
+
+    if GEMINI_API_KEYS:
+        # Warm the model list in the background so the first /v1/models call is served from cache.
+        model_catalog.warm()
+
+# --- 预加载 ---
+def prepare_workers():
+    """
+    Runs once in the gunicorn master when the app is preloaded (see gunicorn.conf.py). Workers
+    forked afterwards inherit the imported SDK and the created databases instead of redoing it.
+    """
+    load_sdk()
+    shared_state.initialize()
+    call_log.initialize()
+    os.makedirs(BATCH_DIR, exist_ok=True)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Checkpoint running batches, then write out call logs still waiting in the queue.
+    await batch_manager.stop()
+    await call_log.stop()
+    await rest_stream.close()
+
 # --- 路由 ---
 v1_router = APIRouter(prefix="/v1")
 admin_router = APIRouter(prefix="/api")
@@ -100,54 +261,76 @@ async def verify_auth_key(auth: str = Depends(get_current_auth)):
 # --- 路由实现 ---
 @admin_router.get("/status", tags=["Admin"])
 async def get_status():
-    return {"status": "ok", "key_count": len(GEMINI_API_KEYS), "service": "baojimi-lite"}
+    return {
+        "status": "ok",
+        "key_count": len(GEMINI_API_KEYS),
+        "service": "baojimi-lite",
+        "keys": key_scheduler.snapshot(),
+        "response_cache": response_cache.stats() if response_cache is not None else None,
+        "gem": gem_handler.stats if GEM_ENABLED else None,
+        "admission": admission.stats(),
+        "token_estimator": token_estimator.stats(),
+        "context_cache": context_cache.stats() if context_cache is not None else None,
+        "coalescing": single_flight.stats() if COALESCE_ENABLED else None,
+        "call_log": call_log.stats(),
+        "batches": batch_manager.stats(),
+        "latency": metrics.summary()
+    }
+
+@admin_router.get("/metrics", tags=["Admin"])
+async def get_metrics():
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
 
 @admin_router.get("/logs", tags=["Admin"])
-async def get_logs():
-    return list(call_logs)
+async def get_logs(
+    limit: int = Query(MAX_LOG_ENTRIES, ge=1, le=MAX_LOG_PAGE_SIZE),
+    before: Optional[int] = Query(None, description="Return entries older than this seq (the previous page's next_before)"),
+    model: Optional[str] = None,
+    key: Optional[str] = Query(None, description="Last four characters of the API key"),
+    status: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+):
+    # Make this worker's queued entries visible before querying.
+    await call_log.flush()
+    return await asyncio.to_thread(
+        call_log.query, limit=limit, before=before, model=model, key=key, status=status,
+        since=since.timestamp() if since else None, until=until.timestamp() if until else None,
+    )
 
 @admin_router.post("/check-keys", tags=["Admin"], dependencies=[Depends(verify_auth_key)])
 @limiter.limit("5/minute")
 async def check_api_keys(request: Request):
-    if not GEMINI_API_KEYS: return {"valid_keys": [], "invalid_keys": []}
-    valid_keys, invalid_keys = [], []
-    async with httpx.AsyncClient() as client:
-        for key in GEMINI_API_KEYS:
-            try:
-                if not isinstance(key, str) or not key:
-                    raise ValueError("API key must be a non-empty string.")
-                genai.configure(api_key=key)
-                model = genai.GenerativeModel('gemini-1.5-flash')
-                await model.generate_content_async("hello", generation_config={"max_output_tokens": 1})
-                valid_keys.append(key)
-            except Exception as e:
-                # Log the error for debugging purposes
-                print(f"Key check failed for key ending in ...{key[-4:] if isinstance(key, str) and len(key) > 4 else '****'}: {e}")
-                invalid_keys.append(key)
-    return {"valid_keys": valid_keys, "invalid_keys": invalid_keys}
+    # Rarely used, so the checker is only imported on the first check.
+    from .key_checker import check_keys
+
+    # Results stream back as NDJSON: one line per key as soon as it is checked, then a summary line.
+    async def results():
+        valid_count, invalid_count = 0, 0
+        yield json.dumps({"total": len(GEMINI_API_KEYS)}) + "\n"
+        async for result in check_keys(GEMINI_API_KEYS, key_scheduler, KEY_CHECK_CONCURRENCY, KEY_CHECK_TIMEOUT):
+            if result["valid"]:
+                valid_count += 1
+            else:
+                invalid_count += 1
+            yield json.dumps(result) + "\n"
+        yield json.dumps({"done": True, "valid": valid_count, "invalid": invalid_count}) + "\n"
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
 
 @v1_router.get("/models", tags=["OpenAI Compatibility"])
 async def list_models():
     if not GEMINI_API_KEYS:
         raise HTTPException(status_code=500, detail="GEMINI_API_KEYS is not configured.")
 
-    api_key = random.choice(GEMINI_API_KEYS)
-    genai.configure(api_key=api_key)
-
     try:
-        models = genai.list_models()
-        model_list = []
-        for m in models:
-            if 'generateContent' in m.supported_generation_methods:
-                model_list.append(
-                     {"id": m.name.replace("models/", ""), "object": "model", "created": int(time.time()), "owned_by": "google"}
-                 )
+        model_list = await model_catalog.get()
         return {"object": "list", "data": model_list}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch models from Google. Error: {e}")
 
 @v1_router.post("/chat/completions", tags=["OpenAI Compatibility"]) # Auth is handled inside
-@limiter.limit("20/minute")
+@limiter.limit(CHAT_RATE_LIMIT)
 async def chat_completions(req: ChatCompletionRequest, request: Request, auth: str = Depends(get_current_auth)):
     # For some clients, we need to check auth key here
     if LAOPOBAO_AUTH_KEY and not auth:
@@ -155,15 +338,69 @@ async def chat_completions(req: ChatCompletionRequest, request: Request, auth: s
 
     if not GEMINI_API_KEYS: raise HTTPException(status_code=500, detail="GEMINI_API_KEYS is not configured.")
   
+    handler_started = time.perf_counter()
+    request_started = getattr(request.state, "received_at", handler_started)
     model_name = req.model
+    if MODEL_VALIDATION_ENABLED:
+        if await model_catalog.confirm_unknown(model_name):
+            raise HTTPException(status_code=400, detail=f"Unknown model: {model_name}")
+        model_catalog.warm()
+    metrics.observe("baojimi_request_parse_seconds", handler_started - request_started, model=model_name)
+    # Only deterministic requests may share a response; sampled ones must each get their own.
+    deterministic = (req.temperature or 0) <= RESPONSE_CACHE_MAX_TEMPERATURE
+    cacheable = response_cache is not None and not req.stream and deterministic
+    coalescible = COALESCE_ENABLED and deterministic
     try:
-        gemini_params = openai_to_gemini_params(req.dict())
+        gemini_params = openai_to_gemini_params(req.dict(), add_random_prefix=False)
         safety_settings = get_safety_settings(model_name)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
-
-    available_keys = random.sample(GEMINI_API_KEYS, len(GEMINI_API_KEYS))
+    if MAX_PROMPT_TOKENS:
+        prompt_tokens, dropped_turns = truncate_history(gemini_params, MAX_PROMPT_TOKENS, token_estimator)
+        if dropped_turns:
+            logger.info(f"Truncated {dropped_turns} oldest turns to ~{prompt_tokens} prompt tokens")
+    else:
+        prompt_tokens = token_estimator.estimate(gemini_params)
+    request_key = None
+    if cacheable or coalescible:
+        # Identity of the request, taken before the anti-cache prefix makes every request unique.
+        request_key = make_cache_key(model_name, gemini_params)
+    if not cacheable:
+        gemini_params = with_random_prefix(gemini_params)
+    metrics.observe("baojimi_convert_seconds", time.perf_counter() - handler_started, model=model_name)
+
+    max_attempts = min(len(GEMINI_API_KEYS), MAX_TRY)
+    tried_keys = set()
+    use_gem = req.stream and GEM_ENABLED and model_name.startswith('gemini')
+    # The self-healing generator manages its own keys and retries, so it is not hedged.
+    hedger = Hedger(HEDGE_DELAY, HEDGE_MAX_EXTRA) if HEDGE_ENABLED and not use_gem else None
+
+    def acquire_backup_key():
+        backup_key = key_scheduler.acquire(exclude=tried_keys, tokens=prompt_tokens)
+        if backup_key is not None:
+            tried_keys.add(backup_key)
+        return backup_key
+
+    async def upstream_call(api_key):
+        # Returns the Gemini response (streams are already primed with their first chunk) and its latency.
+        started = time.monotonic()
+        key_label = f"...{api_key[-4:]}"
+        try:
+            response = await generate_content(api_key, model_name, gemini_params, safety_settings, stream=req.stream)
+        except BaseException as e:
+            outcome = "cancelled" if isinstance(e, asyncio.CancelledError) else "error"
+            metrics.observe("baojimi_upstream_attempt_seconds", time.monotonic() - started, model=model_name, key=key_label, outcome=outcome)
+            raise
+        latency = time.monotonic() - started
+        metrics.observe("baojimi_upstream_attempt_seconds", latency, model=model_name, key=key_label, outcome="ok")
+        return response, latency
   
+    async def discard_response(result):
+        # A losing hedged stream is closed, so it stops generating and gives back its connection.
+        response, _ = result
+        if req.stream:
+            await (response if REST_STREAMING else sdk_chunks(response)).aclose()
+
     log_entry = {
         "id": f"log-{uuid.uuid4()}",
         "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
@@ -174,52 +411,218 @@ async def chat_completions(req: ChatCompletionRequest, request: Request, auth: s
         "error_info": None
     }
 
-    for i in range(min(len(available_keys), MAX_TRY)):
-        api_key = available_keys[i]
-        log_entry["key_used"] = f"...{api_key[-4:]}"
+    cache_key = None
+    if cacheable:
+        cache_key = request_key
+        cached_response = response_cache.get(cache_key)
+        if cached_response is not None:
+            log_entry["status"] = "success"
+            log_entry["key_used"] = "cache"
+            record_call(log_entry)
+            return {**cached_response, "id": f"chatcmpl-{uuid.uuid4()}", "created": int(time.time())}
+
+    broadcast = None
+    if coalescible and req.stream:
+        # An identical stream is already running: subscribe to it, with its earlier chunks replayed.
+        shared_chunks = await single_flight.join_stream(request_key)
+        if shared_chunks is not None:
+            log_entry["status"] = "success"
+            log_entry["key_used"] = "shared"
+            record_call(log_entry)
+            return sse_response(shared_chunks, model_name, request=request)
+        broadcast = single_flight.lead_stream(request_key)
+
+    def stream_response(chunks, ticket, on_finish=None, timer=None, on_unused=None):
+        if broadcast is None:
+            return sse_response(chunks, model_name, on_finish, timer, ticket, request, on_unused)
+
+        # The upstream now belongs to the broadcast; its key and admission slot are freed when it ends.
+        def on_close(error=None):
+            if on_finish is not None:
+                on_finish(error=error)
+            ticket.release()
+        broadcast.start(chunks, on_close)
+        return sse_response(broadcast.subscribe(), model_name, timer=timer, request=request)
+
+    async def complete():
         try:
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel(
-                model_name=model_name,
-                safety_settings=safety_settings,
-                system_instruction=gemini_params.get("system_instruction")
-            )
-          
-            if req.stream:
-                if GEM_ENABLED and model_name.startswith('gemini'):
-                    # Use the self-healing stream generator for all gemini models
-                    response_generator = gem_handler.self_healing_stream_generator(model_name, gemini_params, api_key)
-                else:
-                    # Use the standard stream generator
-                    response_generator = await model.generate_content_async(gemini_params["contents"], generation_config=gemini_params["generation_config"], stream=True)
-                
-                log_entry["status"] = "success"
-                call_logs.appendleft(log_entry)
-                return StreamingResponse(stream_generator(response_generator, model_name), media_type="text/event-stream")
-            else:
-                response = await model.generate_content_async(gemini_params["contents"], generation_config=gemini_params["generation_config"])
-                log_entry["status"] = "success"
-                call_logs.appendleft(log_entry)
-                openai_response = non_stream_response(response, model_name)
-                if "error" in openai_response:
-                    raise HTTPException(status_code=500, detail=openai_response["error"])
-                return openai_response
-        except Exception as e:
-            print(f"Attempt {i+1} with key ...{api_key[-4:]} failed: {e}")
-            log_entry["status"] = "failed"
-            log_entry["error_info"] = str(e)
-            if i == min(len(available_keys), MAX_TRY) - 1:
-                call_logs.appendleft(log_entry)
-                raise HTTPException(status_code=500, detail=f"All API keys failed. Last error: {e}")
-            continue
+            ticket = await admission.admit(model_name)
+        except AdmissionRejected as e:
+            raise HTTPException(status_code=429, detail=f"Server busy: {e.reason}", headers={"Retry-After": str(e.retry_after)})
+        # Streams hand the ticket to their body generator, which releases it when the stream ends.
+        ticket_handed_off = False
+        try:
+            for i in range(max_attempts):
+                api_key = key_scheduler.acquire(exclude=tried_keys, tokens=prompt_tokens)
+                if api_key is None:
+                    if not tried_keys:
+                        # Every key is at MAX_CONCURRENT_PER_KEY (e.g. taken by hedged backups).
+                        raise HTTPException(status_code=429, detail="Server busy: all API keys are saturated", headers={"Retry-After": str(admission.retry_after())})
+                    break
+                tried_keys.add(api_key)
+                log_entry["key_used"] = f"...{api_key[-4:]}"
+                key_released = False
+                try:
+                    if use_gem:
+                        # Use the self-healing stream generator for all gemini models.
+                        # It takes over the acquired key and reports every attempt to the scheduler itself.
+                        key_released = True
+                        # A shared stream is still wanted while anyone reads it, whether or not this client is.
+                        is_disconnected = request.is_disconnected if broadcast is None else broadcast.is_abandoned
+                        response_generator = gem_handler.self_healing_stream_generator(
+                            model_name, gemini_params, api_key, key_scheduler, safety_settings, is_disconnected,
+                            open_stream=rest_stream.stream_generate_content if REST_STREAMING else None
+                        )
+                        log_entry["status"] = "success"
+                        record_call(log_entry)
+                        timer = StreamTimer(model_name, log_entry["key_used"], request_started)
+                        ticket_handed_off = True
+                        # The generator only takes over the key once it runs; if it never does, give the key back here.
+                        return stream_response(
+                            response_generator, ticket, timer=timer, on_unused=partial(key_scheduler.abandon, api_key)
+                        )
+
+                    if hedger is not None:
+                        # Hedged attempts release their own keys on failure or cancellation.
+                        key_released = True
+                        api_key, (response, latency) = await hedger.call(
+                            upstream_call, api_key, acquire_backup_key, key_scheduler.release, key_scheduler.abandon,
+                            discard_response
+                        )
+                        key_released = False
+                        log_entry["key_used"] = f"...{api_key[-4:]}"
+                    else:
+                        response, latency = await upstream_call(api_key)
+
+                    if req.stream:
+                        # The key stays in flight until the stream is drained.
+                        key_released = True
+                        on_finish = partial(key_scheduler.release, api_key, latency)
+                        log_entry["status"] = "success"
+                        record_call(log_entry)
+                        timer = StreamTimer(model_name, log_entry["key_used"], request_started)
+                        ticket_handed_off = True
+                        # The REST transport already yields StreamChunks.
+                        chunks = response if REST_STREAMING else sdk_chunks(response)
+                        return stream_response(chunks, ticket, on_finish, timer)
+                    else:
+                        openai_response = non_stream_response(response, model_name)
+                        # The key answered: a blocked or unreadable response still says nothing bad about it.
+                        key_released = True
+                        key_scheduler.release(api_key, latency=latency)
+                        if "error" in openai_response:
+                            raise HTTPException(status_code=500, detail=openai_response["error"])
+                        if cache_key is not None:
+                            response_cache.put(cache_key, openai_response)
+                        metrics.observe("baojimi_request_seconds", time.perf_counter() - request_started, model=model_name)
+                        log_entry["status"] = "success"
+                        record_call(log_entry)
+                        return openai_response
+                except Exception as e:
+                    print(f"Attempt {i+1} with key ...{api_key[-4:]} failed: {e}")
+                    if not key_released:
+                        key_scheduler.release(api_key, error=e)
+                    log_entry["status"] = "failed"
+                    log_entry["error_info"] = str(e)
+                    if i == max_attempts - 1:
+                        record_call(log_entry)
+                        raise HTTPException(status_code=500, detail=f"All API keys failed. Last error: {e}")
+                    continue
     
-    # This part should ideally not be reached if successful response is returned
-    log_entry["status"] = "failed"
-    log_entry["error_info"] = "All retries failed."
-    call_logs.appendleft(log_entry)
-    raise HTTPException(status_code=500, detail="Failed to get response from Gemini after all retries.")
+            # This part should ideally not be reached if successful response is returned
+            log_entry["status"] = "failed"
+            log_entry["error_info"] = "All retries failed."
+            record_call(log_entry)
+            raise HTTPException(status_code=500, detail="Failed to get response from Gemini after all retries.")
+        finally:
+            if not ticket_handed_off:
+                ticket.release()
+
+    if coalescible and not req.stream:
+        openai_response, shared = await single_flight.do(request_key, complete)
+        if not shared:
+            return openai_response
+        log_entry["status"] = "success"
+        log_entry["key_used"] = "shared"
+        record_call(log_entry)
+        return {**openai_response, "id": f"chatcmpl-{uuid.uuid4()}", "created": int(time.time())}
+
+    if broadcast is None:
+        return await complete()
+    try:
+        return await complete()
+    except BaseException as e:
+        # Requests waiting to join get the same HTTP error; if we were cancelled they run their own call.
+        broadcast.fail(e if isinstance(e, HTTPException) else LeaderGone("The shared stream was not started."))
+        raise
+
+@v1_router.post("/batches", tags=["Batches"], dependencies=[Depends(verify_auth_key)])
+@limiter.limit("10/minute")
+async def create_batch(request: Request):
+    # The request body is the JSONL input file: one {"custom_id", "url", "body"} line per chat completion.
+    if not GEMINI_API_KEYS: raise HTTPException(status_code=500, detail="GEMINI_API_KEYS is not configured.")
+    try:
+        return await batch_manager.create(request.stream())
+    except InvalidBatch as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@v1_router.get("/batches", tags=["Batches"], dependencies=[Depends(verify_auth_key)])
+async def list_batches(limit: int = Query(20, ge=1, le=100)):
+    return {"object": "list", "data": batch_manager.list(limit)}
+
+@v1_router.get("/batches/{batch_id}", tags=["Batches"], dependencies=[Depends(verify_auth_key)])
+async def get_batch(batch_id: str):
+    batch = batch_manager.get(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail=f"Batch {batch_id} not found")
+    return batch
+
+@v1_router.get("/batches/{batch_id}/output", tags=["Batches"], dependencies=[Depends(verify_auth_key)])
+async def get_batch_output(batch_id: str):
+    # Results in OpenAI batch output format, in completion order; partial while the batch is running.
+    path = batch_manager.output_path(batch_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail=f"Batch {batch_id} not found")
+    return FileResponse(path, media_type="application/jsonl", filename=f"{batch_id}_output.jsonl")
+
+@v1_router.post("/batches/{batch_id}/cancel", tags=["Batches"], dependencies=[Depends(verify_auth_key)])
+async def cancel_batch(batch_id: str):
+    batch = batch_manager.cancel(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail=f"Batch {batch_id} not found")
+    return batch
 
 # --- 辅助函数 ---
+async def generate_content(api_key, model_name, gemini_params, safety_settings, stream=False):
+    """
+    One Gemini call on api_key; with context caching on, only the uncached part of the prompt is sent.
+    With the REST transport, streams come back as an async iterator of StreamChunks.
+    """
+    async def send(contents, cache_name=None):
+        if stream and REST_STREAMING:
+            return await rest_stream.stream_generate_content(
+                api_key, model_name, contents, gemini_params["generation_config"],
+                gemini_params.get("system_instruction"), safety_settings, cache_name
+            )
+        model = get_client(api_key).generative_model(
+            model_name=model_name,
+            safety_settings=safety_settings,
+            system_instruction=gemini_params.get("system_instruction"),
+            cached_content=cache_name
+        )
+        return await model.generate_content_async(contents, generation_config=gemini_params["generation_config"], stream=stream)
+
+    cache_name, contents = None, gemini_params["contents"]
+    if context_cache is not None:
+        cache_name, contents = context_cache.prepare(api_key, model_name, gemini_params)
+    try:
+        return await send(contents, cache_name)
+    except Exception as e:
+        if cache_name is None or not context_cache.invalidate(api_key, cache_name, e):
+            raise
+    # The cached prefix expired upstream; resend the full prompt on the same key.
+    return await send(gemini_params["contents"])
+
 def gemini_finish_reason_to_openai(reason: str) -> str:
     """Converts Gemini's finish reason to OpenAI's format."""
     if reason is None:
@@ -233,57 +636,95 @@ def gemini_finish_reason_to_openai(reason: str) -> str:
         "OTHER": "stop",
     }.get(reason, "stop")
 
-async def stream_generator(gemini_response, model_name):
+async def stream_generator(chunks, model_name, on_finish=None, timer=None, ticket=None):
+    """Encodes an async iterator of StreamChunks as OpenAI SSE events."""
+    # One completion id / created timestamp per stream, as OpenAI clients expect.
+    encoder = ChunkEncoder(model_name)
     final_finish_reason = "stop"  # Default finish reason
+    usage = None
+    stream_error = None
+    client_gone = False
     try:
-        async for chunk in gemini_response:
-            if not chunk.parts:
-                continue
-            
+        async for chunk in chunks:
             finish_reason = None
-            if chunk.candidates and chunk.candidates[0].finish_reason:
-                finish_reason = gemini_finish_reason_to_openai(chunk.candidates[0].finish_reason)
+            if chunk.finish_reason:
+                finish_reason = gemini_finish_reason_to_openai(chunk.finish_reason)
                 if finish_reason != 'stop': # Keep track of the final non-stop reason
                     final_finish_reason = finish_reason
+            if chunk.usage is not None:
+                usage = chunk.usage
 
-            choice = {
-                "index": 0,
-                "delta": {"content": chunk.text},
-                "finish_reason": finish_reason
-            }
+            if not chunk.text:
+                continue
+            if timer is not None:
+                timer.chunk()
+            yield encoder.content(chunk.text, finish_reason)
 
-            openai_chunk = {
-                "id": f"chatcmpl-{uuid.uuid4()}",
-                "object": "chat.completion.chunk",
-                "created": int(time.time()),
-                "model": model_name,
-                "choices": [choice]
-            }
-            yield f"data: {json.dumps(openai_chunk)}\n\n"
+    except ClientDisconnected:
+        # Nobody is listening any more; skip the closing events.
+        client_gone = True
 
     except Exception as e:
         print(f"Error in stream generator: {e}")
-        error_chunk = {"error": str(e)}
-        yield f"data: {json.dumps(error_chunk)}\n\n"
+        stream_error = e
+        yield encoder.error(str(e))
         final_finish_reason = "error"
 
     finally:
-        # This final chunk is sent regardless of whether the stream finished successfully or not.
-        final_chunk = {
-            "id": f"chatcmpl-{uuid.uuid4()}",
-            "object": "chat.completion.chunk",
-            "created": int(time.time()),
-            "model": model_name,
-            "choices": [
-                {
-                    "index": 0,
-                    "delta": {},
-                    "finish_reason": final_finish_reason
-                }
-            ]
-        }
-        yield f"data: {json.dumps(final_chunk)}\n\n"
-        yield "data: [DONE]\n\n"
+        if on_finish is not None:
+            on_finish(error=stream_error)
+        if ticket is not None:
+            ticket.release()
+        if timer is not None:
+            timer.done()
+
+    # This final chunk is sent whether or not the stream finished successfully. It is not yielded
+    # from the finally block, where it would swallow a cancellation or break aclose().
+    if not client_gone:
+        yield encoder.finish(final_finish_reason, usage)
+        yield SSE_DONE
+
+def sse_response(chunks, model_name, on_finish=None, timer=None, ticket=None, request=None, on_unused=None):
+    """
+    Streams `chunks` to the client. `on_unused` runs instead of on_finish(error=None) when the
+    client leaves before the stream is first read.
+    """
+    source = chunks
+    finished = False
+
+    def finish(error=None):
+        nonlocal finished
+        if not finished:
+            finished = True
+            if on_finish is not None:
+                on_finish(error=error)
+
+    if request is not None:
+        # Stop pulling from Gemini as soon as the client closes the connection.
+        chunks = cancel_on_disconnect(chunks, request.is_disconnected, f" ({model_name})")
+    body = stream_generator(chunks, model_name, finish, timer, ticket)
+    if SSE_COALESCE_MS > 0:
+        body = coalesce(body, SSE_COALESCE_MS / 1000)
+
+    async def cleanup():
+        nonlocal finished
+        # Backstop: the generators' finally blocks never run if the client leaves before the first chunk.
+        await body.aclose()
+        if not finished:
+            # Never read: close the primed upstream stream and hand its key back.
+            try:
+                aclose = getattr(source, "aclose", None)
+                if aclose is not None:
+                    await aclose()
+            finally:
+                if on_unused is not None:
+                    finished = True
+                    on_unused()
+                else:
+                    finish(error=None)
+        if ticket is not None:
+            ticket.release()
+    return StreamingResponse(body, media_type="text/event-stream", background=BackgroundTask(cleanup))
 
 def non_stream_response(gemini_response, model_name):
     try:
@@ -322,6 +763,48 @@ def non_stream_response(gemini_response, model_name):
         # General exception handler
         return {"error": {"message": f"Failed to process Gemini response: {e}", "type": "api_error", "code": "internal_error"}}
 
+# --- 批量任务 ---
+async def batch_completion(api_key, body):
+    """Runs one batch line (an OpenAI chat request body) on api_key and returns the OpenAI response."""
+    req = ChatCompletionRequest(**{**body, "stream": False})
+    log_entry = {
+        "id": f"log-{uuid.uuid4()}",
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
+        "model": req.model,
+        "stream": False,
+        "status": "pending",
+        "key_used": f"...{api_key[-4:]}",
+        "error_info": None
+    }
+    try:
+        try:
+            gemini_params = openai_to_gemini_params(req.dict())
+            safety_settings = get_safety_settings(req.model)
+        except ValueError as e:
+            raise BatchRequestError("invalid_request", str(e))
+        if MAX_PROMPT_TOKENS:
+            truncate_history(gemini_params, MAX_PROMPT_TOKENS, token_estimator)
+        response = await generate_content(api_key, req.model, gemini_params, safety_settings)
+        openai_response = non_stream_response(response, req.model)
+        if "error" in openai_response:
+            # Blocked prompts and unreadable responses would fail the same way on every key.
+            raise BatchRequestError(openai_response["error"]["code"], openai_response["error"]["message"])
+    except Exception as e:
+        log_entry["status"] = "failed"
+        log_entry["error_info"] = str(e)
+        record_call(log_entry)
+        raise
+    log_entry["status"] = "success"
+    record_call(log_entry)
+    return openai_response
+
+batch_manager = BatchManager(
+    BATCH_DIR, key_scheduler, batch_completion,
+    concurrency_per_key=BATCH_CONCURRENCY_PER_KEY,
+    max_attempts=BATCH_MAX_ATTEMPTS,
+    max_requests=BATCH_MAX_REQUESTS,
+)
+
 
 
 # --- 注册路由和静态文件服务 ---
@@ -0,0 +1,142 @@
+import os
+import time
+from bisect import bisect_left
+
+# --- 延迟指标 ---
+# 固定桶直方图：observe() 只做一次二分查找和两次加法，不保存原始样本。
+# 指标按 worker 进程统计，/api/metrics 以 Prometheus 文本格式输出。
+
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0,
+)
+
+METRIC_HELP = {
+    "baojimi_request_parse_seconds": "Time from request arrival to the handler, including body parsing.",
+    "baojimi_convert_seconds": "Time spent in openai_to_gemini_params.",
+    "baojimi_upstream_attempt_seconds": "Duration of each upstream attempt until a response or first chunk.",
+    "baojimi_time_to_first_chunk_seconds": "Time from request arrival to the first streamed content chunk.",
+    "baojimi_inter_chunk_seconds": "Gap between consecutive streamed content chunks.",
+    "baojimi_stream_duration_seconds": "Total duration of a streamed response.",
+    "baojimi_request_seconds": "Total handler time of non-streaming requests.",
+    "baojimi_admission_wait_seconds": "Time spent queued for an admission slot.",
+}
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Estimates a quantile by linear interpolation inside the bucket that contains it."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._histograms = {}  # (name, labels) -> Histogram
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def render_prometheus(self) -> str:
+        lines = []
+        by_name = {}
+        for (name, labels), histogram in self._histograms.items():
+            by_name.setdefault(name, []).append((labels, histogram))
+        for name in sorted(by_name):
+            lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in by_name[name]:
+                label_text = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+                prefix = label_text + "," if label_text else ""
+                cumulative = 0
+                for bound, bucket_count in zip(histogram.buckets, histogram.counts):
+                    cumulative += bucket_count
+                    lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {histogram.count}')
+                lines.append(f"{name}_sum{{{label_text}}} {histogram.sum:.6f}")
+                lines.append(f"{name}_count{{{label_text}}} {histogram.count}")
+        lines.append(f"# worker pid {os.getpid()}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> list:
+        """p50/p95/p99 in milliseconds for every series, for the status page."""
+        rows = []
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            rows.append({
+                "metric": name,
+                "labels": dict(labels),
+                "count": histogram.count,
+                "p50_ms": round(histogram.quantile(0.50) * 1000, 1),
+                "p95_ms": round(histogram.quantile(0.95) * 1000, 1),
+                "p99_ms": round(histogram.quantile(0.99) * 1000, 1),
+            })
+        return rows
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+registry = MetricsRegistry()
+
+
+class StreamTimer:
+    """Records time-to-first-chunk, inter-chunk gaps and total duration of one stream."""
+
+    __slots__ = ("model", "key", "request_started", "stream_started", "last_chunk")
+
+    def __init__(self, model: str, key: str, request_started: float):
+        self.model = model
+        self.key = key
+        self.request_started = request_started
+        self.stream_started = time.perf_counter()
+        self.last_chunk = None
+
+    def chunk(self):
+        now = time.perf_counter()
+        if self.last_chunk is None:
+            registry.observe("baojimi_time_to_first_chunk_seconds", now - self.request_started, model=self.model, key=self.key)
+        else:
+            registry.observe("baojimi_inter_chunk_seconds", now - self.last_chunk, model=self.model)
+        self.last_chunk = now
+
+    def done(self):
+        registry.observe("baojimi_stream_duration_seconds", time.perf_counter() - self.stream_started, model=self.model)
+
+
+class RequestTimingMiddleware:
+    """Pure ASGI middleware that stamps the arrival time before the body is parsed."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            scope.setdefault("state", {})["received_at"] = time.perf_counter()
+        await self.app(scope, receive, send)
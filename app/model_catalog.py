@@ -0,0 +1,114 @@
+import time
+import asyncio
+import logging
+
+from .clients import get_client
+
+logger = logging.getLogger("app")
+
+# 后台加载失败后，至少间隔这么久（秒）才会再次尝试
+RETRY_AFTER_FAILURE = 30.0
+
+
+def fetch_generative_models(api_key: str) -> list:
+    """Blocking call that pages through Google's model list; run it off the event loop."""
+    created = int(time.time())
+    return [
+        {"id": m.name.replace("models/", ""), "object": "model", "created": created, "owned_by": "google"}
+        for m in get_client(api_key).list_models()
+        if 'generateContent' in m.supported_generation_methods
+    ]
+
+
+class ModelCatalog:
+    """
+    In-memory model list with stale-while-revalidate refresh.
+
+    The first caller waits for the initial fetch. After that, callers always get the cached
+    list immediately; once it is older than `ttl` a single background refresh is started.
+    """
+
+    def __init__(self, scheduler, ttl: float = 600.0):
+        self.scheduler = scheduler
+        self.ttl = ttl
+        self._models = None
+        self._ids = frozenset()
+        self._fetched_at = 0.0
+        self._refresh_task = None
+        self._failed_at = None
+        self.last_error = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._models is not None
+
+    async def _fetch(self):
+        api_key = self.scheduler.acquire()
+        if api_key is None:
+            raise RuntimeError("No API key is available.")
+        started = time.monotonic()
+        try:
+            models = await asyncio.to_thread(fetch_generative_models, api_key)
+        except Exception as e:
+            self.scheduler.release(api_key, error=e)
+            self.last_error = str(e)
+            self._failed_at = time.monotonic()
+            raise
+        self.scheduler.release(api_key, latency=time.monotonic() - started)
+        self._models = models
+        self._ids = frozenset(model["id"] for model in models)
+        self._fetched_at = time.monotonic()
+        self.last_error = None
+        logger.info(f"Model list refreshed: {len(models)} models")
+        return models
+
+    def refresh(self) -> asyncio.Task:
+        """Starts a refresh unless one is already running, and returns its task."""
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self._fetch())
+            self._refresh_task.add_done_callback(_consume_error)
+        return self._refresh_task
+
+    def _stale(self) -> bool:
+        return time.monotonic() - self._fetched_at > self.ttl
+
+    def _may_retry(self) -> bool:
+        return self._failed_at is None or time.monotonic() - self._failed_at > RETRY_AFTER_FAILURE
+
+    def warm(self):
+        """Starts loading the list in the background if it is missing or older than `ttl`, backing off after failures."""
+        if self._models is not None and not self._stale():
+            return
+        if self._may_retry():
+            self.refresh()
+
+    async def get(self) -> list:
+        if self._models is None:
+            return await asyncio.shield(self.refresh())
+        if time.monotonic() - self._fetched_at > self.ttl:
+            self.refresh()
+        return self._models
+
+    def is_unknown(self, model_name: str) -> bool:
+        """True only when the list is loaded and does not contain model_name."""
+        if self._models is None:
+            return False
+        return model_name.replace("models/", "", 1) not in self._ids
+
+    async def confirm_unknown(self, model_name: str) -> bool:
+        """Like is_unknown(), but a miss against a list older than `ttl` waits for one refresh first."""
+        if not self.is_unknown(model_name):
+            return False
+        if self._stale() and self._may_retry():
+            try:
+                await asyncio.shield(self.refresh())
+            except Exception:
+                # Already logged by _consume_error; the list we have still decides.
+                pass
+        return self.is_unknown(model_name)
+
+
+def _consume_error(task: asyncio.Task):
+    # Background refresh failures are logged and kept in last_error; never left unretrieved.
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"Model list refresh failed: {task.exception()}")
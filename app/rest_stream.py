@@ -0,0 +1,208 @@
+import os
+import json
+from typing import TYPE_CHECKING
+
+from .streaming import StreamChunk
+
+if TYPE_CHECKING:
+    import httpx
+
+# --- REST 流式上游 ---
+# 直接调用 Gemini REST 接口 models/*:streamGenerateContent?alt=sse，逐行解析 SSE，
+# 每个事件只取出文本、结束原因和用量三个字段，不再经过 SDK 为每个分块构造的 protobuf / Python 响应对象。
+# 所有 Key 共用一个 httpx.AsyncClient 连接池，Key 放在请求头里。httpx 和 SDK 一样在第一次调用时才导入。
+
+# 可选：把 REST 上游指向其他地址（例如 bench/fake_gemini.py --rest-port 提供的本地假服务）。
+GEMINI_REST_ENDPOINT = os.environ.get("GEMINI_REST_ENDPOINT", "https://generativelanguage.googleapis.com").rstrip("/")
+REST_MAX_KEEPALIVE = int(os.environ.get("REST_MAX_KEEPALIVE", 64))
+REST_CONNECT_TIMEOUT = 10.0   # 建立连接的超时（秒）
+REST_READ_TIMEOUT = 300.0     # 两个分块之间最长等待时间（秒）
+
+_client = None
+_client_pid = None
+
+
+def _http_client() -> "httpx.AsyncClient":
+    global _client, _client_pid
+    import httpx
+    # Connections must not cross a gunicorn fork, so each worker builds its own pool on first use.
+    if _client is None or _client_pid != os.getpid():
+        _client = httpx.AsyncClient(
+            base_url=GEMINI_REST_ENDPOINT,
+            timeout=httpx.Timeout(REST_READ_TIMEOUT, connect=REST_CONNECT_TIMEOUT),
+            # Admission control already bounds concurrency; only the idle pool is capped here.
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=REST_MAX_KEEPALIVE),
+        )
+        _client_pid = os.getpid()
+    return _client
+
+
+async def close():
+    """Closes this process's connection pool."""
+    global _client
+    if _client is not None and _client_pid == os.getpid():
+        await _client.aclose()
+    _client = None
+
+
+def _camel(name: str) -> str:
+    head, *rest = name.split("_")
+    return head + "".join(word.capitalize() for word in rest)
+
+
+def _system_content(system_instruction) -> dict:
+    if isinstance(system_instruction, str):
+        return {"parts": [{"text": system_instruction}]}
+    parts = []
+    for item in system_instruction:
+        if isinstance(item, str):
+            parts.append({"text": item})
+        elif isinstance(item, dict) and "text" in item:
+            parts.append({"text": item["text"]})
+    return {"parts": parts}
+
+
+def request_body(contents, generation_config=None, system_instruction=None, safety_settings=None, cached_content=None) -> dict:
+    """The JSON body of a generateContent / streamGenerateContent call."""
+    body = {"contents": contents}
+    if cached_content:
+        # The system instruction is part of the cache.
+        body["cachedContent"] = cached_content
+    elif system_instruction:
+        body["systemInstruction"] = _system_content(system_instruction)
+    if generation_config:
+        body["generationConfig"] = {_camel(key): value for key, value in generation_config.items() if value is not None}
+    if safety_settings:
+        body["safetySettings"] = safety_settings
+    return body
+
+
+def _model_path(model_name: str) -> str:
+    return model_name if "/" in model_name else f"models/{model_name}"
+
+
+def _api_error(status_code: int, message: str) -> Exception:
+    """The google.api_core exception the SDK would raise, so key health and cache invalidation treat both transports alike."""
+    from google.api_core import exceptions as google_exceptions
+    return google_exceptions.from_http_status(status_code, message)
+
+
+def _error_message(body: bytes, fallback: str) -> str:
+    try:
+        return json.loads(body)["error"]["message"]
+    except (ValueError, KeyError, TypeError):
+        return body.decode("utf-8", "replace")[:500] or fallback
+
+
+def _chunk(event: dict) -> StreamChunk:
+    candidates = event.get("candidates")
+    if not candidates:
+        # A blocked prompt comes back as promptFeedback without candidates.
+        block_reason = (event.get("promptFeedback") or {}).get("blockReason")
+        return StreamChunk("", block_reason)
+    candidate = candidates[0]
+    parts = (candidate.get("content") or {}).get("parts") or ()
+    text = "".join(part.get("text", "") for part in parts)
+    finish_reason = candidate.get("finishReason")
+    if finish_reason == "FINISH_REASON_UNSPECIFIED":
+        finish_reason = None
+    metadata = event.get("usageMetadata")
+    if not metadata:
+        return StreamChunk(text, finish_reason)
+    usage = None
+    if finish_reason:
+        usage = {
+            "prompt_tokens": metadata.get("promptTokenCount", 0),
+            "completion_tokens": metadata.get("candidatesTokenCount", 0),
+            "total_tokens": metadata.get("totalTokenCount", 0),
+        }
+    return StreamChunk(text, finish_reason, metadata.get("candidatesTokenCount") or None, usage)
+
+
+async def _events(response: "httpx.Response"):
+    """StreamChunks parsed from the SSE body as it arrives."""
+    import httpx
+    data = []
+    try:
+        async for line in response.aiter_lines():
+            if line.startswith("data:"):
+                data.append(line[6:] if line.startswith("data: ") else line[5:])
+                continue
+            if line or not data:
+                continue
+            event = json.loads("\n".join(data))
+            data.clear()
+            error = event.get("error")
+            if error:
+                raise _api_error(error.get("code", 500), error.get("message", "Upstream stream error"))
+            yield _chunk(event)
+    except httpx.TransportError as e:
+        # The gRPC transport reports a dropped stream as UNAVAILABLE.
+        raise _api_error(503, f"Upstream stream broke: {e!r}") from e
+    if data:
+        yield _chunk(json.loads("\n".join(data)))
+
+
+class _RestChunks:
+    """StreamChunks of one primed response; aclose() closes the connection even if iteration never started."""
+
+    __slots__ = ("_response", "_events", "_first")
+
+    def __init__(self, response: "httpx.Response", events, first: StreamChunk):
+        self._response = response
+        self._events = events
+        self._first = first
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._first is not None:
+            chunk, self._first = self._first, None
+            return chunk
+        try:
+            return await self._events.__anext__()
+        except BaseException:
+            # End of stream, an upstream error or cancellation: the connection is done either way.
+            await self._response.aclose()
+            raise
+
+    async def aclose(self):
+        self._first = None
+        await self._events.aclose()
+        await self._response.aclose()
+
+
+async def stream_generate_content(api_key, model_name, contents, generation_config=None, system_instruction=None,
+                                  safety_settings=None, cached_content=None):
+    """
+    Starts a streamGenerateContent call and returns an async iterator of StreamChunks.
+
+    Like the SDK's generate_content_async(stream=True), this waits for the first chunk, so
+    HTTP errors and immediate failures surface here, before anything is sent to the client.
+    """
+    import httpx
+    client = _http_client()
+    body = request_body(contents, generation_config, system_instruction, safety_settings, cached_content)
+    request = client.build_request(
+        "POST", f"/v1beta/{_model_path(model_name)}:streamGenerateContent",
+        params={"alt": "sse"},
+        headers={"x-goog-api-key": api_key, "content-type": "application/json"},
+        content=json.dumps(body, ensure_ascii=False).encode("utf-8"),
+    )
+    try:
+        response = await client.send(request, stream=True)
+    except httpx.TransportError as e:
+        raise _api_error(503, f"Upstream connection failed: {e!r}") from e
+    try:
+        if response.status_code != 200:
+            raise _api_error(response.status_code, _error_message(await response.aread(), response.reason_phrase))
+        events = _events(response)
+        first = await events.__anext__()
+    except StopAsyncIteration:
+        await response.aclose()
+        raise _api_error(502, "Upstream stream ended without any chunks.") from None
+    except BaseException:
+        await response.aclose()
+        raise
+    return _RestChunks(response, events, first)
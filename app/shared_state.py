@@ -0,0 +1,239 @@
+import os
+import time
+import sqlite3
+import threading
+
+from limits.storage import Storage
+
+# --- 跨 worker 共享状态 ---
+# gunicorn 的每个 worker 都是独立进程，进程内的计数器只能看到自己那一份流量。
+# 默认使用同一台机器上的 SQLite 文件（WAL 模式）在 worker 之间共享
+# 速率限制计数和 Key 健康状态；SHARED_STATE_BACKEND=memory 可退回到进程内存储。
+# 调用日志见 call_log.py。
+
+SHARED_STATE_BACKEND = os.environ.get("SHARED_STATE_BACKEND", "sqlite").lower()
+SHARED_STATE_PATH = os.environ.get("SHARED_STATE_PATH", "/tmp/baojimi-lite-state.db")
+# 每个 IP / 限流维度一行计数；每个进程每计数这么多次，顺带删除一次已过期的行，避免表无限增长
+COUNTER_PRUNE_INTERVAL = 1000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rate_limits (
+    key TEXT PRIMARY KEY,
+    count INTEGER NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS key_health (
+    key_id TEXT PRIMARY KEY,
+    cooldown_until REAL NOT NULL,
+    consecutive_failures INTEGER NOT NULL,
+    rate_limit_streak INTEGER NOT NULL,
+    last_error TEXT,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+class SQLiteDatabase:
+    """
+    A SQLite file in WAL mode shared by every worker on the host, with one connection per process.
+    Callers hold `lock` while they use connection().
+    """
+
+    def __init__(self, path: str, schema: str):
+        self.path = path
+        self.schema = schema
+        self.lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._schema_ready = False
+
+    def connection(self) -> sqlite3.Connection:
+        # Connections must not cross a fork, so each worker process opens its own.
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if not self._schema_ready:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(self.schema)
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def initialize(self):
+        """
+        Creates the database once, before gunicorn forks its workers, so they do not all take the
+        write lock for the same schema setup at boot. The connection is closed again, not inherited.
+        """
+        if self.path == ":memory:":
+            return  # Every process gets its own in-memory database anyway.
+        with self.lock:
+            self.connection().close()
+            self._conn = None
+            self._schema_ready = True
+
+
+class SQLiteSharedState:
+    """Shared state stored in a single SQLite database visible to every worker on the host."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db = SQLiteDatabase(path, _SCHEMA)
+        self._increments = 0
+
+    def initialize(self):
+        self._db.initialize()
+
+    def _execute(self, sql: str, params=()):
+        with self._db.lock:
+            return self._db.connection().execute(sql, params).fetchall()
+
+
+    # 速率限制计数（固定窗口）
+    def incr_counter(self, key: str, expiry: float, amount: int = 1) -> int:
+        now = time.time()
+        rows = self._execute(
+            """
+            INSERT INTO rate_limits (key, count, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                count = CASE WHEN expires_at <= ? THEN excluded.count ELSE count + excluded.count END,
+                expires_at = CASE WHEN expires_at <= ? THEN excluded.expires_at ELSE expires_at END
+            RETURNING count
+            """,
+            (key, amount, now + expiry, now, now),
+        )
+        self._increments += 1
+        if self._increments % COUNTER_PRUNE_INTERVAL == 0:
+            self._execute("DELETE FROM rate_limits WHERE expires_at <= ?", (now,))
+        return rows[0][0]
+
+    def get_counter(self, key: str):
+        """Returns (count, expires_at) for a live counter, or (0, now) if it is missing or expired."""
+        now = time.time()
+        rows = self._execute("SELECT count, expires_at FROM rate_limits WHERE key = ? AND expires_at > ?", (key, now))
+        return rows[0] if rows else (0, now)
+
+    def clear_counter(self, key: str = None) -> int:
+        if key is None:
+            count = self._execute("SELECT COUNT(*) FROM rate_limits")[0][0]
+            self._execute("DELETE FROM rate_limits")
+            return count
+        self._execute("DELETE FROM rate_limits WHERE key = ?", (key,))
+        return 1
+
+    # Key 健康状态
+    def save_key_health(self, key_id: str, health: dict):
+        self._execute(
+            """
+            INSERT OR REPLACE INTO key_health
+                (key_id, cooldown_until, consecutive_failures, rate_limit_streak, last_error, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (key_id, health["cooldown_until"], health["consecutive_failures"],
+             health["rate_limit_streak"], health["last_error"], time.time()),
+        )
+
+    def load_key_health(self) -> dict:
+        rows = self._execute(
+            "SELECT key_id, cooldown_until, consecutive_failures, rate_limit_streak, last_error, updated_at"
+            " FROM key_health"
+        )
+        return {
+            key_id: {
+                "cooldown_until": cooldown_until,
+                "consecutive_failures": consecutive_failures,
+                "rate_limit_streak": rate_limit_streak,
+                "last_error": last_error,
+                "updated_at": updated_at,
+            }
+            for key_id, cooldown_until, consecutive_failures, rate_limit_streak, last_error, updated_at in rows
+        }
+
+
+class MemorySharedState:
+    """Per-process fallback with the same interface; only correct with a single worker."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._health = {}
+        self._increments = 0
+
+
+    def incr_counter(self, key: str, expiry: float, amount: int = 1) -> int:
+        now = time.time()
+        with self._lock:
+            count, expires_at = self._counters.get(key, (0, 0.0))
+            if expires_at <= now:
+                count, expires_at = 0, now + expiry
+            count += amount
+            self._counters[key] = (count, expires_at)
+            self._increments += 1
+            if self._increments % COUNTER_PRUNE_INTERVAL == 0:
+                self._counters = {name: counter for name, counter in self._counters.items() if counter[1] > now}
+            return count
+
+    def get_counter(self, key: str):
+        now = time.time()
+        count, expires_at = self._counters.get(key, (0, now))
+        return (count, expires_at) if expires_at > now else (0, now)
+
+    def clear_counter(self, key: str = None) -> int:
+        with self._lock:
+            if key is None:
+                count = len(self._counters)
+                self._counters.clear()
+                return count
+            self._counters.pop(key, None)
+            return 1
+
+    def save_key_health(self, key_id: str, health: dict):
+        self._health[key_id] = {**health, "updated_at": time.time()}
+
+    def load_key_health(self) -> dict:
+        return dict(self._health)
+
+    def initialize(self):
+        pass
+
+
+def create_shared_state():
+    if SHARED_STATE_BACKEND == "memory":
+        return MemorySharedState()
+    return SQLiteSharedState(SHARED_STATE_PATH)
+
+
+shared_state = create_shared_state()
+
+
+class SharedStateStorage(Storage):
+    """
+    `limits` storage backed by the shared state, so slowapi counters are global across workers.
+    Registered for the ``shared://`` scheme.
+    """
+
+    STORAGE_SCHEME = ["shared"]
+
+    @property
+    def base_exceptions(self):
+        return (sqlite3.Error,)
+
+    def incr(self, key: str, expiry: int, amount: int = 1) -> int:
+        return shared_state.incr_counter(key, expiry, amount)
+
+    def get(self, key: str) -> int:
+        return shared_state.get_counter(key)[0]
+
+    def get_expiry(self, key: str) -> float:
+        return shared_state.get_counter(key)[1]
+
+    def check(self) -> bool:
+        try:
+            shared_state.get_counter("__healthcheck__")
+            return True
+        except Exception:
+            return False
+
+    def reset(self) -> int:
+        return shared_state.clear_counter()
+
+    def clear(self, key: str) -> None:
+        shared_state.clear_counter(key)
@@ -0,0 +1,228 @@
+import asyncio
+import logging
+
+logger = logging.getLogger("app")
+
+
+class LeaderGone(Exception):
+    """The request that owned a shared stream went away before it started; run your own call."""
+
+
+class SubscriberLagged(Exception):
+    """A subscriber stopped reading and fell more than the buffer size behind the shared stream."""
+
+
+class _Closed:
+    __slots__ = ("error",)
+
+    def __init__(self, error=None):
+        self.error = error
+
+
+class _Subscriber:
+    """
+    One subscriber's view of a StreamBroadcast. Unlike an async generator, aclose() also leaves
+    the broadcast when iteration never started, e.g. the client went away before the first chunk.
+    """
+
+    __slots__ = ("_broadcast", "_queue", "_closed")
+
+    def __init__(self, broadcast, queue):
+        self._broadcast = broadcast
+        self._queue = queue
+        self._closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._closed:
+            raise StopAsyncIteration
+        try:
+            item = await self._queue.get()
+        except BaseException:
+            await self.aclose()
+            raise
+        if isinstance(item, _Closed):
+            await self.aclose()
+            if item.error is not None:
+                raise item.error
+            raise StopAsyncIteration
+        return item
+
+    async def aclose(self):
+        if not self._closed:
+            self._closed = True
+            self._broadcast._leave(self._queue)
+
+
+class StreamBroadcast:
+    """
+    Fans one upstream StreamChunk sequence out to every subscriber.
+
+    The leader calls start() with the upstream iterator, which is then drained by a single pump
+    task. Each subscriber reads from its own queue of at most `max_buffer` chunks; the first
+    `max_buffer` chunks are also kept so late joiners get them replayed, after which the stream
+    stops accepting joiners. A subscriber that falls a full buffer behind is cut off instead of
+    stalling the others, and the upstream is cancelled once the last subscriber leaves.
+    """
+
+    def __init__(self, max_buffer: int, on_unjoinable=None):
+        self.max_buffer = max_buffer
+        self._history = []
+        self._queues = set()
+        self._ready = asyncio.get_running_loop().create_future()
+        self._ready.add_done_callback(_consume_error)
+        self._pump = None
+        self._finished = False
+        self._on_unjoinable = on_unjoinable
+
+
+    def start(self, source, on_close=None):
+        """Starts pumping `source`; on_close(error=...) runs once the upstream is finished."""
+        self._pump = asyncio.ensure_future(self._run(source, on_close))
+        self._ready.set_result(None)
+
+    def fail(self, error: BaseException):
+        """The leader could not start the upstream stream; waiting joiners get `error`."""
+        self._close_to_joiners()
+        if not self._ready.done():
+            self._ready.set_exception(error)
+
+    async def join(self):
+        """Waits for the leader to start, then returns a subscriber, or None if replay is no longer possible."""
+        await asyncio.shield(self._ready)
+        return self.subscribe()
+
+    def subscribe(self):
+        if self._history is None:
+            return None
+        queue = asyncio.Queue(self.max_buffer + 1)
+        for item in self._history:
+            queue.put_nowait(item)
+        self._queues.add(queue)
+        return _Subscriber(self, queue)
+
+    async def is_abandoned(self) -> bool:
+        """True once every subscriber has left; the shared stream's counterpart of Request.is_disconnected()."""
+        return not self._queues
+
+    def _leave(self, queue):
+        self._queues.discard(queue)
+        if not self._queues and not self._finished and self._pump is not None:
+            # Nobody is listening any more; stop generating.
+            self._pump.cancel()
+
+    async def _run(self, source, on_close):
+        error = None
+        try:
+            async for chunk in source:
+                self._publish(chunk)
+        except asyncio.CancelledError:
+            error = LeaderGone("All subscribers left the shared stream.")
+        except Exception as e:
+            error = e
+        finally:
+            self._finished = True
+            aclose = getattr(source, "aclose", None)
+            if aclose is not None:
+                # Also ends the upstream call when the pump was cancelled.
+                try:
+                    await aclose()
+                except Exception as e:
+                    logger.warning(f"Failed to close a shared upstream stream: {e}")
+            self._close_to_joiners()
+            self._publish(_Closed(error))
+            if on_close is not None:
+                on_close(error=None if isinstance(error, LeaderGone) else error)
+
+    def _publish(self, item):
+        if self._history is not None:
+            if len(self._history) < self.max_buffer:
+                self._history.append(item)
+            else:
+                self._close_to_joiners()
+        for queue in list(self._queues):
+            try:
+                queue.put_nowait(item)
+            except asyncio.QueueFull:
+                logger.warning("Dropped a subscriber that fell too far behind a shared stream.")
+                self._queues.discard(queue)
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(_Closed(SubscriberLagged("Fell too far behind the shared stream.")))
+
+    def _close_to_joiners(self):
+        self._history = None
+        if self._on_unjoinable is not None:
+            self._on_unjoinable()
+            self._on_unjoinable = None
+
+
+class SingleFlight:
+    """
+    Deduplicates identical in-flight requests.
+
+    Non-streaming calls with the same key share one task and its result. Streams with the same
+    key share a StreamBroadcast. Entries disappear as soon as the call finishes (or the stream
+    stops accepting joiners), so only truly concurrent requests are merged.
+    """
+
+    def __init__(self, max_buffer: int = 1024):
+        self.max_buffer = max_buffer
+        self._calls = {}    # key -> asyncio.Task
+        self._streams = {}  # key -> StreamBroadcast
+        self.shared_calls = 0
+        self.shared_streams = 0
+
+    async def do(self, key, fn):
+        """Runs fn() once per key at a time; returns (result, shared) where shared means another request ran it."""
+        task = self._calls.get(key)
+        if task is not None:
+            self.shared_calls += 1
+            return await asyncio.shield(task), True
+        task = asyncio.ensure_future(fn())
+        self._calls[key] = task
+
+        def forget(_):
+            if self._calls.get(key) is task:
+                del self._calls[key]
+        task.add_done_callback(forget)
+        # Shielded, so the leader going away does not fail the requests sharing its call.
+        return await asyncio.shield(task), False
+
+    async def join_stream(self, key):
+        """A subscriber to an identical in-flight stream, or None when there is none to join."""
+        broadcast = self._streams.get(key)
+        if broadcast is None:
+            return None
+        try:
+            subscriber = await broadcast.join()
+        except LeaderGone:
+            return None
+        if subscriber is not None:
+            self.shared_streams += 1
+        return subscriber
+
+    def lead_stream(self, key) -> StreamBroadcast:
+        """Registers a new broadcast that identical streams will join until it stops accepting joiners."""
+        def forget():
+            if self._streams.get(key) is broadcast:
+                del self._streams[key]
+        broadcast = StreamBroadcast(self.max_buffer, on_unjoinable=forget)
+        self._streams[key] = broadcast
+        return broadcast
+
+    def stats(self) -> dict:
+        return {
+            "in_flight_calls": len(self._calls),
+            "in_flight_streams": len(self._streams),
+            "shared_calls": self.shared_calls,
+            "shared_streams": self.shared_streams,
+        }
+
+
+def _consume_error(future: asyncio.Future):
+    # Joiners may all have left before the leader failed; the error must not be reported as unretrieved.
+    if not future.cancelled():
+        future.exception()
@@ -0,0 +1,117 @@
+import json
+import time
+import uuid
+import asyncio
+from json.encoder import encode_basestring_ascii
+
+# --- OpenAI 兼容的 SSE 分块编码 ---
+# 每个流只生成一次 completion id / created 时间戳，并预先拼好 JSON 模板，
+# 每个 token 增量只需要转义 delta 文本本身。
+
+DONE = b"data: [DONE]\n\n"
+
+_FINISH_REASONS = {
+    None: b"null",
+    "stop": b'"stop"',
+    "length": b'"length"',
+    "content_filter": b'"content_filter"',
+    "error": b'"error"',
+}
+
+
+def _finish_reason_bytes(reason) -> bytes:
+    encoded = _FINISH_REASONS.get(reason)
+    if encoded is None:
+        encoded = encode_basestring_ascii(reason).encode("ascii")
+    return encoded
+
+
+class ChunkEncoder:
+    """Encodes chat.completion.chunk SSE events for a single stream as bytes."""
+
+    __slots__ = ("completion_id", "created", "model_name", "_content_head", "_finish_head", "_tail")
+
+    def __init__(self, model_name: str, completion_id: str = None, created: int = None):
+        self.completion_id = completion_id or f"chatcmpl-{uuid.uuid4()}"
+        self.created = created if created is not None else int(time.time())
+        self.model_name = model_name
+        envelope = (
+            b'data: {"id":' + encode_basestring_ascii(self.completion_id).encode("ascii")
+            + b',"object":"chat.completion.chunk","created":' + str(self.created).encode("ascii")
+            + b',"model":' + encode_basestring_ascii(model_name).encode("ascii")
+            + b',"choices":[{"index":0,"delta":'
+        )
+        self._content_head = envelope + b'{"content":'
+        self._finish_head = envelope + b'{}'
+        self._tail = b',"finish_reason":'
+
+    def content(self, text: str, finish_reason: str = None) -> bytes:
+        return b"".join((
+            self._content_head,
+            encode_basestring_ascii(text).encode("ascii"),
+            b"}",
+            self._tail,
+            _finish_reason_bytes(finish_reason),
+            b"}]}\n\n",
+        ))
+
+    def finish(self, finish_reason: str, usage: dict = None) -> bytes:
+        """The closing event; `usage` (OpenAI prompt/completion/total tokens) is attached to it when known."""
+        if usage is None:
+            return b"".join((self._finish_head, self._tail, _finish_reason_bytes(finish_reason), b"}]}\n\n"))
+        return b"".join((
+            self._finish_head,
+            self._tail,
+            _finish_reason_bytes(finish_reason),
+            b'}],"usage":',
+            json.dumps(usage, separators=(",", ":")).encode("ascii"),
+            b"}\n\n",
+        ))
+
+    @staticmethod
+    def error(message: str) -> bytes:
+        return b"data: " + json.dumps({"error": message}).encode("ascii") + b"\n\n"
+
+
+async def coalesce(byte_stream, window: float):
+    """
+    Merges SSE events that arrive within `window` seconds of the first buffered one into a
+    single write. Events are kept intact; only the number of transport writes drops.
+    """
+    iterator = byte_stream.__aiter__()
+    buffer = []
+    deadline = None
+    pending = None
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            if buffer:
+                done, _ = await asyncio.wait((pending,), timeout=max(0.0, deadline - loop.time()))
+                if not done:
+                    yield b"".join(buffer)
+                    buffer, deadline = [], None
+                    continue
+            try:
+                data = await pending
+            except StopAsyncIteration:
+                break
+            finally:
+                if pending.done():
+                    pending = None
+            buffer.append(data)
+            if deadline is None:
+                deadline = loop.time() + window
+            elif loop.time() >= deadline:
+                yield b"".join(buffer)
+                buffer, deadline = [], None
+        if buffer:
+            yield b"".join(buffer)
+    finally:
+        if pending is not None:
+            pending.cancel()
+            await asyncio.wait((pending,))
+        aclose = getattr(byte_stream, "aclose", None)
+        if aclose is not None:
+            await aclose()
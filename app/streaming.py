@@ -0,0 +1,135 @@
+import asyncio
+import logging
+from typing import NamedTuple, Optional
+
+logger = logging.getLogger("app")
+
+# 流式响应期间检查客户端是否已断开的间隔（秒）
+DISCONNECT_POLL_INTERVAL = 0.5
+
+
+class StreamChunk(NamedTuple):
+    """The parts of an upstream stream chunk the proxy actually uses."""
+    text: str
+    finish_reason: Optional[str] = None
+    # Output tokens Gemini has generated for this stream so far, when it reports them.
+    output_tokens: Optional[int] = None
+    # OpenAI-style usage (prompt/completion/total tokens), on the chunk that carries the finish reason.
+    usage: Optional[dict] = None
+
+
+class ClientDisconnected(Exception):
+    """The downstream client went away; the upstream stream has been cancelled."""
+
+
+def _finish_reason_name(chunk) -> Optional[str]:
+    if not chunk.candidates:
+        return None
+    reason = chunk.candidates[0].finish_reason
+    if not reason:
+        return None
+    # The SDK exposes proto enums; the OpenAI mapping works on their names.
+    return getattr(reason, "name", reason)
+
+
+def _output_tokens(chunk) -> Optional[int]:
+    usage = getattr(chunk, "usage_metadata", None)
+    return getattr(usage, "candidates_token_count", None) or None
+
+
+def _usage(chunk) -> Optional[dict]:
+    usage = getattr(chunk, "usage_metadata", None)
+    if not usage:
+        return None
+    return {
+        "prompt_tokens": usage.prompt_token_count,
+        "completion_tokens": usage.candidates_token_count,
+        "total_tokens": usage.total_token_count,
+    }
+
+
+class _SdkChunks:
+    """StreamChunks from a primed SDK stream; aclose() ends the upstream call even if iteration never started."""
+
+    __slots__ = ("_response", "_chunks")
+
+    def __init__(self, response):
+        self._response = response
+        self._chunks = _iterate_sdk(response)
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self._chunks.__anext__()
+
+    async def aclose(self):
+        await self._chunks.aclose()
+        # The gRPC stream behind AsyncGenerateContentResponse; closing it drops, and so cancels, the call.
+        upstream = getattr(self._response, "_iterator", None)
+        if upstream is not None and hasattr(upstream, "aclose"):
+            await upstream.aclose()
+
+
+def sdk_chunks(response):
+    """Adapts a google-generativeai streaming response into StreamChunks."""
+    return _SdkChunks(response)
+
+
+async def _iterate_sdk(response):
+    async for chunk in response:
+        finish_reason = _finish_reason_name(chunk)
+        usage = _usage(chunk) if finish_reason else None
+        if not chunk.parts:
+            if finish_reason:
+                yield StreamChunk("", finish_reason, _output_tokens(chunk), usage)
+            continue
+        yield StreamChunk(chunk.text, finish_reason, _output_tokens(chunk), usage)
+
+
+async def _wait_disconnect(is_disconnected, poll_interval):
+    while not await is_disconnected():
+        await asyncio.sleep(poll_interval)
+
+
+async def cancel_on_disconnect(chunks, is_disconnected, label="", poll_interval=DISCONNECT_POLL_INTERVAL):
+    """
+    Passes StreamChunks through until `is_disconnected()` reports the client has gone.
+
+    Each upstream read races a watcher, so a disconnect cancels the pending read at once
+    instead of after the next chunk arrives; ClientDisconnected is then raised. Cancelling
+    the read tears down the upstream generator, which stops generation and any retries.
+    """
+    iterator = chunks.__aiter__()
+    watcher = asyncio.ensure_future(_wait_disconnect(is_disconnected, poll_interval))
+    pending = None
+    chars, tokens = 0, None
+    try:
+        while True:
+            pending = asyncio.ensure_future(iterator.__anext__())
+            await asyncio.wait((pending, watcher), return_when=asyncio.FIRST_COMPLETED)
+            if not pending.done():
+                raise ClientDisconnected()
+            try:
+                chunk = pending.result()
+            except StopAsyncIteration:
+                return
+            finally:
+                pending = None
+            chars += len(chunk.text)
+            tokens = chunk.output_tokens or tokens
+            yield chunk
+    except (ClientDisconnected, asyncio.CancelledError, GeneratorExit):
+        # The server may also notice the disconnect first and cancel us, or close this generator.
+        logger.info(
+            f"Client disconnected mid-stream{label}; cancelled upstream after {chars} chars, "
+            f"{tokens if tokens is not None else 'unknown'} output tokens generated."
+        )
+        raise
+    finally:
+        watcher.cancel()
+        if pending is not None:
+            # The read runs in its own task, so cancelling it unwinds the upstream generator there.
+            pending.cancel()
+        elif hasattr(iterator, "aclose"):
+            await iterator.aclose()
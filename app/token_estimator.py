@@ -0,0 +1,91 @@
+import re
+import hashlib
+from collections import OrderedDict
+
+# --- 本地 Token 估算 ---
+# 不调用 countTokens 接口，按字符粗略估算：中日韩字符约 1 token/字，其余约 4 字符/token。
+# 角色扮演类请求每次都会带上完整的历史记录，所以按内容哈希缓存每段文本的估算结果。
+
+CHARS_PER_TOKEN = 4
+TOKENS_PER_MESSAGE = 4  # 每条消息的角色、分隔符等固定开销
+
+_CJK = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]")
+
+
+def estimate_text_tokens(text: str) -> int:
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    return cjk + -(-(len(text) - cjk) // CHARS_PER_TOKEN)
+
+
+class TokenEstimator:
+    """Estimates prompt size of converted Gemini params, caching per-text results by content hash."""
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self._cache = OrderedDict()  # digest -> tokens
+        self.hits = 0
+        self.misses = 0
+
+    def text_tokens(self, text: str) -> int:
+        if not text:
+            return 0
+        digest = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        tokens = self._cache.get(digest)
+        if tokens is not None:
+            self.hits += 1
+            self._cache.move_to_end(digest)
+            return tokens
+        self.misses += 1
+        tokens = estimate_text_tokens(text)
+        self._cache[digest] = tokens
+        if len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        return tokens
+
+    def message_tokens(self, message: dict) -> int:
+        return TOKENS_PER_MESSAGE + sum(self.text_tokens(part.get("text", "")) for part in message.get("parts", []))
+
+    def system_tokens(self, system_instruction) -> int:
+        if not system_instruction:
+            return 0
+        if isinstance(system_instruction, str):
+            return TOKENS_PER_MESSAGE + self.text_tokens(system_instruction)
+        # OpenAI content-part lists are passed through as-is by openai_to_gemini_params.
+        return TOKENS_PER_MESSAGE + sum(
+            self.text_tokens(item.get("text", "")) for item in system_instruction if isinstance(item, dict)
+        )
+
+    def estimate(self, gemini_params: dict) -> int:
+        return self.system_tokens(gemini_params.get("system_instruction")) + sum(
+            self.message_tokens(message) for message in gemini_params.get("contents", [])
+        )
+
+    def stats(self) -> dict:
+        return {"entries": len(self._cache), "hits": self.hits, "misses": self.misses}
+
+
+def truncate_history(gemini_params: dict, budget: int, estimator: TokenEstimator):
+    """
+    Drops the oldest turns until the estimated prompt fits in `budget` tokens.
+
+    The system instruction and the latest message are always kept, and the history still starts
+    with a user turn as Gemini requires. Returns (estimated_tokens, dropped_turns); gemini_params
+    is updated in place.
+    """
+    contents = gemini_params.get("contents", [])
+    sizes = [estimator.message_tokens(message) for message in contents]
+    total = estimator.system_tokens(gemini_params.get("system_instruction")) + sum(sizes)
+    if total <= budget or len(contents) <= 1:
+        return total, 0
+
+    start = 0
+    while start < len(contents) - 1 and total > budget:
+        total -= sizes[start]
+        start += 1
+    while start < len(contents) - 1 and contents[start].get("role") != "user":
+        total -= sizes[start]
+        start += 1
+    gemini_params["contents"] = contents[start:]
+    return total, start
@@ -0,0 +1,79 @@
+"""
+Microbenchmark: per-chunk cost of the SSE encoding in stream_generator.
+
+Compares the previous dict + json.dumps implementation (two dicts, uuid4(),
+time.time() and a full json.dumps per delta) against app.sse.ChunkEncoder.
+
+    python bench/bench_sse.py [--chunks 20000] [--repeat 5]
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.sse import ChunkEncoder  # noqa: E402
+
+MODEL = "gemini-2.5-pro"
+DELTAS = ["Hello", " world", "，你好", " \"quoted\"", "\n", "emoji 🚀", " and more text " * 3]
+
+
+def legacy_encode(text, finish_reason, model_name):
+    choice = {
+        "index": 0,
+        "delta": {"content": text},
+        "finish_reason": finish_reason
+    }
+    openai_chunk = {
+        "id": f"chatcmpl-{uuid.uuid4()}",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model_name,
+        "choices": [choice]
+    }
+    return f"data: {json.dumps(openai_chunk)}\n\n".encode("utf-8")
+
+
+def run_legacy(n):
+    for i in range(n):
+        legacy_encode(DELTAS[i % len(DELTAS)], None, MODEL)
+
+
+def run_encoder(n):
+    encoder = ChunkEncoder(MODEL)
+    for i in range(n):
+        encoder.content(DELTAS[i % len(DELTAS)])
+
+
+def check_equivalent():
+    encoder = ChunkEncoder(MODEL)
+    for text in DELTAS:
+        new = json.loads(encoder.content(text, "stop")[len(b"data: "):])
+        old = json.loads(legacy_encode(text, "stop", MODEL)[len(b"data: "):])
+        for payload in (new, old):
+            payload.pop("id")
+            payload.pop("created")
+        assert new == old, (new, old)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    check_equivalent()
+    results = {}
+    for name, fn in (("legacy json.dumps", run_legacy), ("ChunkEncoder", run_encoder)):
+        best = min(timeit.repeat(lambda: fn(args.chunks), number=1, repeat=args.repeat))
+        results[name] = best
+        print(f"{name:<20} {best / args.chunks * 1e6:8.2f} us/chunk  ({args.chunks} chunks, best of {args.repeat})")
+    print(f"speedup: {results['legacy json.dumps'] / results['ChunkEncoder']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
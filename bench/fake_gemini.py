@@ -0,0 +1,288 @@
+"""
+Local stand-in for the Gemini API, for offline benchmarks.
+
+Serves GenerateContent, StreamGenerateContent, ListModels and the cachedContents create/update
+calls over plaintext gRPC on localhost with configurable latency, chunk cadence, 429/500
+injection and mid-stream disconnects. Point the proxy at it with:
+
+    GEMINI_API_ENDPOINT=127.0.0.1:50051 GEMINI_API_INSECURE=true
+
+    python bench/fake_gemini.py --port 50051 --latency 0.2 --chunks 20 --chunk-interval 0.02
+
+With --rest-port it also serves the REST streamGenerateContent?alt=sse endpoint used by
+UPSTREAM_TRANSPORT=rest, sharing the same configuration and caches:
+
+    GEMINI_REST_ENDPOINT=http://127.0.0.1:50052 UPSTREAM_TRANSPORT=rest
+"""
+import json
+import uuid
+import random
+import asyncio
+import argparse
+from dataclasses import dataclass
+
+import grpc
+import uvicorn
+import google.ai.generativelanguage as glm
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+SERVICE_PREFIX = "google.ai.generativelanguage.v1beta"
+MODELS = ("gemini-1.5-flash", "gemini-1.5-pro", "gemini-2.0-flash", "gemini-2.5-flash", "gemini-2.5-pro")
+
+
+@dataclass
+class FakeConfig:
+    latency: float = 0.2            # time before the response / first chunk
+    chunks: int = 20                # chunks per streamed response
+    chunk_interval: float = 0.02    # gap between streamed chunks
+    chunk_text: str = "lorem ipsum dolor sit amet "
+    rate_429: float = 0.0           # fraction of calls failing with RESOURCE_EXHAUSTED
+    rate_500: float = 0.0           # fraction of calls failing with INTERNAL
+    rate_disconnect: float = 0.0    # fraction of streams cut off halfway
+
+
+def _response(text: str, finish: bool, prompt_tokens: int = 0, output_tokens: int = 0):
+    return glm.GenerateContentResponse(
+        candidates=[glm.Candidate(
+            content=glm.Content(role="model", parts=[glm.Part(text=text)]),
+            finish_reason=glm.Candidate.FinishReason.STOP if finish else glm.Candidate.FinishReason.FINISH_REASON_UNSPECIFIED,
+        )],
+        usage_metadata=glm.GenerateContentResponse.UsageMetadata(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=output_tokens,
+            total_token_count=prompt_tokens + output_tokens,
+        ),
+    )
+
+
+def _prompt_tokens(request) -> int:
+    return sum(len(part.text) for content in request.contents for part in content.parts) // 4
+
+
+class FakeGemini:
+    def __init__(self, config: FakeConfig):
+        self.config = config
+        self.calls = 0
+        self.active_streams = 0
+        self.caches = {}  # name -> prompt tokens held by the cache
+        self.cached_calls = 0
+        self.uploaded_bytes = 0
+
+    async def _inject_errors(self, context):
+        roll = random.random()
+        if roll < self.config.rate_429:
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, "Resource has been exhausted (e.g. check quota).")
+        if roll < self.config.rate_429 + self.config.rate_500:
+            await context.abort(grpc.StatusCode.INTERNAL, "An internal error has occurred.")
+
+    async def _check_cache(self, request, context) -> int:
+        """Prompt tokens held by the request's cached content, aborting if the cache is unknown."""
+        self.uploaded_bytes += glm.GenerateContentRequest.pb(request).ByteSize()
+        if not request.cached_content:
+            return 0
+        if request.cached_content not in self.caches:
+            await context.abort(grpc.StatusCode.NOT_FOUND, f"CachedContent not found: {request.cached_content}")
+        self.cached_calls += 1
+        return self.caches[request.cached_content]
+
+    async def generate_content(self, request, context):
+        self.calls += 1
+        cached_tokens = await self._check_cache(request, context)
+        await asyncio.sleep(self.config.latency)
+        await self._inject_errors(context)
+        text = self.config.chunk_text * self.config.chunks
+        return _response(text, True, cached_tokens + _prompt_tokens(request), len(text) // 4)
+
+    async def stream_generate_content(self, request, context):
+        self.calls += 1
+        self.active_streams += 1
+        try:
+            cached_tokens = await self._check_cache(request, context)
+            await asyncio.sleep(self.config.latency)
+            await self._inject_errors(context)
+            disconnect_at = self.config.chunks // 2 if random.random() < self.config.rate_disconnect else None
+            prompt_tokens = cached_tokens + _prompt_tokens(request)
+            for i in range(self.config.chunks):
+                if i == disconnect_at:
+                    await context.abort(grpc.StatusCode.UNAVAILABLE, "Connection reset by peer")
+                if i:
+                    await asyncio.sleep(self.config.chunk_interval)
+                last = i == self.config.chunks - 1
+                output_tokens = (i + 1) * len(self.config.chunk_text) // 4
+                yield _response(self.config.chunk_text, last, prompt_tokens, output_tokens)
+        finally:
+            self.active_streams -= 1
+
+    async def list_models(self, request, context):
+        return glm.ListModelsResponse(models=[
+            glm.Model(name=f"models/{name}", supported_generation_methods=["generateContent", "countTokens"])
+            for name in MODELS
+        ])
+
+    async def create_cached_content(self, request, context):
+        cached = request.cached_content
+        name = f"cachedContents/{uuid.uuid4().hex[:12]}"
+        system_chars = sum(len(part.text) for part in cached.system_instruction.parts)
+        self.caches[name] = system_chars // 4 + _prompt_tokens(cached)
+        return glm.CachedContent(name=name, model=cached.model, usage_metadata={"total_token_count": self.caches[name]})
+
+    async def update_cached_content(self, request, context):
+        if request.cached_content.name not in self.caches:
+            await context.abort(grpc.StatusCode.NOT_FOUND, f"CachedContent not found: {request.cached_content.name}")
+        return glm.CachedContent(name=request.cached_content.name)
+
+    def _rest_error(self, code: int, status: str, message: str):
+        return JSONResponse({"error": {"code": code, "message": message, "status": status}}, status_code=code)
+
+    async def rest_stream_generate_content(self, request):
+        """POST /v1beta/models/{model}:streamGenerateContent?alt=sse"""
+        model, _, method = request.path_params["target"].partition(":")
+        if method != "streamGenerateContent" or request.query_params.get("alt") != "sse":
+            return self._rest_error(404, "NOT_FOUND", f"Unsupported method: {method}")
+        raw = await request.body()
+        body = json.loads(raw)
+        self.calls += 1
+        self.uploaded_bytes += len(raw)
+        cached_tokens = 0
+        if body.get("cachedContent"):
+            if body["cachedContent"] not in self.caches:
+                return self._rest_error(404, "NOT_FOUND", f"CachedContent not found: {body['cachedContent']}")
+            self.cached_calls += 1
+            cached_tokens = self.caches[body["cachedContent"]]
+        await asyncio.sleep(self.config.latency)
+        roll = random.random()
+        if roll < self.config.rate_429:
+            return self._rest_error(429, "RESOURCE_EXHAUSTED", "Resource has been exhausted (e.g. check quota).")
+        if roll < self.config.rate_429 + self.config.rate_500:
+            return self._rest_error(500, "INTERNAL", "An internal error has occurred.")
+        prompt_tokens = cached_tokens + sum(
+            len(part.get("text", "")) for content in body.get("contents", []) for part in content.get("parts", [])
+        ) // 4
+        disconnect_at = self.config.chunks // 2 if random.random() < self.config.rate_disconnect else None
+
+        async def events():
+            self.active_streams += 1
+            try:
+                for i in range(self.config.chunks):
+                    if i == disconnect_at:
+                        raise ConnectionResetError("Connection reset by peer")
+                    if i:
+                        await asyncio.sleep(self.config.chunk_interval)
+                    last = i == self.config.chunks - 1
+                    output_tokens = (i + 1) * len(self.config.chunk_text) // 4
+                    candidate = {"content": {"role": "model", "parts": [{"text": self.config.chunk_text}]}, "index": 0}
+                    if last:
+                        candidate["finishReason"] = "STOP"
+                    event = {
+                        "candidates": [candidate],
+                        "usageMetadata": {
+                            "promptTokenCount": prompt_tokens,
+                            "candidatesTokenCount": output_tokens,
+                            "totalTokenCount": prompt_tokens + output_tokens,
+                        },
+                        "modelVersion": model,
+                    }
+                    yield f"data: {json.dumps(event)}\r\n\r\n".encode("utf-8")
+            finally:
+                self.active_streams -= 1
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    def rest_app(self) -> Starlette:
+        return Starlette(routes=[Route("/v1beta/models/{target}", self.rest_stream_generate_content, methods=["POST"])])
+
+    def handlers(self):
+        generative = grpc.method_handlers_generic_handler(f"{SERVICE_PREFIX}.GenerativeService", {
+            "GenerateContent": grpc.unary_unary_rpc_method_handler(
+                self.generate_content,
+                request_deserializer=glm.GenerateContentRequest.deserialize,
+                response_serializer=glm.GenerateContentResponse.serialize,
+            ),
+            "StreamGenerateContent": grpc.unary_stream_rpc_method_handler(
+                self.stream_generate_content,
+                request_deserializer=glm.GenerateContentRequest.deserialize,
+                response_serializer=glm.GenerateContentResponse.serialize,
+            ),
+        })
+        models = grpc.method_handlers_generic_handler(f"{SERVICE_PREFIX}.ModelService", {
+            "ListModels": grpc.unary_unary_rpc_method_handler(
+                self.list_models,
+                request_deserializer=glm.ListModelsRequest.deserialize,
+                response_serializer=glm.ListModelsResponse.serialize,
+            ),
+        })
+        caches = grpc.method_handlers_generic_handler(f"{SERVICE_PREFIX}.CacheService", {
+            "CreateCachedContent": grpc.unary_unary_rpc_method_handler(
+                self.create_cached_content,
+                request_deserializer=glm.CreateCachedContentRequest.deserialize,
+                response_serializer=glm.CachedContent.serialize,
+            ),
+            "UpdateCachedContent": grpc.unary_unary_rpc_method_handler(
+                self.update_cached_content,
+                request_deserializer=glm.UpdateCachedContentRequest.deserialize,
+                response_serializer=glm.CachedContent.serialize,
+            ),
+        })
+        return (generative, models, caches)
+
+
+async def start_server(config: FakeConfig, port: int = 0):
+    """Starts the fake on 127.0.0.1 and returns (server, fake, bound_port)."""
+    fake = FakeGemini(config)
+    server = grpc.aio.server()
+    server.add_generic_rpc_handlers(fake.handlers())
+    bound_port = server.add_insecure_port(f"127.0.0.1:{port}")
+    await server.start()
+    return server, fake, bound_port
+
+
+async def start_rest_server(fake: FakeGemini, port: int):
+    """Serves fake's REST endpoint on 127.0.0.1:port in the running loop; returns the uvicorn server."""
+    server = uvicorn.Server(uvicorn.Config(fake.rest_app(), host="127.0.0.1", port=port, log_level="warning", lifespan="off"))
+    asyncio.ensure_future(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    return server
+
+
+def add_config_arguments(parser: argparse.ArgumentParser):
+    defaults = FakeConfig()
+    parser.add_argument("--latency", type=float, default=defaults.latency)
+    parser.add_argument("--chunks", type=int, default=defaults.chunks)
+    parser.add_argument("--chunk-interval", type=float, default=defaults.chunk_interval)
+    parser.add_argument("--rate-429", type=float, default=defaults.rate_429)
+    parser.add_argument("--rate-500", type=float, default=defaults.rate_500)
+    parser.add_argument("--rate-disconnect", type=float, default=defaults.rate_disconnect)
+
+
+def config_from_args(args) -> FakeConfig:
+    return FakeConfig(
+        latency=args.latency,
+        chunks=args.chunks,
+        chunk_interval=args.chunk_interval,
+        rate_429=args.rate_429,
+        rate_500=args.rate_500,
+        rate_disconnect=args.rate_disconnect,
+    )
+
+
+async def _serve(args):
+    server, fake, port = await start_server(config_from_args(args), args.port)
+    rest = f" (REST on 127.0.0.1:{args.rest_port})" if args.rest_port else ""
+    if args.rest_port:
+        await start_rest_server(fake, args.rest_port)
+    print(f"Fake Gemini listening on 127.0.0.1:{port}{rest}", flush=True)
+    await server.wait_for_termination()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=50051)
+    parser.add_argument("--rest-port", type=int, default=0, help="also serve the REST SSE endpoint on this port")
+    add_config_arguments(parser)
+    asyncio.run(_serve(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
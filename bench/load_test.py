@@ -0,0 +1,249 @@
+"""
+Offline load test for the proxy against the local fake Gemini upstream.
+
+Starts bench/fake_gemini.py and the proxy (uvicorn, or gunicorn with --workers > 1) as
+subprocesses, then drives /v1/chat/completions in non-stream and stream mode at increasing
+concurrency. Reports throughput, end-to-end latency, time to first byte, proxy-added latency
+(observed minus the fake's configured upstream time) and proxy memory per connection.
+
+    python bench/load_test.py --concurrency 1 8 32 --requests 64 --latency 0.2 --chunks 20
+    python bench/load_test.py --modes stream --env UPSTREAM_TRANSPORT=rest   # REST SSE upstream
+
+No network access or real API keys are needed.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_gemini import add_config_arguments  # noqa: E402
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_KEYS = ",".join(f"AIzaFakeBenchKey{i:04d}" for i in range(8))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def rss_kb(pid: int) -> int:
+    """Resident memory of pid plus its direct children (gunicorn workers), in KB."""
+    total = 0
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def start_fake(args, port, rest_port=None):
+    cmd = [sys.executable, os.path.join(REPO_ROOT, "bench", "fake_gemini.py"), "--port", str(port),
+           "--rest-port", str(rest_port or 0),
+           "--latency", str(args.latency), "--chunks", str(args.chunks),
+           "--chunk-interval", str(args.chunk_interval), "--rate-429", str(args.rate_429),
+           "--rate-500", str(args.rate_500), "--rate-disconnect", str(args.rate_disconnect)]
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    process.stdout.readline()  # "Fake Gemini listening on ..."
+    return process
+
+
+def start_proxy(args, fake_port, fake_rest_port, proxy_port, state_path):
+    env = dict(os.environ)
+    env.update({
+        "GEMINI_API_KEYS": FAKE_KEYS,
+        "GEMINI_API_ENDPOINT": f"127.0.0.1:{fake_port}",
+        "GEMINI_API_INSECURE": "true",
+        "GEMINI_REST_ENDPOINT": f"http://127.0.0.1:{fake_rest_port}",
+        "CHAT_RATE_LIMIT": "1000000/minute",
+        "SHARED_STATE_PATH": state_path,
+        # Every request sends the same body; merged requests would measure fan-out, not upstream concurrency.
+        "COALESCE": "false",
+        "PYTHONWARNINGS": "ignore",
+    })
+    env.update(dict(item.split("=", 1) for item in args.env))
+    if args.workers > 1:
+        cmd = [sys.executable, "-m", "gunicorn", "-w", str(args.workers), "-k", "uvicorn.workers.UvicornWorker",
+               "app.main:app", "--bind", f"127.0.0.1:{proxy_port}", "--log-level", "warning"]
+    else:
+        cmd = [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(proxy_port), "--log-level", "warning"]
+    return subprocess.Popen(cmd, cwd=REPO_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def wait_ready(base_url, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(f"{base_url}/api/status")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError("proxy did not become ready")
+
+
+async def one_request(client, base_url, stream, model):
+    body = {"model": model, "stream": stream, "messages": [{"role": "user", "content": "Tell me a story."}]}
+    started = time.perf_counter()
+    ttfb = None
+    status = None
+    try:
+        async with client.stream("POST", f"{base_url}/v1/chat/completions", json=body) as response:
+            status = response.status_code
+            async for _ in response.aiter_raw():
+                if ttfb is None:
+                    ttfb = time.perf_counter() - started
+    except httpx.HTTPError:
+        status = "transport_error"
+    total = time.perf_counter() - started
+    return status, ttfb if ttfb is not None else total, total
+
+
+async def run_level(base_url, proxy_pid, stream, concurrency, total_requests, model):
+    results = []
+    queue = asyncio.Queue()
+    for _ in range(total_requests):
+        queue.put_nowait(None)
+    idle_rss = rss_kb(proxy_pid)
+    peak_rss = idle_rss
+
+    async def sample_memory():
+        nonlocal peak_rss
+        while True:
+            peak_rss = max(peak_rss, rss_kb(proxy_pid))
+            await asyncio.sleep(0.05)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=120.0, limits=limits) as client:
+        async def worker():
+            while not queue.empty():
+                queue.get_nowait()
+                results.append(await one_request(client, base_url, stream, model))
+
+        sampler = asyncio.ensure_future(sample_memory())
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        sampler.cancel()
+    return results, elapsed, idle_rss, peak_rss
+
+
+def summarize(mode, concurrency, results, elapsed, idle_rss, peak_rss, expected_total, expected_ttfb):
+    ok = [r for r in results if r[0] == 200]
+    latencies = [r[2] for r in ok]
+    ttfbs = [r[1] for r in ok]
+    overheads = [latency - expected_total for latency in latencies]
+    return {
+        "mode": mode,
+        "concurrency": concurrency,
+        "requests": len(results),
+        "ok": len(ok),
+        "errors": len(results) - len(ok),
+        "throughput_rps": round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        "latency_p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "latency_p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "ttfb_p50_ms": round(percentile(ttfbs, 0.50) * 1000, 1),
+        "ttfb_overhead_p50_ms": round((percentile(ttfbs, 0.50) - expected_ttfb) * 1000, 1) if ttfbs else 0.0,
+        "overhead_p50_ms": round(percentile(overheads, 0.50) * 1000, 1),
+        "overhead_p95_ms": round(percentile(overheads, 0.95) * 1000, 1),
+        "overhead_mean_ms": round(statistics.mean(overheads) * 1000, 1) if overheads else 0.0,
+        "rss_idle_mb": round(idle_rss / 1024, 1),
+        "rss_per_conn_kb": round(max(0, peak_rss - idle_rss) / concurrency, 1),
+    }
+
+
+def print_table(rows):
+    columns = ["mode", "concurrency", "ok", "errors", "throughput_rps", "latency_p50_ms", "latency_p95_ms",
+               "ttfb_p50_ms", "ttfb_overhead_p50_ms", "overhead_p50_ms", "overhead_p95_ms", "rss_per_conn_kb"]
+    widths = [max(len(c), *(len(str(r[c])) for r in rows)) for c in columns]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(str(row[c]).ljust(w) for c, w in zip(columns, widths)))
+
+
+async def run(args):
+    fake_port, fake_rest_port, proxy_port = free_port(), free_port(), free_port()
+    base_url = f"http://127.0.0.1:{proxy_port}"
+    state_path = os.path.join(tempfile.mkdtemp(prefix="baojimi-bench-"), "state.db")
+    fake = start_fake(args, fake_port, fake_rest_port)
+    proxy = start_proxy(args, fake_port, fake_rest_port, proxy_port, state_path)
+    rows = []
+    try:
+        await wait_ready(base_url)
+        # Warm up connections, the model list and the key pool.
+        async with httpx.AsyncClient(timeout=60.0) as client:
+            await asyncio.gather(*(one_request(client, base_url, False, args.model) for _ in range(4)))
+
+        stream_total = args.latency + (args.chunks - 1) * args.chunk_interval
+        for mode in args.modes:
+            stream = mode == "stream"
+            for concurrency in args.concurrency:
+                total_requests = max(args.requests, concurrency)
+                results, elapsed, idle_rss, peak_rss = await run_level(
+                    base_url, proxy.pid, stream, concurrency, total_requests, args.model
+                )
+                rows.append(summarize(
+                    mode, concurrency, results, elapsed, idle_rss, peak_rss,
+                    stream_total if stream else args.latency, args.latency,
+                ))
+                row = rows[-1]
+                print(f"{mode:<10} c={concurrency:<4} ok={row['ok']:<5} rps={row['throughput_rps']:<8} "
+                      f"p50={row['latency_p50_ms']}ms overhead_p50={row['overhead_p50_ms']}ms", flush=True)
+    finally:
+        proxy.terminate()
+        fake.terminate()
+        proxy.wait()
+        fake.wait()
+
+    print()
+    print_table(rows)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": vars(args), "results": rows}, f, indent=2)
+        print(f"\nResults written to {args.json}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--requests", type=int, default=64, help="requests per concurrency level")
+    parser.add_argument("--modes", nargs="+", choices=["non-stream", "stream"], default=["non-stream", "stream"])
+    parser.add_argument("--model", default="gemini-2.0-flash")
+    parser.add_argument("--workers", type=int, default=1, help="run the proxy under gunicorn with this many workers")
+    parser.add_argument("--env", nargs="*", default=[], metavar="KEY=VALUE", help="extra environment for the proxy, e.g. GEM=true")
+    parser.add_argument("--json", help="also write results to this JSON file")
+    add_config_arguments(parser)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,446 @@
+"""
+Offline regression checks for key bookkeeping, stream cleanup and shared-state housekeeping.
+
+Each check drives the real scheduler, handlers or stores with fake upstream calls and asserts
+how keys, upstream streams and stored rows end up. No network access or API keys are needed;
+exits 1 if any check fails.
+
+    python bench/regression_checks.py
+"""
+import os
+import sys
+import json
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# app.main reads its configuration at import time.
+os.environ.update({
+    "GEMINI_API_KEYS": "key-aaaa,key-bbbb",
+    "SHARED_STATE_BACKEND": "memory",
+    "MODEL_VALIDATION": "false",
+    "CHAT_RATE_LIMIT": "1000000/minute",
+})
+
+from google.api_core import exceptions as google_exceptions  # noqa: E402
+
+from app.hedging import Hedger  # noqa: E402
+from app.key_scheduler import KeyScheduler  # noqa: E402
+from app.streaming import StreamChunk  # noqa: E402
+
+CHECKS = []
+
+
+def check(fn):
+    CHECKS.append(fn)
+    return fn
+
+
+@check
+async def hedged_failure_is_recorded_as_failure():
+    scheduler = KeyScheduler(["key-aaaa", "key-bbbb"])
+    first = scheduler.acquire()
+
+    async def attempt(key):
+        if key == first:
+            # Slow enough to be hedged, then fails while the backup is still running.
+            await asyncio.sleep(0.03)
+            raise google_exceptions.ResourceExhausted("quota")
+        await asyncio.sleep(0.05)
+        return "ok"
+
+    def acquire_backup():
+        return scheduler.acquire(exclude={first})
+
+    hedger = Hedger(0.01, 1)
+    key, result = await hedger.call(attempt, first, acquire_backup, scheduler.release, scheduler.abandon)
+    scheduler.release(key, latency=0.05)
+    failed = scheduler._states[first]
+    assert result == "ok" and key != first
+    assert failed.failures == 1 and failed.successes == 0, (failed.failures, failed.successes)
+    assert failed.cooldown_until > 0 and not failed.latency_ewma
+    # The heaps must still be comparable after the failure.
+    assert scheduler.acquire() is not None
+
+
+@check
+async def losing_hedged_stream_is_closed():
+    scheduler = KeyScheduler(["key-aaaa", "key-bbbb"])
+    first = scheduler.acquire()
+    answered = asyncio.Event()
+    streams = {}
+
+    async def attempt(key):
+        # Both attempts get their first chunk in the same event-loop tick.
+        await answered.wait()
+        streams[key] = FakeStream()
+        return streams[key]
+
+    async def discard(stream):
+        await stream.aclose()
+
+    async def answer():
+        await asyncio.sleep(0.05)
+        answered.set()
+
+    hedger = Hedger(0.01, 1)
+    asyncio.ensure_future(answer())
+    key, result = await hedger.call(
+        attempt, first, lambda: scheduler.acquire(exclude={first}), scheduler.release, scheduler.abandon, discard
+    )
+    loser = next(other for other in streams if other != key)
+    assert len(streams) == 2 and streams[loser].closed and not result.closed, streams
+
+
+@check
+async def token_log_is_pruned_without_tpm_limit():
+    from app import key_scheduler
+    scheduler = KeyScheduler(["key-aaaa"])
+    clock = [1000.0]
+    real_monotonic = key_scheduler.time.monotonic
+    key_scheduler.time.monotonic = lambda: clock[0]
+    try:
+        for _ in range(1000):
+            scheduler.release(scheduler.acquire(tokens=100), latency=0.1)
+            clock[0] += 1.0
+    finally:
+        key_scheduler.time.monotonic = real_monotonic
+    state = scheduler._states["key-aaaa"]
+    # One acquire per second: only the last TPM window is kept.
+    assert len(state.token_log) <= key_scheduler.TPM_WINDOW + 1, len(state.token_log)
+    assert state.window_tokens == sum(tokens for _, tokens in state.token_log)
+
+
+class FakeStream:
+    """A primed upstream stream that records whether it was closed; fails or stalls after `chunks`."""
+
+    def __init__(self, chunks=(), error=None):
+        self.chunks = list(chunks)
+        self.error = error
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.chunks:
+            return self.chunks.pop(0)
+        if self.error is not None:
+            raise self.error
+        await asyncio.sleep(10)
+        return StreamChunk("hello", "STOP")
+
+    async def aclose(self):
+        self.closed = True
+
+
+@check
+async def batch_leaves_key_slots_for_chat():
+    from types import SimpleNamespace
+    from app.batches import BatchManager
+    scheduler = KeyScheduler(["key-aaaa", "key-bbbb"], max_in_flight=2)
+    done = asyncio.Event()
+
+    async def call(api_key, body):
+        await done.wait()
+        return {}
+
+    batches = BatchManager("/tmp", scheduler, call, concurrency_per_key=2)
+    run = SimpleNamespace(cancelling=False, write_result=lambda custom_id, **result: None)
+    tasks = [asyncio.ensure_future(batches._execute(run, f"request-{i}", {})) for i in range(8)]
+    await asyncio.sleep(0.01)
+    try:
+        assert batches.stats()["in_flight"] == 2, batches.stats()
+        # A chat request still finds a free slot on every key.
+        keys = {scheduler.acquire(), scheduler.acquire()}
+        assert keys == {"key-aaaa", "key-bbbb"}, keys
+    finally:
+        done.set()
+        await asyncio.gather(*tasks)
+
+
+@check
+async def stale_model_list_is_refreshed_without_models_calls():
+    from app import model_catalog
+    upstream = ["gemini-2.0-flash"]
+    real_fetch = model_catalog.fetch_generative_models
+    model_catalog.fetch_generative_models = lambda api_key: [{"id": model_id} for model_id in upstream]
+    try:
+        catalog = model_catalog.ModelCatalog(KeyScheduler(["key-aaaa"]), ttl=0.05)
+        await catalog.get()
+        upstream.append("gemini-new")
+        assert await catalog.confirm_unknown("gemini-new")  # The list is still fresh.
+        await asyncio.sleep(0.1)
+        # A miss against the stale list waits for one refresh instead of rejecting the model.
+        assert not await catalog.confirm_unknown("gemini-new")
+
+        upstream.append("gemini-newer")
+        await asyncio.sleep(0.1)
+        catalog.warm()  # What the chat path calls for known models.
+        await catalog._refresh_task
+        assert not catalog.is_unknown("gemini-newer")
+    finally:
+        model_catalog.fetch_generative_models = real_fetch
+
+
+@check
+async def expired_rate_limit_counters_are_pruned():
+    import tempfile
+    from app import shared_state
+    with tempfile.TemporaryDirectory() as directory:
+        for state in (shared_state.SQLiteSharedState(os.path.join(directory, "state.db")), shared_state.MemorySharedState()):
+            for i in range(shared_state.COUNTER_PRUNE_INTERVAL * 3):
+                # One request per client IP, each counter already expired by the next one.
+                state.incr_counter(f"LIMITER/10.0.{i // 256}.{i % 256}", -1)
+            state.incr_counter("LIMITER/live", 60)
+            if isinstance(state, shared_state.SQLiteSharedState):
+                rows = state._execute("SELECT COUNT(*) FROM rate_limits")[0][0]
+            else:
+                rows = len(state._counters)
+            assert rows <= shared_state.COUNTER_PRUNE_INTERVAL, (type(state).__name__, rows)
+            assert state.get_counter("LIMITER/live")[0] == 1
+
+
+@check
+async def closed_gem_stream_keeps_key_cooldown():
+    from app import gem_handler
+    scheduler = KeyScheduler(["key-aaaa"])
+    scheduler.release(scheduler.acquire(), error=google_exceptions.ResourceExhausted("quota"))
+    key = scheduler.acquire()  # The last-resort cooling key.
+    state = scheduler._states[key]
+    cooldown = state.cooldown_until
+
+    async def open_stream(api_key, *args):
+        return FakeStream(chunks=[StreamChunk("partial")])
+
+    stream = gem_handler.self_healing_stream_generator(
+        "gemini-2.0-flash", {"contents": []}, key, scheduler, open_stream=open_stream
+    )
+    await stream.__anext__()
+    await stream.aclose()
+    assert state.in_flight == 0 and state.successes == 0, (state.in_flight, state.successes)
+    assert state.cooldown_until == cooldown and state.rate_limit_streak == 1
+
+
+@check
+async def saturated_keys_end_gem_stream_with_upstream_error():
+    from app import gem_handler
+    class BusyScheduler(KeyScheduler):
+        def release(self, key, latency=None, error=None):
+            super().release(key, latency, error)
+            if error is not None:
+                # Another request takes the freed key before the stream can resume on it.
+                self.acquire()
+
+    scheduler = BusyScheduler(["key-aaaa", "key-bbbb"], max_in_flight=1)
+    key = scheduler.acquire()
+    scheduler.acquire()  # Another request holds the only other key.
+
+    async def open_stream(api_key, *args):
+        return FakeStream(chunks=[StreamChunk("partial")], error=google_exceptions.ServiceUnavailable("dropped"))
+
+    stream = gem_handler.self_healing_stream_generator(
+        "gemini-2.0-flash", {"contents": []}, key, scheduler, open_stream=open_stream
+    )
+    await stream.__anext__()
+    try:
+        await stream.__anext__()
+    except google_exceptions.ServiceUnavailable:
+        pass
+    else:
+        raise AssertionError("stream did not end with the upstream error")
+    in_flight = {state.key: state.in_flight for state in scheduler._states.values()}
+    assert in_flight == {"key-aaaa": 1, "key-bbbb": 1}, in_flight
+
+
+def chat_scope():
+    return {
+        "type": "http", "asgi": {"version": "3.0", "spec_version": "2.3"}, "http_version": "1.1",
+        "method": "POST", "scheme": "http", "path": "/v1/chat/completions", "raw_path": b"/v1/chat/completions",
+        "query_string": b"", "root_path": "", "headers": [(b"content-type", b"application/json")],
+        "client": ("127.0.0.1", 50000), "server": ("127.0.0.1", 8000),
+    }
+
+
+async def post_chat(main, payload):
+    """Sends one non-stream chat request through the app; returns (status, response JSON)."""
+    messages = [{"type": "http.request", "body": json.dumps(payload).encode(), "more_body": False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    await asyncio.wait_for(main.app(chat_scope(), receive, send), 5)
+    return sent[0]["status"], json.loads(b"".join(message.get("body", b"") for message in sent[1:]))
+
+
+async def disconnect_before_first_chunk(main):
+    streams = []
+
+    async def generate_content(api_key, model_name, gemini_params, safety_settings, stream=False):
+        streams.append(FakeStream())
+        return streams[-1]
+
+    main.generate_content = generate_content
+    main.REST_STREAMING = True  # Upstream responses are StreamChunk iterators, as with UPSTREAM_TRANSPORT=rest.
+    # Temperature 0, so the request may be coalesced when COALESCE_ENABLED is set.
+    body = json.dumps({
+        "model": "gemini-2.0-flash", "stream": True, "temperature": 0, "messages": [{"role": "user", "content": "hi"}]
+    }).encode()
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def receive():
+        # The client hangs up right after sending its request.
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        # Yields like a real transport, so the disconnect wins before the body is first read.
+        await asyncio.sleep(0)
+
+    await asyncio.wait_for(main.app(chat_scope(), receive, send), 5)
+    await asyncio.sleep(0.05)  # A shared stream's pump finishes in its own task.
+    assert len(streams) == 1 and streams[0].closed, "upstream stream was not closed"
+    in_flight = {state.key: state.in_flight for state in main.key_scheduler._states.values()}
+    assert not any(in_flight.values()), in_flight
+
+
+@check
+async def early_disconnect_releases_key():
+    import app.main as main
+    main.COALESCE_ENABLED = False
+    await disconnect_before_first_chunk(main)
+
+
+@check
+async def early_disconnect_releases_key_of_shared_stream():
+    import app.main as main
+    main.COALESCE_ENABLED = True
+    await disconnect_before_first_chunk(main)
+
+
+@check
+async def shared_gem_stream_resumes_after_leader_leaves():
+    import app.main as main
+    broken, leave = asyncio.Event(), asyncio.Event()
+    attempts = []
+
+    async def first_attempt():
+        yield StreamChunk("Once upon")
+        await broken.wait()
+        raise google_exceptions.ServiceUnavailable("dropped")
+
+    async def resumed_attempt():
+        yield StreamChunk(" a time.", "STOP")
+
+    async def open_stream(api_key, *args):
+        attempts.append(api_key)
+        return first_attempt() if len(attempts) == 1 else resumed_attempt()
+
+    real_open_stream = main.rest_stream.stream_generate_content
+    main.rest_stream.stream_generate_content = open_stream
+    main.GEM_ENABLED = main.REST_STREAMING = main.COALESCE_ENABLED = True
+    body = json.dumps({
+        "model": "gemini-2.0-flash", "stream": True, "temperature": 0, "messages": [{"role": "user", "content": "story"}]
+    }).encode()
+
+    def client(gone):
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+        received, first_chunk = [], asyncio.Event()
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            await gone.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            received.append(message.get("body", b""))
+            if b"Once upon" in received[-1]:
+                first_chunk.set()
+
+        task = asyncio.ensure_future(main.app(chat_scope(), receive, send))
+        return task, received, first_chunk
+
+    try:
+        leader, _, leader_started = client(leave)
+        await asyncio.wait_for(leader_started.wait(), 5)
+        follower, follower_received, follower_started = client(asyncio.Event())
+        await asyncio.wait_for(follower_started.wait(), 5)
+        # The leader hangs up; the follower is still reading when the upstream breaks.
+        leave.set()
+        await asyncio.wait_for(leader, 5)
+        broken.set()
+        await asyncio.wait_for(follower, 5)
+    finally:
+        main.rest_stream.stream_generate_content = real_open_stream
+        main.GEM_ENABLED = False
+    assert len(attempts) == 2, attempts
+    assert b"a time." in b"".join(follower_received), follower_received
+
+
+@check
+async def blocked_prompt_is_not_a_key_failure():
+    import app.main as main
+    from types import SimpleNamespace
+
+    async def generate_content(api_key, model_name, gemini_params, safety_settings, stream=False):
+        return SimpleNamespace(candidates=[], prompt_feedback=SimpleNamespace(block_reason="OTHER"))
+
+    main.generate_content = generate_content
+    main.COALESCE_ENABLED = False
+    states = main.key_scheduler._states.values()
+    before = {state.key: (state.failures, state.cooldown_until) for state in states}
+    status, _ = await post_chat(main, {"model": "gemini-2.0-flash", "messages": [{"role": "user", "content": "blocked"}]})
+    assert status == 500, status
+    after = {state.key: (state.failures, state.cooldown_until) for state in states}
+    assert after == before and not any(state.in_flight for state in states), (before, after)
+
+
+@check
+async def sampled_requests_are_not_coalesced():
+    import app.main as main
+    from types import SimpleNamespace
+    calls = []
+
+    async def generate_content(api_key, model_name, gemini_params, safety_settings, stream=False):
+        calls.append(api_key)
+        text = f"sample {len(calls)}"
+        await asyncio.sleep(0.05)
+        return SimpleNamespace(
+            candidates=[SimpleNamespace(content=SimpleNamespace(parts=[text]), finish_reason=1)], text=text,
+            usage_metadata=SimpleNamespace(prompt_token_count=1, candidates_token_count=2, total_token_count=3),
+        )
+
+    main.generate_content = generate_content
+    main.COALESCE_ENABLED = True
+    payload = {"model": "gemini-2.0-flash", "temperature": 1.0, "messages": [{"role": "user", "content": "sample"}]}
+    results = await asyncio.gather(*(post_chat(main, payload) for _ in range(3)))
+    texts = {body["choices"][0]["message"]["content"] for _, body in results}
+    assert len(calls) == 3 and len(texts) == 3, (calls, texts)
+
+    # Deterministic requests still share one upstream call.
+    calls.clear()
+    payload = {**payload, "temperature": 0}
+    results = await asyncio.gather(*(post_chat(main, payload) for _ in range(3)))
+    assert len(calls) == 1 and all(status == 200 for status, _ in results), (calls, results)
+
+
+async def main():
+    failed = 0
+    for fn in CHECKS:
+        try:
+            await fn()
+        except Exception as e:
+            failed += 1
+            print(f"FAIL {fn.__name__}: {e!r}")
+        else:
+            print(f"ok   {fn.__name__}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
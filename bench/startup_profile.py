@@ -0,0 +1,191 @@
+"""
+Cold start profile for the proxy: import time of app.main, time until a fresh process serves
+its first requests, and memory per worker with and without gunicorn preloading.
+
+    python bench/startup_profile.py                      # import profile + all server modes
+    python bench/startup_profile.py --skip-servers --top 15
+    python bench/startup_profile.py --budget-ms 750      # exit 1 when importing app.main is slower
+
+The import profile runs `python -X importtime -c "import app.main"` and groups the reported
+self time by top-level package. Server modes start the proxy against bench/fake_gemini.py, so no
+network access or real API keys are needed.
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import statistics
+import subprocess
+from collections import defaultdict
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_gemini import add_config_arguments  # noqa: E402
+from load_test import REPO_ROOT, FAKE_KEYS, free_port, start_fake  # noqa: E402
+
+# Import budget for app.main (median over --runs); the Gemini SDK must stay out of it.
+STARTUP_BUDGET_MS = 750
+# Modules that should only load on first use, never while importing app.main.
+LAZY_MODULES = ("google.generativeai", "google.ai.generativelanguage", "grpc", "google.api_core.exceptions", "httpx")
+MODES = ("uvicorn", "gunicorn", "gunicorn-preload")
+
+
+def proxy_env(tmpdir, fake_port=None):
+    env = dict(os.environ)
+    # Measure with bytecode caches, as in the Docker image, which compiles app/ at build time.
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    env.update({
+        "GEMINI_API_KEYS": FAKE_KEYS,
+        "CHAT_RATE_LIMIT": "1000000/minute",
+        "MODEL_VALIDATION": "false",
+        "SHARED_STATE_PATH": os.path.join(tmpdir, "state.db"),
+        "CALL_LOG_PATH": os.path.join(tmpdir, "calls.db"),
+        "BATCH_DIR": os.path.join(tmpdir, "batches"),
+        "PYTHONWARNINGS": "ignore",
+    })
+    if fake_port is not None:
+        env.update({"GEMINI_API_ENDPOINT": f"127.0.0.1:{fake_port}", "GEMINI_API_INSECURE": "true"})
+    return env
+
+
+def import_profile(env):
+    """(total ms, {module: (self ms, cumulative ms)}) for one `import app.main`."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app.main"],
+        cwd=REPO_ROOT, env=env, capture_output=True, text=True, check=True,
+    )
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = (int(self_us) / 1000, int(cumulative_us) / 1000)
+    return modules["app.main"][1], modules
+
+
+def report_imports(args, env):
+    import_profile(env)  # Warm-up: writes missing .pyc files and fills the OS page cache.
+    totals, modules = [], {}
+    for _ in range(args.runs):
+        total, modules = import_profile(env)
+        totals.append(total)
+    median = statistics.median(totals)
+
+    by_package = defaultdict(float)
+    for name, (self_ms, _) in modules.items():
+        by_package[name.split(".")[0]] += self_ms
+    print(f"import app.main: median {median:.0f} ms over {args.runs} runs (budget {args.budget_ms} ms)")
+    print(f"{'package':<28}{'self ms':>10}")
+    for package, self_ms in sorted(by_package.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"{package:<28}{self_ms:>10.1f}")
+    eager = [name for name in LAZY_MODULES if name in modules]
+    if eager:
+        print(f"loaded eagerly, should be lazy: {', '.join(eager)}")
+    return median <= args.budget_ms and not eager
+
+
+def pss_kb(pid: int) -> int:
+    """Proportional set size of pid: shared pages are split between the processes sharing them."""
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def children(pid: int) -> list:
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+
+def start_proxy(mode, workers, env, port):
+    if mode == "uvicorn":
+        cmd = [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"]
+    else:
+        env = {**env, "PRELOAD": "true" if mode == "gunicorn-preload" else "false"}
+        cmd = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--workers", str(workers),
+               "--bind", f"127.0.0.1:{port}", "--log-level", "warning", "app.main:app"]
+    return subprocess.Popen(cmd, cwd=REPO_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def measure_server(mode, workers, env, port):
+    base_url = f"http://127.0.0.1:{port}"
+    body = {"model": "gemini-1.5-flash", "messages": [{"role": "user", "content": "Hi"}]}
+    started = time.perf_counter()
+    process = start_proxy(mode, workers, env, port)
+    try:
+        ready = first_chat = None
+        async with httpx.AsyncClient(timeout=30) as client:
+            while ready is None:
+                if time.perf_counter() - started > 60 or process.poll() is not None:
+                    raise RuntimeError(f"{mode} did not become ready")
+                try:
+                    if (await client.get(f"{base_url}/api/status")).status_code == 200:
+                        ready = time.perf_counter() - started
+                except httpx.TransportError:
+                    await asyncio.sleep(0.02)
+            response = await client.post(f"{base_url}/v1/chat/completions", json=body)
+            first_chat = time.perf_counter() - started
+            if response.status_code != 200:
+                raise RuntimeError(f"{mode}: first chat request returned {response.status_code}")
+            # Let every worker finish its background SDK import before sampling memory.
+            await asyncio.sleep(2.0)
+        pids = children(process.pid) if mode != "uvicorn" else []
+        return {
+            "ready_ms": ready * 1000,
+            "first_chat_ms": first_chat * 1000,
+            "worker_pss_mb": [pss_kb(pid) / 1024 for pid in pids] or [pss_kb(process.pid) / 1024],
+            "total_pss_mb": sum(pss_kb(pid) for pid in [process.pid, *pids]) / 1024,
+        }
+    finally:
+        process.terminate()
+        process.wait()
+
+
+async def report_servers(args, tmpdir):
+    fake_port = free_port()
+    fake = start_fake(args, fake_port)
+    try:
+        env = proxy_env(tmpdir, fake_port)
+        print(f"\n{'mode':<18}{'ready ms':>10}{'1st chat ms':>13}{'worker PSS MB':>16}{'total PSS MB':>15}")
+        for mode in args.modes:
+            result = await measure_server(mode, args.workers, env, free_port())
+            worker_pss = statistics.mean(result["worker_pss_mb"])
+            print(f"{mode:<18}{result['ready_ms']:>10.0f}{result['first_chat_ms']:>13.0f}"
+                  f"{worker_pss:>16.1f}{result['total_pss_mb']:>15.1f}")
+    finally:
+        fake.terminate()
+        fake.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="import profile repetitions")
+    parser.add_argument("--top", type=int, default=10, help="packages to list by import self time")
+    parser.add_argument("--budget-ms", type=float, default=STARTUP_BUDGET_MS)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument("--skip-servers", action="store_true", help="only profile imports")
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        within_budget = report_imports(args, proxy_env(tmpdir))
+        if not args.skip_servers:
+            asyncio.run(report_servers(args, tmpdir))
+    if not within_budget:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
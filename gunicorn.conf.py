@@ -0,0 +1,25 @@
+import gc
+import os
+
+# --- Gunicorn 配置 ---
+# 用法：gunicorn -c gunicorn.conf.py app.main:app（Dockerfile 默认如此）
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 7860)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# PRELOAD=true（默认）：在 master 进程中导入应用、Gemini SDK 并创建共享数据库，然后再 fork 出 worker。
+# worker 以写时复制的方式共享这些内存页，启动更快、每个 worker 占用的内存更少；
+# 代价是修改代码后需要重启整个服务，而不能只重启 worker。
+preload_app = os.environ.get("PRELOAD", "true").lower() == "true"
+
+
+def when_ready(server):
+    # Called in the master after the (preloaded) app is imported and before any worker is forked.
+    if not server.cfg.preload_app:
+        return
+    from app.main import prepare_workers
+    prepare_workers()
+    # Move everything loaded so far out of the garbage collector's reach, so collections in the
+    # workers do not write to (and thereby un-share) these pages.
+    gc.freeze()
@@ -27,14 +27,40 @@ document.addEventListener('DOMContentLoaded', () => {
             statusBox.textContent = `服务状态正常 (running)`;
             statusBox.className = 'status ok';
             keyCountEl.textContent = data.key_count;
+            renderLatency(data.latency || []);
         } catch (error) {
             statusBox.textContent = `服务状态异常: ${error.message}`;
             statusBox.className = 'status error';
         }
     }
 
+    const LATENCY_LABELS = {
+        baojimi_time_to_first_chunk_seconds: '首个分块',
+        baojimi_upstream_attempt_seconds: '上游请求',
+        baojimi_stream_duration_seconds: '流式总时长',
+        baojimi_request_seconds: '非流式总时长',
+        baojimi_inter_chunk_seconds: '分块间隔',
+    };
+
+    function renderLatency(rows) {
+        const container = document.getElementById('latencyContainer');
+        if (!container) return;
+        rows = rows.filter(row => LATENCY_LABELS[row.metric] && row.count > 0);
+        if (rows.length === 0) {
+            container.innerHTML = '<p>暂无数据</p>';
+            return;
+        }
+        let html = '<table class="latency-table"><tr><th>指标</th><th>标签</th><th>次数</th><th>p50</th><th>p95</th><th>p99</th></tr>';
+        rows.forEach(row => {
+            const labels = Object.entries(row.labels).map(([k, v]) => `${k}=${v}`).join(' ');
+            html += `<tr><td>${LATENCY_LABELS[row.metric]}</td><td>${labels}</td><td>${row.count}</td><td>${row.p50_ms}</td><td>${row.p95_ms}</td><td>${row.p99_ms}</td></tr>`;
+        });
+        html += '</table>';
+        container.innerHTML = html;
+    }
+
     function fetchLogs() {
-        fetch('/api/logs')
+        fetch('/api/logs?limit=20')
         .then(response => {
             if (response.status === 401) {
                 throw new Error('授权码无效或未提供');
@@ -44,7 +70,8 @@ document.addEventListener('DOMContentLoaded', () => {
             }
             return response.json();
         })
-        .then(logs => {
+        .then(data => {
+            const logs = data.logs;
             const logsContainer = document.getElementById('logsContainer');
             if (!logsContainer) return;
             const isFirstLoad = displayedLogIds.size === 0;
@@ -107,6 +134,7 @@ document.addEventListener('DOMContentLoaded', () => {
     // Initial fetch and periodic refresh
     fetchLogs();
     setInterval(fetchLogs, 5000); // Refresh every 5 seconds
+    setInterval(fetchStatus, 10000); // Refresh status and latency every 10 seconds
 
     checkKeysBtn.addEventListener('click', async () => {
         const authKey = authKeyInput.value;
@@ -138,25 +166,57 @@ document.addEventListener('DOMContentLoaded', () => {
                 throw new Error(`检测失败: ${errorData.detail || response.statusText}`);
             }
 
-            const data = await response.json();
-            invalidKeys = data.invalid_keys;
-          
-            let resultsHTML = `<h3>检测完成</h3>`;
-            resultsHTML += `<p>✅ 有效 Key 数量: ${data.valid_keys.length}</p>`;
-            resultsHTML += `<p>❌ 无效 Key 数量: ${data.invalid_keys.length}</p>`;
-          
-            if (data.invalid_keys.length > 0) {
-                resultsHTML += `<h4>已失效的 Key:</h4><ul>`;
-                data.invalid_keys.forEach(key => {
-                    resultsHTML += `<li>${key.substring(0, 4)}...${key.substring(key.length - 4)}</li>`;
-                });
-                resultsHTML += `</ul>`;
-                copyInvalidBtn.style.display = 'block';
-            } else {
-                resultsHTML += `<p>所有 Key 均有效！</p>`;
-            }
+            // The server streams NDJSON: a header line, one line per key, then a summary line.
+            let total = 0;
+            let validCount = 0;
+            let finished = false;
+
+            const render = () => {
+                const checked = validCount + invalidKeys.length;
+                let resultsHTML = finished ? `<h3>检测完成</h3>` : `<h3>正在检测... (${checked} / ${total})</h3>`;
+                resultsHTML += `<p>✅ 有效 Key 数量: ${validCount}</p>`;
+                resultsHTML += `<p>❌ 无效 Key 数量: ${invalidKeys.length}</p>`;
+
+                if (invalidKeys.length > 0) {
+                    resultsHTML += `<h4>已失效的 Key:</h4><ul>`;
+                    invalidKeys.forEach(key => {
+                        resultsHTML += `<li>${key.substring(0, 4)}...${key.substring(key.length - 4)}</li>`;
+                    });
+                    resultsHTML += `</ul>`;
+                    copyInvalidBtn.style.display = 'block';
+                } else if (finished) {
+                    resultsHTML += `<p>所有 Key 均有效！</p>`;
+                }
+                resultsEl.innerHTML = resultsHTML;
+            };
+
+            const handleLine = (line) => {
+                if (!line.trim()) return;
+                const item = JSON.parse(line);
+                if (item.total !== undefined) {
+                    total = item.total;
+                } else if (item.done) {
+                    finished = true;
+                } else if (item.valid) {
+                    validCount++;
+                } else {
+                    invalidKeys.push(item.key);
+                }
+                render();
+            };
 
-            resultsEl.innerHTML = resultsHTML;
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+                const lines = buffer.split('\n');
+                buffer = lines.pop();
+                lines.forEach(handleLine);
+            }
+            handleLine(buffer);
 
         } catch (error) {
             resultsEl.innerHTML = `<p style="color: red;">发生错误: ${error.message}</p>`;